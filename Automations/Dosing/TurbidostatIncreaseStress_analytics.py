@@ -0,0 +1,234 @@
+
+'''
+Post-run analytics of the Turbidostat Increase Stress automation: per stress level statistics from the decision logs.
+
+The decision log of a run (.dlog, see TurbidostatIncreaseStress_decisionlog.py) holds every decision with its OD, its dosing
+(media_ml, alt_media_ml, waste_ml), the alt_media_ratio in use and the ratio_step of the schedule. The records are split into
+steps wherever ratio_step changes (the ramp moving on, or the fleet coordinator setting it), not where alt_media_ratio does:
+a constant schedule, or steps capped at 1.0, keep the same ratio over several steps, and a settings change of the schedule
+changes the ratio within a step. For each step this reports:
+  * hours, decisions, dilutions and dilutions per hour, and the mL of each pump
+  * OD mean and standard deviation
+  * growth_rate: from the rise of log(OD) between two dilutions, per hour
+  * dilution_growth_rate: the growth rate the dilutions imply (each one removes ln((culture_volume + mL) / culture_volume))
+  * adaptation: how fast growth_rate changes during the step, per hour per day, from a fit of its hourly values
+  * stalled: growth_rate fell below --stall_fraction of the first step's and the culture isn't recovering (adaptation <= 0)
+
+The logs are read in chunks of the memory map and every statistic is a running sum (per-step sums with np.bincount, variances
+merged chunk by chunk), so the memory used doesn't depend on the length of the run. Several runs are analysed in parallel,
+one per process.
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_analytics.py turbidostat_increase_stress_pio01_exp1.dlog turbidostat_increase_stress_pio02_exp1.dlog --output steps.json
+
+or in Python:
+
+    from TurbidostatIncreaseStress_analytics import analyze_run
+    steps = analyze_run("turbidostat_increase_stress_pio01_exp1.dlog")
+'''
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TurbidostatIncreaseStress_decisionlog import iter_decision_log
+
+
+MIN_BIN_HOURS = 0.25 # an hour of a step with less OD rise measured than this doesn't count in the adaptation fit
+
+
+class StepStats:
+    # Running sums of one step of one run. The OD variance is kept as (n, mean, M2) and merged chunk by chunk (Chan et al.).
+    __slots__ = ("step", "alt_media_ratio", "start", "end", "decisions", "dilutions", "media_ml", "alt_media_ml", "waste_ml",
+                 "od_n", "od_mean", "od_m2", "rise", "rise_hours", "dilution_growth", "hourly")
+
+    def __init__(self, step, alt_media_ratio, start):
+        self.step = step
+        self.alt_media_ratio = alt_media_ratio
+        self.start = self.end = start
+        self.decisions = self.dilutions = 0
+        self.media_ml = self.alt_media_ml = self.waste_ml = 0.0
+        self.od_n, self.od_mean, self.od_m2 = 0, 0.0, 0.0
+        self.rise = self.rise_hours = 0.0 # sum of the log(OD) rises between dilutions, and the hours they took
+        self.dilution_growth = 0.0
+        self.hourly = {} # hour of the step: [rise, rise_hours]
+
+    def add_od(self, n, mean, m2):
+        if n:
+            total = self.od_n + n
+            delta = mean - self.od_mean
+            self.od_mean += delta * n / total
+            self.od_m2 += m2 + delta * delta * self.od_n * n / total
+            self.od_n = total
+
+    def adaptation(self):
+        # Slope of the hourly growth rates over the step, weighted by the hours of rise measured in each, per hour per day.
+        bins = [(hour + 0.5, rise / hours, hours) for hour, (rise, hours) in self.hourly.items() if hours >= MIN_BIN_HOURS]
+        if len(bins) < 2:
+            return float("nan")
+        x, y, w = (np.array(column) for column in zip(*bins))
+        x_mean, y_mean = np.average(x, weights=w), np.average(y, weights=w)
+        spread = (w * (x - x_mean) ** 2).sum()
+        return float((w * (x - x_mean) * (y - y_mean)).sum() / spread * 24) if spread else float("nan")
+
+    def summary(self):
+        hours = (self.end - self.start) / 3600
+        return {
+            "step": self.step,
+            "alt_media_ratio": round(float(self.alt_media_ratio), 6),
+            "start": self.start,
+            "hours": hours,
+            "decisions": self.decisions,
+            "dilutions": self.dilutions,
+            "dilutions_per_hour": self.dilutions / hours if hours else float("nan"),
+            "media_ml": self.media_ml,
+            "alt_media_ml": self.alt_media_ml,
+            "waste_ml": self.waste_ml,
+            "od_mean": self.od_mean if self.od_n else float("nan"),
+            "od_std": float(np.sqrt(self.od_m2 / (self.od_n - 1))) if self.od_n > 1 else float("nan"),
+            "growth_rate": self.rise / self.rise_hours if self.rise_hours else float("nan"),
+            "dilution_growth_rate": self.dilution_growth / hours if hours else float("nan"),
+            "adaptation": self.adaptation(),
+        }
+
+
+class RunAnalysis:
+    # Feed it the decision records of one run in order, chunk by chunk. Only the open step and the last decision stay between
+    # two chunks.
+    def __init__(self, culture_volume=14.0):
+        self.culture_volume = culture_volume
+        self.steps = [] # the finished steps, as summaries
+        self.open = None # StepStats of the current step
+        self.last = None # (timestamp, log(OD), fired) of the previous decision
+
+    def add(self, records):
+        decisions = records[records["kind"] == 0]
+        n = len(decisions)
+        if not n:
+            return
+        t = decisions["timestamp"].astype(float)
+        ratio = decisions["alt_media_ratio"]
+        ratio_step = decisions["ratio_step"]
+        od = decisions["od"].astype(float)
+        fired = decisions["fired"] == 1
+
+        # Step labels: 0 is the open step if the chunk starts in it, then +1 at every change of ratio_step
+        change = np.empty(n, dtype=bool)
+        change[0] = self.open is None or ratio_step[0] != self.open.step
+        change[1:] = ratio_step[1:] != ratio_step[:-1]
+        labels = np.cumsum(change) - (1 if change[0] else 0)
+        if change[0] and self.open is not None:
+            labels += 1 # label 0 is the open step, which has no decision in this chunk
+        n_steps = int(labels[-1]) + 1
+        count = lambda weights=None: np.bincount(labels, weights=weights, minlength=n_steps)
+
+        steps = [self.open] if self.open is not None else []
+        starts = t[np.flatnonzero(change)]
+        for first, start in zip(np.flatnonzero(change), starts):
+            steps.append(StepStats(int(ratio_step[first]), float(ratio[first]), float(start)))
+
+        decisions_per_step, dilutions_per_step = count(), count(fired)
+        media, alt_media, waste = (count(decisions[column].astype(float)) for column in ("media_ml", "alt_media_ml", "waste_ml"))
+        dilution_growth = count(np.where(fired, np.log1p(decisions["waste_ml"] / self.culture_volume), 0.0))
+
+        valid = np.isfinite(od) & (od > 0)
+        od_n = count(valid)
+        od_sum = count(np.where(valid, od, 0.0))
+        od_mean = np.divide(od_sum, od_n, out=np.zeros(n_steps), where=od_n > 0)
+        od_m2 = count(np.where(valid, (od - od_mean[labels]) ** 2, 0.0))
+
+        # OD rise between two consecutive decisions of the same step with no dilution in between
+        log_od = np.full(n, np.nan)
+        np.log(od, out=log_od, where=valid)
+        previous_t = np.concatenate([[self.last[0] if self.last else np.nan], t[:-1]])
+        previous_log_od = np.concatenate([[self.last[1] if self.last else np.nan], log_od[:-1]])
+        previous_fired = np.concatenate([[self.last[2] if self.last else True], fired[:-1]])
+        same_step = np.concatenate([[not change[0]], labels[1:] == labels[:-1]])
+        dt = (t - previous_t) / 3600
+        pair = same_step & ~previous_fired & np.isfinite(log_od) & np.isfinite(previous_log_od) & (dt > 0)
+        rise = np.where(pair, log_od - previous_log_od, 0.0)
+        rise_hours = np.where(pair, dt, 0.0)
+        rises, rise_hours_per_step = count(rise), count(rise_hours)
+
+        step_start = np.array([step.start for step in steps])
+        hour = np.floor((t - step_start[labels]) / 3600).astype(np.int64)
+        keys, inverse = np.unique(labels[pair] * 2**32 + hour[pair], return_inverse=True)
+        hourly_rise = np.bincount(inverse, weights=rise[pair], minlength=len(keys))
+        hourly_hours = np.bincount(inverse, weights=rise_hours[pair], minlength=len(keys))
+        for key, r, h in zip(keys.tolist(), hourly_rise.tolist(), hourly_hours.tolist()):
+            bin_ = steps[key >> 32].hourly.setdefault(key & 0xFFFFFFFF, [0.0, 0.0])
+            bin_[0] += r
+            bin_[1] += h
+
+        ends = np.full(n_steps, -np.inf)
+        np.maximum.at(ends, labels, t)
+        for i, step in enumerate(steps):
+            step.end = max(step.end, float(ends[i]))
+            step.decisions += int(decisions_per_step[i])
+            step.dilutions += int(dilutions_per_step[i])
+            step.media_ml += float(media[i])
+            step.alt_media_ml += float(alt_media[i])
+            step.waste_ml += float(waste[i])
+            step.dilution_growth += float(dilution_growth[i])
+            step.rise += float(rises[i])
+            step.rise_hours += float(rise_hours_per_step[i])
+            step.add_od(int(od_n[i]), float(od_mean[i]), float(od_m2[i]))
+
+        # a step ends where the next one starts
+        for step, following in zip(steps, steps[1:]):
+            step.end = following.start
+            self.steps.append(step.summary())
+        self.open = steps[-1]
+        self.last = (float(t[-1]), float(log_od[-1]), bool(fired[-1]))
+
+    def finish(self, stall_fraction=0.5):
+        # The summaries of every step, the open one included, with stalled flagged.
+        steps = self.steps + ([self.open.summary()] if self.open is not None else [])
+        baseline = next((step["growth_rate"] for step in steps if np.isfinite(step["growth_rate"])), float("nan"))
+        for step in steps:
+            step["stalled"] = bool(step["growth_rate"] < stall_fraction * baseline and not step["adaptation"] > 0)
+        return steps
+
+
+def analyze_run(path, chunk_size=2**16, culture_volume=14.0, stall_fraction=0.5):
+    analysis = RunAnalysis(culture_volume)
+    for chunk in iter_decision_log(path, chunk_size):
+        analysis.add(chunk)
+    return analysis.finish(stall_fraction)
+
+
+def analyze_runs(paths, workers=None, **kwargs):
+    # {path: steps}, one run per worker process.
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {path: pool.submit(analyze_run, path, **kwargs) for path in paths}
+        return {path: future.result() for path, future in futures.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per stress level statistics of Turbidostat Increase Stress runs, from their decision logs')
+    parser.add_argument('paths', nargs='+', help='.dlog files, one per run')
+    parser.add_argument('--culture_volume', type=float, default=14.0, help='culture_volume of the runs, in mL, for dilution_growth_rate')
+    parser.add_argument('--stall_fraction', type=float, default=0.5, help='A step is stalled below this fraction of the first step\'s growth rate, when not recovering')
+    parser.add_argument('--chunk_size', type=int, default=2**16, help='Records read at a time')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--output', default=None, help='Also write every step of every run to this JSON file')
+    args = parser.parse_args()
+
+    results = analyze_runs(args.paths, workers=args.workers, chunk_size=args.chunk_size, culture_volume=args.culture_volume, stall_fraction=args.stall_fraction)
+    for path, steps in results.items():
+        print(os.path.basename(path))
+        print(f"{'step':>5} {'ratio':>6} {'hours':>7} {'dil/h':>6} {'media mL':>9} {'alt mL':>8} {'OD mean':>8} {'OD std':>7} {'growth':>7} {'dil. gr.':>8} {'adapt.':>7}")
+        for step in steps:
+            print(f"{step['step']:5d} {step['alt_media_ratio']:6.3f} {step['hours']:7.1f} {step['dilutions_per_hour']:6.2f} {step['media_ml']:9.1f} "
+                  f"{step['alt_media_ml']:8.1f} {step['od_mean']:8.3f} {step['od_std']:7.4f} {step['growth_rate']:7.3f} {step['dilution_growth_rate']:8.3f} "
+                  f"{step['adaptation']:7.3f}{'  stalled' if step['stalled'] else ''}")
+        stalled = [step for step in steps if step["stalled"]]
+        if stalled:
+            print(f"Adaptation stalled from step {stalled[0]['step']} (alt_media_ratio {stalled[0]['alt_media_ratio']:g}), {len(stalled)} stalled steps")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
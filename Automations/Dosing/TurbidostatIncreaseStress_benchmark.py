@@ -0,0 +1,231 @@
+
+'''
+Benchmark suite for the Turbidostat Increase Stress plugin, on the pioreactor stand-ins of the simulator (no hardware, no broker).
+
+It measures:
+  * cold_import_ms:         importing TurbidostatIncreaseStress_plugin in a fresh interpreter (median of 21 interpreters)
+  * instantiation_ms:       creating a TurbidostatIncreaseStress, including the calibration check
+  * execute_per_second:     steady-state execute() ticks that don't dilute
+  * dilution_tick_us:       one execute() tick that dilutes (stand-in pumps that take no time)
+  * instance_kb:            Python memory held by one running instance
+  * rss_30_days_mb:         resident memory of a process after a simulated 30 day run of one reactor
+  * rss_growth_30_days_mb:  how much the resident memory grew during those 30 days (a leak shows up here)
+
+Every benchmark runs in its own fresh interpreter, so one can't warm up or pollute another.
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_benchmark.py
+
+to compare against the baseline in TurbidostatIncreaseStress_benchmark.json (exit code 1 on a regression beyond a threshold), or
+
+python3 TurbidostatIncreaseStress_benchmark.py --save
+
+to record the current results as the new baseline. Thresholds are relative: 0.5 means 50% worse than the baseline fails.
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TurbidostatIncreaseStress_benchmark.json")
+
+# name -> (which way is better, relative threshold). Timings get a wide threshold: they vary more between runs than memory does.
+BENCHMARKS = {
+    "cold_import_ms": ("lower", 0.3), # the median of 21 imports stays within about 10% between runs
+    "instantiation_ms": ("lower", 0.5),
+    "execute_per_second": ("higher", 0.3),
+    "dilution_tick_us": ("lower", 0.5),
+    "instance_kb": ("lower", 0.2),
+    "rss_30_days_mb": ("lower", 0.2),
+    "rss_growth_30_days_mb": ("lower", 4.0), # a fraction of a MB that varies from run to run: only a real leak should fail
+}
+
+SETTINGS = dict(target_od=2.0, volume=1.0, dilutions=10, initial_alt_media=0.25, alt_media_ratio_increase=0.05)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def cold_import_ms():
+    from TurbidostatIncreaseStress_simulator import install_pioreactor_standins
+
+    install_pioreactor_standins() # the stand-ins and NumPy are not part of the plugin's import time
+    started = time.perf_counter()
+    import TurbidostatIncreaseStress_plugin  # noqa: F401
+    return (time.perf_counter() - started) * 1000
+
+
+def bench_cold_import_ms(samples=21):
+    # One import is a single sample of the disk cache and the scheduler, so time it in several fresh interpreters.
+    timings = []
+    for _ in range(samples):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--import_once"], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    return median(timings)
+
+
+def bench_instantiation_ms(repeats=50):
+    from TurbidostatIncreaseStress_simulator import load_plugin
+
+    plugin, _ = load_plugin()
+    timings = []
+    for i in range(repeats):
+        started = time.perf_counter()
+        automation = plugin.TurbidostatIncreaseStress(unit=f"bench{i}", experiment="benchmark", **SETTINGS)
+        timings.append((time.perf_counter() - started) * 1000)
+        automation.on_disconnected()
+    return median(timings)
+
+
+def bench_execute_per_second(n_calls=50000, repeats=5):
+    from TurbidostatIncreaseStress_simulator import load_plugin
+
+    plugin, _ = load_plugin()
+    automation = plugin.TurbidostatIncreaseStress(unit="bench", experiment="benchmark", **SETTINGS)
+    automation.latest_od = {"2": 1.0} # below target_od: a full decision, without dilution
+    execute = automation.execute
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(n_calls):
+            execute()
+        best = min(best, time.perf_counter() - started)
+    automation.on_disconnected()
+    return n_calls / best
+
+
+def bench_dilution_tick_us(n_calls=5000):
+    from TurbidostatIncreaseStress_simulator import CultureModel, ReactorBank, load_plugin
+
+    plugin, _ = load_plugin()
+    bank = ReactorBank(1, CultureModel())
+    automation = plugin.TurbidostatIncreaseStress(unit="bench", experiment="benchmark", bank=bank, index=0, **SETTINGS)
+    automation.latest_od = {"2": 3.0} # above target_od: every tick dilutes
+    timings = []
+    for _ in range(n_calls):
+        started = time.perf_counter()
+        automation.execute()
+        timings.append((time.perf_counter() - started) * 1e6)
+    automation.on_disconnected()
+    return median(timings)
+
+
+def bench_instance_kb(n_instances=50):
+    import tracemalloc
+
+    from TurbidostatIncreaseStress_simulator import load_plugin
+
+    plugin, _ = load_plugin()
+    plugin.TurbidostatIncreaseStress(unit="warmup", experiment="benchmark", **SETTINGS).on_disconnected()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    automations = [plugin.TurbidostatIncreaseStress(unit=f"bench{i}", experiment="benchmark", **SETTINGS) for i in range(n_instances)]
+    for automation in automations:
+        automation.latest_od = {"2": 1.0}
+        automation.execute() # so the filters and other lazily created state exist
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    for automation in automations:
+        automation.on_disconnected()
+    return used / n_instances / 1024
+
+
+def bench_rss_30_days():
+    from TurbidostatIncreaseStress_host import rss_mb
+    from TurbidostatIncreaseStress_simulator import simulate
+
+    simulate(days=1.0, engine="plugin", seed=0) # warm up: imports, caches, first allocations
+    before = rss_mb()
+    simulate(days=30.0, engine="plugin", seed=0)
+    after = rss_mb()
+    return {"rss_30_days_mb": after, "rss_growth_30_days_mb": after - before}
+
+
+RUNNERS = {
+    "cold_import_ms": bench_cold_import_ms,
+    "instantiation_ms": bench_instantiation_ms,
+    "execute_per_second": bench_execute_per_second,
+    "dilution_tick_us": bench_dilution_tick_us,
+    "instance_kb": bench_instance_kb,
+    "rss_30_days": bench_rss_30_days,
+}
+
+
+def run_all():
+    # Each runner in a fresh interpreter (this file with --run <name>), which prints its result as JSON.
+    results = {}
+    for name in RUNNERS:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", name], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        value = json.loads(output.strip().splitlines()[-1])
+        results.update(value if isinstance(value, dict) else {name: value})
+    return results
+
+
+def compare(results, baseline):
+    # Returns [(name, value, baseline value, relative change, failed)], the change being positive when worse.
+    rows = []
+    for name, (better, threshold) in BENCHMARKS.items():
+        value, reference = results[name], baseline["results"].get(name)
+        if reference is None:
+            rows.append((name, value, None, None, False))
+            continue
+        threshold = baseline.get("thresholds", {}).get(name, threshold)
+        if reference == 0:
+            change = 0.0 if value <= 0 else float("inf")
+        else:
+            change = (value - reference) / abs(reference) * (1 if better == "lower" else -1)
+        rows.append((name, value, reference, change, change > threshold))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the Turbidostat Increase Stress plugin on the pioreactor stand-ins')
+    parser.add_argument('--save', action='store_true', help='Record the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline JSON file')
+    parser.add_argument('--run', choices=list(RUNNERS), help=argparse.SUPPRESS) # internal: run one benchmark in this interpreter
+    parser.add_argument('--import_once', action='store_true', help=argparse.SUPPRESS) # internal: one cold import sample
+    args = parser.parse_args()
+
+    if args.import_once:
+        print(json.dumps(cold_import_ms()))
+        sys.exit(0)
+    if args.run:
+        print(json.dumps(RUNNERS[args.run]()))
+        sys.exit(0)
+
+    results = run_all()
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "machine": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.machine()},
+                "results": results,
+                "thresholds": {name: threshold for name, (_, threshold) in BENCHMARKS.items()},
+            }, f, indent=2)
+            f.write("\n")
+        for name, value in results.items():
+            print(f"{name:>24}: {value:12.3f}")
+        print(f"Saved as the baseline in {args.baseline}")
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failed = False
+    print(f"{'benchmark':>24} {'result':>12} {'baseline':>12} {'worse by':>8}")
+    for name, value, reference, change, regressed in compare(results, baseline):
+        failed |= regressed
+        reference_text = "-" if reference is None else f"{reference:12.3f}"
+        change_text = "-" if change is None else f"{change:+8.0%}"
+        print(f"{name:>24} {value:12.3f} {reference_text:>12} {change_text:>8}{'  REGRESSION' if regressed else ''}")
+    if baseline.get("machine", {}).get("processor") != platform.machine():
+        print(f"The baseline was recorded on {baseline.get('machine', {}).get('processor')}, this is {platform.machine()}: compare with care.")
+    sys.exit(1 if failed else 0)
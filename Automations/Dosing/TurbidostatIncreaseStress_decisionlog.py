@@ -0,0 +1,168 @@
+
+'''
+Reader for the binary decision log written by the Turbidostat Increase Stress automation (DecisionLog in TurbidostatIncreaseStress_plugin.py).
+
+The log is at ~/.pioreactor/storage/turbidostat_increase_stress_<unit>_<experiment>.dlog on the Pioreactor.
+Copy it to a laptop and run on the command line with
+
+python3 TurbidostatIncreaseStress_decisionlog.py turbidostat_increase_stress_<unit>_<experiment>.dlog
+
+or in Python:
+
+    from TurbidostatIncreaseStress_decisionlog import read_decision_log
+    log = read_decision_log("turbidostat_increase_stress_pio1_exp1.dlog")
+    dilutions = log[log["fired"] == 1]
+    print(dilutions["alt_media_ml"].sum())
+
+The records are NumPy structured arrays mapped straight from the file (no parsing, no copy),
+so a month of decisions is analysed in milliseconds.
+'''
+
+import argparse
+import ast
+import json
+import os
+
+import numpy as np
+
+
+MAGIC = b"TISDLOG1"
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("record_size", "<u4"),
+    ("capacity", "<u4"),
+    ("written", "<u8"),
+    ("padding", "V8"),
+])
+
+# Same layout as DecisionLog.RECORD in the plugin ("<QdffffffiiBBH")
+DECISION_DTYPE = np.dtype([
+    ("seq", "<u8"),
+    ("timestamp", "<f8"),       # unix time of the decision
+    ("od", "<f4"),              # filtered OD compared to target_od (NaN if no OD reading was available), or the new value of a setting (see setting_value)
+    ("media_ml", "<f4"),
+    ("alt_media_ml", "<f4"),
+    ("waste_ml", "<f4"),
+    ("alt_media_ratio", "<f4"),
+    ("target_od", "<f4"),
+    ("dilution_count", "<i4"),
+    ("ratio_step", "<i4"),      # step of the stress schedule the decision was made in
+    ("fired", "u1"),            # 1 if this decision triggered a dilution
+    ("kind", "u1"),             # see KINDS
+    ("setting", "<u2"),         # settings records: the changed setting, SETTINGS[setting - 1]
+])
+
+KINDS = {0: "decision", 1: "settings", 2: "rejected settings"}
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TurbidostatIncreaseStress_plugin.py")
+
+
+def read_plugin_settings(path=PLUGIN_PATH):
+    '''
+    Returns RECONFIGURABLE_SETTINGS of the plugin and the names of its string settings (datatype "string" in
+    published_settings), read from the plugin's source: importing it needs the pioreactor package.
+    '''
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    settings, strings = None, None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            if node.targets[0].id == "RECONFIGURABLE_SETTINGS":
+                settings = ast.literal_eval(node.value)
+            elif node.targets[0].id == "published_settings":
+                strings = frozenset(key for key, field in ast.literal_eval(node.value).items() if field["datatype"] == "string")
+    if settings is None or strings is None:
+        raise ValueError(f"{path} has no RECONFIGURABLE_SETTINGS or published_settings")
+    return settings, strings
+
+
+# SETTINGS[setting - 1] is the setting of a settings record. The value of a STRING_SETTINGS one is an index in the string table.
+SETTINGS, STRING_SETTINGS = read_plugin_settings()
+
+
+def read_decision_log(path, ordered=True):
+    '''
+    Returns the records of the log, oldest first. The array is a read-only memory map of the file, except when
+    the ring has wrapped around and ordered=True: then the two halves are joined, which copies them once.
+    '''
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError(f"{path} is not a Turbidostat Increase Stress decision log")
+    if header["record_size"] != DECISION_DTYPE.itemsize:
+        raise ValueError(f"{path} has {header['record_size']} byte records, this reader expects {DECISION_DTYPE.itemsize}")
+
+    capacity, written = int(header["capacity"]), int(header["written"])
+    records = np.memmap(path, dtype=DECISION_DTYPE, mode="r", offset=HEADER_DTYPE.itemsize, shape=(capacity,))
+    if written <= capacity:
+        return records[:written]
+    if not ordered:
+        return records
+    oldest = written % capacity
+    return np.concatenate([records[oldest:], records[:oldest]])
+
+
+def iter_decision_log(path, chunk_size=2**16):
+    '''
+    Yields the records of the log, oldest first, in chunks of at most chunk_size records: views of the memory map, so
+    going through a whole log never holds more than one chunk in memory, also when the ring has wrapped around.
+    '''
+    records = read_decision_log(path, ordered=False)
+    written = int(np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]["written"])
+    oldest = written % len(records) if written > len(records) else 0
+    for part in (records[oldest:], records[:oldest]):
+        for start in range(0, len(part), chunk_size):
+            yield part[start:start + chunk_size]
+
+
+def read_string_table(path):
+    '''
+    Returns the string table of a decision log (the `.strings` file next to it): the values of the string settings
+    records, by their index in the od column. Empty if there is none.
+    '''
+    try:
+        with open(path + ".strings") as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def setting_value(record, strings):
+    # (name, new value) of a settings record, strings being read_string_table(path).
+    name = SETTINGS[record["setting"] - 1] if 0 < record["setting"] <= len(SETTINGS) else "unknown setting"
+    if name in STRING_SETTINGS and not np.isnan(record["od"]):
+        return name, strings[int(record["od"])]
+    return name, float(record["od"])
+
+
+def summarize(records):
+    fired = records["fired"] == 1
+    decisions = records[records["kind"] == 0]
+    hours = float(records["timestamp"][-1] - records["timestamp"][0]) / 3600 if len(records) > 1 else 0.0
+    return {
+        "decisions": len(decisions),
+        "dilutions": int(fired.sum()),
+        "hours": hours,
+        "dilutions_per_hour": float(fired.sum()) / hours if hours else float("nan"),
+        "media_ml": float(records["media_ml"].sum()),
+        "alt_media_ml": float(records["alt_media_ml"].sum()),
+        "waste_ml": float(records["waste_ml"].sum()),
+        "no_od_reading": int(np.isnan(decisions["od"]).sum()),
+        "settings_changes": int((records["kind"] == 1).sum()),
+        "rejected_settings_changes": int((records["kind"] == 2).sum()),
+        "final_alt_media_ratio": float(records["alt_media_ratio"][-1]) if len(records) else float("nan"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize a Turbidostat Increase Stress decision log')
+    parser.add_argument('path', help='.dlog file')
+    args = parser.parse_args()
+
+    records = read_decision_log(args.path)
+    strings = read_string_table(args.path)
+    for key, value in summarize(records).items():
+        print(f"{key:>25}: {value}")
+    for record in records[records["kind"] != 0]:
+        setting, value = setting_value(record, strings)
+        print(f"{record['timestamp']:.0f} {KINDS[int(record['kind'])]}: {setting} = {value!r}")
@@ -0,0 +1,464 @@
+
+'''
+Fleet coordinator for the Turbidostat Increase Stress automation: one process driving the same protocol on many Pioreactors.
+
+It talks to the units only through the MQTT broker, on the topics pioreactor already uses:
+  * launch:    pioreactor/<unit>/<experiment>/run/dosing_control, picked up by the monitor job of each unit
+  * settings:  pioreactor/<unit>/<experiment>/dosing_automation/settings/set, the plugin's settings transaction (see reconfigure):
+               all the changed settings in one message, sent once to pioreactor/$broadcast/... when the fleet is the whole cluster
+  * state:     pioreactor/<unit>/<experiment>/dosing_automation/<dilution_count, ratio_step, ...>, published by every unit
+
+With --lockstep 1, every unit waits at the end of each step of the stress ramp (step_ready) and the coordinator moves all of them
+to the next step at once (by setting ratio_step) when the last one is ready, so their ramps don't drift apart.
+
+run on the command line (on the leader) with
+
+python3 TurbidostatIncreaseStress_fleet.py --experiment exp1 --units pio01 pio02 pio03 --lockstep 1 --target_od 2.0 --volume 1.0
+
+--experiment is required. Settings are resolved like in TurbidostatIncreaseStress_run.py (command line, --config, YAML defaults). Without --units, the fleet
+is every unit of the cluster, and --lockstep 1 needs --fleet_size, the number of units: a unit that has not reported yet is not
+known to the coordinator, and the fleet must not move on without it. It starts the automation and prints the fleet state every
+minute, until interrupted, then stops the automation on every unit.
+
+Without a broker or Pioreactors:
+
+python3 TurbidostatIncreaseStress_fleet.py --simulate 50
+
+runs 50 real plugin instances against an in-process broker stand-in, measures the fan-out latency of a settings change
+(one broadcast, one message per unit, one message per unit and per setting), and replays a few days of the ramp with and
+without lockstep to compare how far the units' steps drift apart.
+'''
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+
+import numpy as np
+
+from TurbidostatIncreaseStress_run import build_parser, read_fields, resolve_settings, validate
+
+
+BROADCAST = "$broadcast" # pioreactor's UNIVERSAL_IDENTIFIER: a topic for every unit of the cluster
+JOB = "dosing_automation"
+AUTOMATION = "turbidostat_increase_stress"
+STATE = ("dilution_count", "ratio_step", "alt_media_ratio", "step_ready", "reservoir_empty") # published by each unit, aggregated here
+
+
+def topic_matches(pattern, topic):
+    # MQTT topic filter: + matches one level, # all the remaining ones.
+    pattern_levels, topic_levels = pattern.split("/"), topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or level not in ("+", topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def parse_value(payload):
+    # A published setting, as the unit sent it: JSON, or a bare string.
+    text = payload.decode() if isinstance(payload, bytes) else payload
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {"True": True, "False": False}.get(text, text)
+
+
+class UnitState:
+    __slots__ = STATE + ("updated_at",)
+
+    def __init__(self):
+        self.dilution_count = 0
+        self.ratio_step = 0
+        self.alt_media_ratio = float("nan")
+        self.step_ready = False
+        self.reservoir_empty = ""
+        self.updated_at = None
+
+
+class FleetCoordinator:
+    # units: the Pioreactors of the fleet, or None for every unit of the cluster (the settings then go out as one broadcast,
+    # and the fleet is every unit that reports its state). publish(topic, payload) sends a message, and on_message must receive
+    # the messages of the topics in subscriptions(). fleet_size: with units=None and lockstep, the number of units lockstep waits
+    # for, since the coordinator only learns of a unit when it first reports.
+    def __init__(self, experiment, units, publish, lockstep=False, fleet_size=None):
+        if not experiment:
+            raise ValueError("The fleet needs an experiment: every topic of the units has it")
+        if lockstep and units is None and not fleet_size:
+            raise ValueError("Lockstep on every unit of the cluster needs the fleet size: a unit that hasn't reported yet would be left behind")
+        self.experiment = experiment
+        self.units = list(units) if units is not None else None
+        self.fleet_size = len(self.units) if self.units is not None else fleet_size
+        self.publish = publish
+        self.lockstep = lockstep
+        self.states = {unit: UnitState() for unit in self.units or ()}
+        self.pending = {} # settings waiting for the end of a batch()
+        self.batching = 0
+        self.advanced_to = None # lockstep: the step every unit was last moved to
+        self.lock = threading.Lock() # on_message runs on the MQTT thread, set() on the caller's
+
+    def topic(self, unit, suffix):
+        return f"pioreactor/{unit}/{self.experiment}/{suffix}"
+
+    def targets(self):
+        return [BROADCAST] if self.units is None else self.units
+
+    def subscriptions(self):
+        return [self.topic("+", f"{JOB}/{attr}") for attr in STATE]
+
+    def launch(self, **settings):
+        # Start the automation on every unit, through the monitor job of each unit.
+        payload = json.dumps({"options": {"automation_name": AUTOMATION, **settings}, "args": []})
+        for unit in self.targets():
+            self.publish(self.topic(unit, "run/dosing_control"), payload)
+
+    def stop(self):
+        # Returns what publish returned for each message, e.g. to wait until they are sent before disconnecting.
+        return [self.publish(self.topic(unit, "dosing_control/$state/set"), "disconnected") for unit in self.targets()]
+
+    def set(self, **settings):
+        # Change settings on every unit. Inside a batch(), the changes are merged and sent when the batch ends.
+        with self.lock:
+            self.pending.update(settings)
+            if self.batching:
+                return
+        self.flush()
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            self.batching += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batching -= 1
+            if not self.batching:
+                self.flush()
+
+    def flush(self):
+        # The pending settings as one transaction per unit (a single broadcast for the whole cluster): a unit applies all of them
+        # between two decisions, or none if they are not valid for it.
+        with self.lock:
+            settings, self.pending = self.pending, {}
+        if settings:
+            payload = json.dumps(settings)
+            for unit in self.targets():
+                self.publish(self.topic(unit, f"{JOB}/settings/set"), payload)
+
+    def on_message(self, topic, payload):
+        _, unit, experiment, job, attr = topic.split("/")
+        if experiment != self.experiment or job != JOB or attr not in STATE:
+            return
+        if self.units is not None and unit not in self.states:
+            return # a unit of the cluster that is not part of this fleet
+        with self.lock:
+            state = self.states.setdefault(unit, UnitState())
+            setattr(state, attr, parse_value(payload))
+            state.updated_at = time.time()
+            advance_to = self.lockstep_step()
+        if advance_to is not None:
+            for unit in self.targets():
+                self.publish(self.topic(unit, f"{JOB}/ratio_step/set"), str(advance_to))
+
+    def lockstep_step(self):
+        # The step to move every unit to, when the last unit finished its step, else None. Units behind the others are moved
+        # forward too, so the fleet is on the same step from then on. Called with the lock held.
+        if not self.lockstep or len(self.states) < (self.fleet_size or 1) or any(state.updated_at is None for state in self.states.values()):
+            return None # a unit of the fleet has not reported yet
+        if not all(state.step_ready for state in self.states.values()):
+            return None
+        step = max(state.ratio_step for state in self.states.values()) + 1
+        self.advanced_to = step
+        for state in self.states.values():
+            state.step_ready = False # until each unit reports it is ready again, at the new step: a unit can publish the new
+                                     # ratio_step before its step_ready goes back to False, which must not count as ready
+        return step
+
+    def status(self):
+        with self.lock:
+            states = dict(self.states)
+        reporting = {unit: state for unit, state in states.items() if state.updated_at is not None}
+        steps = [state.ratio_step for state in reporting.values()]
+        ratios = [state.alt_media_ratio for state in reporting.values()]
+        return {
+            "units": max(len(states), self.fleet_size or 0),
+            "reporting": len(reporting),
+            "ratio_step_min": min(steps, default=None),
+            "ratio_step_max": max(steps, default=None),
+            "alt_media_ratio_min": min(ratios, default=None),
+            "alt_media_ratio_max": max(ratios, default=None),
+            "step_ready": sum(state.step_ready for state in reporting.values()),
+            "reservoir_empty": {unit: state.reservoir_empty for unit, state in reporting.items() if state.reservoir_empty},
+            "silent": sorted(unit for unit in states if unit not in reporting),
+        }
+
+
+class LocalBroker:
+    # In-process stand-in for the MQTT broker, to run a fleet without Pioreactors: topic filters with + and #, and with
+    # threaded=True a delivery queue and thread per client, like one network connection per Pioreactor. With threaded=False,
+    # messages are delivered in the publisher's thread in the order they were published, never nested, for replays that
+    # give the same result every time.
+    def __init__(self, threaded=True):
+        self.threaded = threaded
+        self.clients = []
+        self.queue = deque() # threaded=False: (callback, topic, payload) waiting for delivery
+        self.delivering = False
+
+    def client(self):
+        client = LocalClient(self)
+        self.clients.append(client)
+        return client
+
+    def publish(self, topic, payload):
+        for client in self.clients:
+            for pattern, callback in client.subscriptions:
+                if topic_matches(pattern, topic):
+                    if self.threaded:
+                        client.inbox.append((callback, topic, payload))
+                        client.wake.set()
+                    else:
+                        self.queue.append((callback, topic, payload))
+        if self.threaded or self.delivering:
+            return
+        self.delivering = True
+        try:
+            while self.queue:
+                callback, topic, payload = self.queue.popleft()
+                callback(topic, payload)
+        finally:
+            self.delivering = False
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+class LocalClient:
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscriptions = []
+        self.inbox = deque()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None
+        if broker.threaded:
+            self.thread = threading.Thread(target=self.deliver, daemon=True)
+            self.thread.start()
+
+    def subscribe(self, pattern, callback):
+        self.subscriptions.append((pattern, callback))
+
+    def publish(self, topic, payload):
+        self.broker.publish(topic, payload)
+
+    def deliver(self):
+        while not self.closed:
+            self.wake.wait()
+            self.wake.clear()
+            while self.inbox:
+                callback, topic, payload = self.inbox.popleft()
+                callback(topic, payload)
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class SimulatedUnit:
+    # One Pioreactor of a simulated fleet, around a real plugin instance: its monitor job (a run message starts the automation)
+    # and the MQTT side of the automation (set messages call the plugin's setters, state changes are published).
+    def __init__(self, unit, broker, plugin, bank, index):
+        self.unit = unit
+        self.plugin = plugin
+        self.bank = bank
+        self.index = index
+        self.client = broker.client()
+        self.automation = None
+        self.published = {}
+        self.applied = 0 # set messages handled
+        self.applied_at = None # perf_counter() after the last one
+        for target in (unit, BROADCAST):
+            self.client.subscribe(f"pioreactor/{target}/+/run/dosing_control", self.on_run)
+            self.client.subscribe(f"pioreactor/{target}/+/{JOB}/+/set", self.on_set)
+
+    def on_run(self, topic, payload):
+        options = json.loads(payload)["options"]
+        options.pop("automation_name")
+        self.automation = self.plugin.TurbidostatIncreaseStress(unit=self.unit, experiment=topic.split("/")[2], bank=self.bank, index=self.index, **options)
+        self.publish_state()
+
+    def on_set(self, topic, payload):
+        if self.automation is not None:
+            try:
+                getattr(self.automation, f"set_{topic.split('/')[-2]}")(payload.decode() if isinstance(payload, bytes) else payload)
+            except ValueError:
+                pass # rejected, the plugin logged why
+            self.publish_state()
+        self.applied_at = perf_counter()
+        self.applied += 1
+
+    def tick(self, od):
+        self.automation.latest_od = {"2": od}
+        self.automation.execute()
+        self.publish_state()
+
+    def publish_state(self):
+        for attr in STATE:
+            value = getattr(self.automation, attr)
+            if self.published.get(attr) != value:
+                self.published[attr] = value
+                self.client.publish(f"pioreactor/{self.unit}/{self.automation.experiment}/{JOB}/{attr}", json.dumps(value))
+
+    def close(self):
+        if self.automation is not None:
+            self.automation.on_disconnected()
+
+
+def simulated_fleet(n_units, threaded, lockstep=False, broadcast=True, seed=0, stress_spread=0.3, clock=None, **settings):
+    # A fleet of n_units simulated Pioreactors on one in-process broker, the coordinator connected and the automation launched.
+    # The cultures tolerate alt_media differently (ic50 spread by stress_spread), so their ramps drift apart without lockstep.
+    from TurbidostatIncreaseStress_simulator import CultureModel, ReactorBank, load_plugin
+
+    plugin, _ = load_plugin(clock)
+    bank = ReactorBank(n_units, CultureModel(), seed=seed)
+    bank.ic50 *= np.random.default_rng(seed).lognormal(0.0, stress_spread, n_units)
+    broker = LocalBroker(threaded=threaded)
+    units = [SimulatedUnit(f"unit{i:03d}", broker, plugin, bank, i) for i in range(n_units)]
+    client = broker.client()
+    coordinator = FleetCoordinator("fleet", None if broadcast else [unit.unit for unit in units], client.publish, lockstep=lockstep, fleet_size=n_units)
+    for topic in coordinator.subscriptions():
+        client.subscribe(topic, coordinator.on_message)
+    coordinator.launch(**settings, lockstep=int(lockstep))
+    wait_for(lambda: all(unit.automation is not None for unit in units))
+    return broker, bank, units, coordinator
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("the simulated fleet did not answer in time")
+        time.sleep(0.001)
+
+
+def measure_fanout(n_units=50, repeats=20):
+    '''
+    Latency from the coordinator publishing a change of two settings to each unit having applied it, on a threaded in-process
+    broker (one delivery thread per unit), for: one broadcast message, one message per unit, and one message per unit and setting
+    (setting them one by one, as from the UI). Returns {mode: {"messages", "median_ms", "p99_ms", "last_unit_ms"}}.
+    '''
+    settings = dict(target_od=2.0, volume=1.0, dilutions=10, initial_alt_media=0.25, alt_media_ratio_increase=0.05)
+    results = {}
+    for mode in ("broadcast", "per_unit", "per_unit_per_setting"):
+        broker, _, units, coordinator = simulated_fleet(n_units, threaded=True, broadcast=mode == "broadcast", **settings)
+        latencies, last = [], []
+        messages = 0
+        for i in range(repeats):
+            changes = {"volume": 1.0 + 0.01 * (i + 1), "dilutions": 10 + i % 2}
+            expected = [unit.applied + (len(changes) if mode == "per_unit_per_setting" else 1) for unit in units]
+            started = perf_counter()
+            if mode == "per_unit_per_setting":
+                for key, value in changes.items():
+                    coordinator.set(**{key: value})
+            else:
+                coordinator.set(**changes)
+            wait_for(lambda: all(unit.applied >= n for unit, n in zip(units, expected)))
+            delays = [(unit.applied_at - started) * 1000 for unit in units]
+            latencies += delays
+            last.append(max(delays))
+            messages = len(changes) * n_units if mode == "per_unit_per_setting" else (1 if mode == "broadcast" else n_units)
+        broker.close()
+        for unit in units:
+            unit.close()
+        results[mode] = {"messages": messages, "median_ms": float(np.median(latencies)), "p99_ms": float(np.percentile(latencies, 99)),
+                         "last_unit_ms": float(np.median(last))}
+    return results
+
+
+def replay_ramp(n_units=50, days=3.0, lockstep=False, duration=5.0, seed=0, **settings):
+    '''
+    Replay days of the stress ramp on a simulated fleet (virtual clock, messages delivered in order) and return how far apart
+    the units' steps got: {"max_step_spread", "final_step_min", "final_step_max", "advanced_to"}.
+    '''
+    from TurbidostatIncreaseStress_simulator import VirtualClock
+
+    settings = {**dict(target_od=2.0, volume=1.0, dilutions=10, initial_alt_media=0.05, alt_media_ratio_increase=0.05), **settings}
+    clock = VirtualClock()
+    broker, bank, units, coordinator = simulated_fleet(n_units, threaded=False, lockstep=lockstep, seed=seed, clock=clock, **settings)
+    spread = 0
+    for _ in range(int(days * 24 * 60 / duration)):
+        clock.advance(duration * 60)
+        bank.grow(duration / 60)
+        for unit, od in zip(units, bank.measure().tolist()):
+            unit.tick(od)
+        steps = [unit.automation.ratio_step for unit in units]
+        spread = max(spread, max(steps) - min(steps))
+    for unit in units:
+        unit.close()
+    return {"max_step_spread": spread, "final_step_min": min(steps), "final_step_max": max(steps), "advanced_to": coordinator.advanced_to}
+
+
+if __name__ == "__main__":
+    fields = read_fields()
+    parser = build_parser(fields)
+    parser.description = 'Run the Turbidostat Increase Stress automation on a fleet of Pioreactors'
+    parser.add_argument('--units', nargs='+', default=None, help='Units of the fleet (default: every unit of the cluster)')
+    parser.add_argument('--fleet_size', type=int, default=None, help='Without --units: number of units in the cluster, that lockstep waits for')
+    parser.add_argument('--simulate', type=int, default=0, help='Measure on this many simulated units and an in-process broker instead')
+    parser.add_argument('--days', type=float, default=3.0, help='--simulate: days of ramp replayed')
+    args = parser.parse_args()
+    if not args.simulate and not args.experiment:
+        parser.error("--experiment is required: the units only receive the messages of their experiment's topics")
+    if args.fleet_size is not None and args.units is not None:
+        parser.error("--fleet_size is the number of units without --units")
+
+    if args.simulate:
+        for mode, result in measure_fanout(args.simulate).items():
+            print(f"fan-out {mode:>21}: {result['messages']:5d} messages   median {result['median_ms']:.2f} ms   p99 {result['p99_ms']:.2f} ms   last unit {result['last_unit_ms']:.2f} ms")
+        for lockstep in (False, True):
+            result = replay_ramp(args.simulate, days=args.days, lockstep=lockstep)
+            print(f"{'lockstep' if lockstep else 'independent':>11} ramps over {args.days:g} days: steps {result['final_step_min']} - {result['final_step_max']} at the end, "
+                  f"largest spread {result['max_step_spread']} steps"
+                  f"{'' if result['advanced_to'] is None else ', last moved together to step %d' % result['advanced_to']}")
+        sys.exit(0)
+
+    try:
+        resolved = resolve_settings(fields, args)
+    except ValueError as e:
+        print(f"Invalid settings: {e}")
+        sys.exit(1)
+    settings = {key: value for key, (value, _) in resolved.items()}
+    problems = validate(fields, settings)
+    if problems:
+        for problem in problems:
+            print(f"Invalid setting: {problem}")
+        sys.exit(1)
+
+    from pioreactor.pubsub import create_client # only on the leader, with a broker
+
+    if settings["lockstep"] and args.units is None and not args.fleet_size:
+        parser.error("--lockstep 1 without --units needs --fleet_size: a unit that hasn't reported yet would be left behind")
+    client = create_client(client_id="turbidostat_increase_stress_fleet")
+    coordinator = FleetCoordinator(args.experiment, args.units, lambda topic, payload: client.publish(topic, payload, qos=1), lockstep=bool(settings["lockstep"]), fleet_size=args.fleet_size)
+    client.on_message = lambda _client, _userdata, message: coordinator.on_message(message.topic, message.payload)
+    for topic in coordinator.subscriptions():
+        client.subscribe(topic, qos=1)
+    try:
+        coordinator.launch(**settings, duration=args.duration)
+        while True:
+            time.sleep(60)
+            print(json.dumps(coordinator.status()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for message in coordinator.stop(): # the automation must not keep running on the units without its coordinator
+            message.wait_for_publish(timeout=10)
+        client.disconnect()
@@ -0,0 +1,213 @@
+
+'''
+Run many Turbidostat Increase Stress automations in one process, on one asyncio event loop.
+
+A separate DosingController per reactor means one interpreter, one copy of every import and one broker connection per reactor.
+For simulated and bench reactors, this host runs N TurbidostatIncreaseStress instances cooperatively instead: they share
+the imports, the pump calibration cache and one in-process message connection (the broker stand-in of the simulator).
+Each instance keeps its own execute() schedule, and every execute() and OD reading runs on the event loop thread, with no
+thread per reactor. The stand-in pumps don't block: a reactor's dosing lock is held for the time its pumps would run
+(one pump at a time), so its ticks and OD readings during a dilution are skipped as on a Pioreactor, while the other
+reactors keep ticking.
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_host.py --reactors 100 --duration 1 --time_scale 60 --minutes 1
+
+--time_scale 60 runs the reactors 60 times faster than real time (so duration 1 minute is a tick every second).
+At the end it prints the memory used (after the imports, and per hosted instance) and the execute() deadlines missed:
+an execute() starting more than 5% of its period late. Much faster time scales shrink that margin below the scheduling
+jitter of the machine itself.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+from TurbidostatIncreaseStress_simulator import CultureModel, ReactorBank, load_plugin
+
+
+def rss_mb():
+    # Resident memory of this process right now (peak memory on systems without /proc).
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class ScaledClock:
+    # Real time sped up by time_scale, in seconds since the host started. The hosted automations read it as time() and monotonic().
+    def __init__(self, time_scale=1.0):
+        self.time_scale = time_scale
+        self.started = time.monotonic()
+
+    @property
+    def now(self):
+        return (time.monotonic() - self.started) * self.time_scale
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+class InlineExecutor:
+    # Stands in for the automation's decisions thread: runs an event_driven decision right away, on the loop thread.
+    def submit(self, fn, *args):
+        fn(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class HostedReactor:
+    # The host's bookkeeping for one automation. __slots__ keeps it to a few fixed fields per reactor.
+    __slots__ = ("automation", "topic", "period", "next_deadline", "executes", "missed", "max_lateness", "pumping")
+
+    def __init__(self, automation, topic, period, first_deadline):
+        self.automation = automation
+        self.topic = topic
+        self.period = period # seconds of loop time between two execute()
+        self.next_deadline = first_deadline
+        self.executes = 0
+        self.missed = 0
+        self.max_lateness = 0.0
+        self.pumping = None # the loop's handle that releases the dosing lock when the deferred pump time is over
+
+
+class ReactorHost:
+    def __init__(self, n_reactors, target_od=2.0, volume=5.0, dilutions=10, initial_alt_media=0.25, alt_media_ratio_increase=0.05,
+                 duration=1.0, od_interval=5.0, time_scale=1.0, model=None, seed=None, deadline_slack=0.05, **automation_kwargs):
+        self.clock = ScaledClock(time_scale)
+        self.plugin, self.standins = load_plugin(self.clock) # one import of the plugin and of the pioreactor stand-ins, for every reactor
+        self.standins.pump_timing.time_scale = 1.0 / time_scale # stand-in pumps take ml / (mL/s) seconds of scaled time
+        self.standins.pump_timing.deferred = {} # and report that time instead of sleeping, see hold_while_pumping
+        self.bank = ReactorBank(n_reactors, model or CultureModel(), seed=seed)
+        self.time_scale = time_scale
+        self.od_period = od_interval / time_scale
+        self.deadline_slack = deadline_slack # an execute() starting later than this fraction of its period missed its deadline
+        self.memory = {"after_imports_mb": rss_mb()}
+
+        period = duration * 60.0 / time_scale
+        self.reactors = []
+        for i in range(n_reactors):
+            automation = self.plugin.TurbidostatIncreaseStress(
+                target_od=target_od, volume=volume, dilutions=dilutions, initial_alt_media=initial_alt_media,
+                alt_media_ratio_increase=alt_media_ratio_increase, unit=f"host{i:04d}", experiment="host", duration=duration,
+                bank=self.bank, index=i, **automation_kwargs,
+            )
+            automation.decisions = InlineExecutor() # no thread per reactor: see hold_while_pumping
+            topic = f"pioreactor/{automation.unit}/{automation.experiment}/od_reading/ods"
+            # first ticks spread over one period, so the reactors don't all execute at the same instant
+            self.reactors.append(HostedReactor(automation, topic, period, period * (1 + i / n_reactors)))
+        self.memory["after_instances_mb"] = rss_mb()
+
+    async def run_reactor(self, reactor, stop_at):
+        loop = asyncio.get_running_loop()
+        reactor.next_deadline += loop.time()
+        while reactor.next_deadline < stop_at:
+            await asyncio.sleep(max(reactor.next_deadline - loop.time(), 0.0))
+            lateness = loop.time() - reactor.next_deadline
+            reactor.max_lateness = max(reactor.max_lateness, lateness)
+            reactor.missed += lateness > self.deadline_slack * reactor.period
+            reactor.automation.execute()
+            self.hold_while_pumping(reactor)
+            reactor.executes += 1
+            reactor.next_deadline += reactor.period
+            while reactor.next_deadline < loop.time(): # the execute() overran a whole period: those ticks are missed
+                reactor.next_deadline += reactor.period
+                reactor.missed += 1
+
+    def hold_while_pumping(self, reactor):
+        # The pumps of a dilution returned at once and left their run time in pump_timing.deferred: hold the reactor's dosing lock
+        # that long, like execute_io_action does on a Pioreactor, without blocking the loop.
+        seconds = self.standins.pump_timing.deferred.pop(reactor.automation.unit, 0.0)
+        if seconds > 0 and reactor.automation.dosing_lock.acquire(blocking=False):
+            reactor.pumping = asyncio.get_running_loop().call_later(seconds, self.stop_pumping, reactor)
+
+    def stop_pumping(self, reactor):
+        reactor.pumping = None
+        reactor.automation.dosing_lock.release()
+
+    async def read_ods(self, stop_at):
+        # The OD readings of every reactor, through the one shared message connection: sets latest_od like the
+        # DosingAutomationJob subscription does, and publishes the reading for event_driven automations.
+        loop = asyncio.get_running_loop()
+        last = self.clock.now
+        while loop.time() < stop_at:
+            now = self.clock.now
+            self.bank.grow((now - last) / 3600.0)
+            last = now
+            ods = self.bank.measure()
+            for reactor, od in zip(self.reactors, ods.tolist()):
+                reactor.automation.latest_od = {"2": od}
+                if reactor.topic in self.standins.subscriptions:
+                    payload = json.dumps({"ods": {"2": {"od": od, "channel": "2", "angle": "90"}}})
+                    self.standins.publish(reactor.topic, payload)
+                    self.hold_while_pumping(reactor)
+            await asyncio.sleep(self.od_period)
+
+    async def run(self, seconds):
+        loop = asyncio.get_running_loop()
+        stop_at = loop.time() + seconds
+        await asyncio.gather(self.read_ods(stop_at), *(self.run_reactor(reactor, stop_at) for reactor in self.reactors))
+
+    def close(self):
+        for reactor in self.reactors:
+            if reactor.pumping is not None: # the run ended before the pumps did: on_disconnected waits for the dosing lock
+                reactor.pumping.cancel()
+                self.stop_pumping(reactor)
+            reactor.automation.on_disconnected()
+
+    def report(self):
+        n = len(self.reactors)
+        return {
+            "reactors": n,
+            "after_imports_mb": self.memory["after_imports_mb"],
+            "after_instances_mb": self.memory["after_instances_mb"],
+            "per_instance_kb": (self.memory["after_instances_mb"] - self.memory["after_imports_mb"]) * 1024 / n,
+            "one_process_each_mb": self.memory["after_imports_mb"] * n, # at least: every process pays for its own interpreter and imports
+            "executes": sum(r.executes for r in self.reactors),
+            "missed_deadlines": sum(r.missed for r in self.reactors),
+            "max_lateness_ms": max(r.max_lateness for r in self.reactors) * 1000,
+            "threads": threading.active_count(),
+            "waste_ml": float(self.bank.dispensed_ml["waste"].sum()),
+            "simulated_hours": self.clock.now / 3600,
+            "mean_od": float(np.mean(self.bank.od)),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run many Turbidostat Increase Stress automations in one asyncio process')
+    parser.add_argument('--reactors', type=int, default=100, help='Number of hosted automations')
+    parser.add_argument('--target_od', type=float, default=2.0, help='Target optical density')
+    parser.add_argument('--volume', type=float, default=5.0, help='Volume for dilution')
+    parser.add_argument('--dilutions', type=int, default=10, help='Number of dilutions')
+    parser.add_argument('--initial_alt_media', type=float, default=0.25, help='Initial alternate media ratio')
+    parser.add_argument('--alt_media_ratio_increase', type=float, default=0.05, help='Media ratio increase after each cycle')
+    parser.add_argument('--duration', type=float, default=1.0, help='How often execute runs, in minutes')
+    parser.add_argument('--od_interval', type=float, default=5.0, help='Seconds between two OD readings')
+    parser.add_argument('--time_scale', type=float, default=1.0, help='Run this many times faster than real time')
+    parser.add_argument('--minutes', type=float, default=1.0, help='How long the host runs, in real minutes')
+    parser.add_argument('--initial_od', type=float, default=0.05, help='OD of the simulated cultures at the start')
+    parser.add_argument('--event_driven', type=int, default=0, help='1 to dilute on every OD reading instead of on execute()')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    host = ReactorHost(args.reactors, args.target_od, args.volume, args.dilutions, args.initial_alt_media, args.alt_media_ratio_increase,
+                       duration=args.duration, od_interval=args.od_interval, time_scale=args.time_scale, model=CultureModel(initial_od=args.initial_od), seed=args.seed,
+                       event_driven=args.event_driven)
+    try:
+        asyncio.run(host.run(args.minutes * 60.0))
+    finally:
+        host.close()
+    for key, value in host.report().items():
+        print(f"{key:>20}: {value:.2f}" if isinstance(value, float) else f"{key:>20}: {value}")
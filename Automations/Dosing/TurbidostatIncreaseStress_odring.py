@@ -0,0 +1,177 @@
+'''
+Shared-memory ring of OD readings, a prototype of a local fast path from od_reading to the dosing automation on the same Pi
+(no JSON, no broker hop).
+
+The Turbidostat Increase Stress automation reads it with od_ring=1, and falls back to the broker while there is no ring.
+od_reading is part of the pioreactor package and needs a small hook to write the ring:
+
+    from TurbidostatIncreaseStress_odring import ODRing, od_ring_path
+    ring = ODRing(od_ring_path(unit, experiment), channels)
+    ring.publish({"2": 0.93}, time.time())  # for each reading
+
+and a reader opens ODRing(od_ring_path(unit, experiment)), waits on ring.wait(timeout) and reads ring.latest_values().
+
+Compare it with the broker path, across processes and with a local broker stand-in, by running on the command line
+
+python3 TurbidostatIncreaseStress_simulator.py --od_feed
+'''
+
+import mmap
+import os
+import select
+import struct
+import zlib
+
+
+OD_RING_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else os.path.join(os.path.expanduser("~"), ".pioreactor", "storage") # /dev/shm is in RAM, so the ring never touches the SD card
+
+
+class ODRing:
+    # Shared-memory ring of the latest OD readings of one unit, for od_reading and a reader on the same Pi: the reader
+    # reads the readings straight from the mapping, with no JSON and no broker hop. One writer, any number of readers,
+    # no locks. Every slot is a seqlock: the writer makes the slot's sequence number odd, writes the readings, then makes it even again,
+    # and a reader retries when the number was odd or changed while it read. The slot's CRC also catches a torn read on CPUs
+    # that reorder the stores (the Pi's ARM cores do).
+    # A reader that must react to every reading waits on a doorbell, a FIFO next to the ring the writer writes one byte to
+    # after each reading, instead of polling the ring. The readings themselves never go through the FIFO.
+    MAGIC = b"TISODRG1"
+    HEADER = struct.Struct("<8sII32sQ") # magic, number of channels, capacity, channel names (comma separated), readings written
+    NAMES_SIZE = 32
+    MAX_RETRIES = 100
+
+    __slots__ = ("path", "channels", "capacity", "slot", "checked", "mm", "writer", "bell")
+
+    def __init__(self, path, channels=None, capacity=64):
+        # With channels, open the ring as its writer (creating a new one): raises ValueError if the channel names don't fit in the header.
+        # Without, open an existing ring to read it: raises OSError if there is none, ValueError if the file is not an OD ring.
+        # A new ring is made under a temporary name and renamed over the old one, so a reader still mapping the old file
+        # never sees it truncated (that would crash it with SIGBUS). The reader notices the old ring went stale and reopens the path.
+        self.path = path
+        self.writer = channels is not None
+        self.bell = None # file descriptor of the doorbell, opened on first use
+        if self.writer:
+            self.channels = [str(channel) for channel in channels]
+            self.capacity = int(capacity)
+            names = ",".join(self.channels).encode()
+            if not self.channels or any(not channel or "," in channel for channel in self.channels):
+                raise ValueError(f"OD ring channel names must be non-empty and without commas, got {self.channels}")
+            if len(names) > self.NAMES_SIZE:
+                raise ValueError(f"OD ring channel names take {len(names)} bytes, at most {self.NAMES_SIZE} fit in the header: {self.channels}")
+        else:
+            with open(path, "rb") as f:
+                header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size or self.HEADER.unpack(header)[0] != self.MAGIC:
+                raise ValueError(f"{path} is not an OD ring")
+            _, n_channels, self.capacity, names, _ = self.HEADER.unpack(header)
+            self.channels = names.rstrip(b"\0").decode().split(",")[:n_channels]
+        self.slot = struct.Struct(f"<Qd{len(self.channels)}dI4x") # sequence number, timestamp, one OD per channel, CRC of the timestamp and ODs
+        self.checked = struct.Struct(f"<{len(self.channels) + 1}d") # the part of a slot its CRC covers
+        size = self.HEADER.size + self.capacity * self.slot.size
+
+        opened = f"{path}.{os.getpid()}.tmp" if self.writer else path
+        fd = os.open(opened, os.O_RDWR | os.O_CREAT | os.O_TRUNC if self.writer else os.O_RDONLY)
+        try:
+            if self.writer:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE if self.writer else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if self.writer:
+            self.HEADER.pack_into(self.mm, 0, self.MAGIC, len(self.channels), self.capacity, ",".join(self.channels).encode(), 0)
+            os.replace(opened, path)
+            if not os.path.exists(path + ".bell"):
+                os.mkfifo(path + ".bell")
+
+    @property
+    def written(self):
+        return struct.unpack_from("<Q", self.mm, self.HEADER.size - 8)[0]
+
+    def publish(self, ods, timestamp):
+        # Writer side: ods is {channel: od}, in the channels given when the ring was created.
+        n = self.written
+        offset = self.HEADER.size + (n % self.capacity) * self.slot.size
+        values = [float(ods[channel]) for channel in self.channels]
+        crc = zlib.crc32(self.checked.pack(timestamp, *values))
+        struct.pack_into("<Q", self.mm, offset, 2 * n + 1) # odd: being written
+        self.slot.pack_into(self.mm, offset, 2 * n + 1, timestamp, *values, crc)
+        struct.pack_into("<Q", self.mm, offset, 2 * n + 2) # even: complete
+        struct.pack_into("<Q", self.mm, self.HEADER.size - 8, n + 1)
+        self.ring_bell()
+
+    def ring_bell(self):
+        # Wake up the readers waiting in wait(). Without a reader (ENXIO), or with readers that haven't emptied the FIFO yet (EAGAIN),
+        # there is nobody to wake.
+        try:
+            if self.bell is None:
+                self.bell = os.open(self.path + ".bell", os.O_WRONLY | os.O_NONBLOCK)
+            os.write(self.bell, b"\0")
+        except BlockingIOError:
+            pass
+        except OSError:
+            if self.bell is not None:
+                os.close(self.bell) # EPIPE: the reader went away, open the doorbell again next time
+            self.bell = None
+
+    def wait(self, timeout):
+        # Reader side: block until the writer rings the doorbell, at most timeout seconds. Returns False on a timeout.
+        if self.bell is None:
+            try:
+                self.bell = os.open(self.path + ".bell", os.O_RDWR | os.O_NONBLOCK) # read-write, so the FIFO never reports end of file
+            except OSError:
+                select.select([], [], [], timeout) # no doorbell (yet): wait like a poll
+                return False
+        if not select.select([self.bell], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self.bell, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def read(self, n):
+        # Reader side: (timestamp, {channel: od}) of reading number n (0 = the first one written), or None if it was overwritten.
+        reading = self.read_values(n)
+        return None if reading is None else (reading[0], dict(zip(self.channels, reading[1])))
+
+    def read_values(self, n):
+        # Like read, with the ODs as a tuple in the order of self.channels: unpacked straight from the mapping, no dict is built.
+        offset = self.HEADER.size + (n % self.capacity) * self.slot.size
+        for _ in range(self.MAX_RETRIES):
+            slot = self.slot.unpack_from(self.mm, offset)
+            seq = slot[0]
+            if seq % 2:
+                continue # the writer is in this slot right now
+            if struct.unpack_from("<Q", self.mm, offset)[0] != seq or zlib.crc32(self.checked.pack(*slot[1:-1])) != slot[-1]:
+                continue # it moved on while we read
+            if seq != 2 * n + 2:
+                return None
+            return slot[1], slot[2:-1]
+        return None
+
+    def latest(self):
+        n = self.written
+        return self.read(n - 1) if n else None
+
+    def latest_values(self):
+        n = self.written
+        return self.read_values(n - 1) if n else None
+
+    def recent(self, count):
+        # The last `count` readings still in the ring, oldest first.
+        n = self.written
+        readings = (self.read(i) for i in range(max(n - min(count, self.capacity), 0), n))
+        return [reading for reading in readings if reading is not None]
+
+    def close(self):
+        if self.bell is not None:
+            os.close(self.bell)
+            self.bell = None
+        if not self.mm.closed:
+            self.mm.close()
+
+
+def od_ring_path(unit, experiment):
+    # Where od_reading publishes the OD ring of a unit, for ODRing(path, channels) on the writer side and ODRing(path) on the reader side.
+    return os.path.join(OD_RING_DIR, f"pioreactor_od_{unit}_{experiment}.ring")
+
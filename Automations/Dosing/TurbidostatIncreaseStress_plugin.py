@@ -1,9 +1,24 @@
 
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from math import ceil, floor, log, log2
+from time import monotonic, perf_counter, time
+
 from pioreactor.automations.dosing.base import DosingAutomationJobContrib
 from pioreactor.utils import local_persistant_storage
 from pioreactor.exc import CalibrationError
-from pioreactor.background_jobs.dosing_control import DosingController
 from pioreactor.utils import is_pio_job_running
+from pioreactor.utils import SummableDict
+from pioreactor.config import config
+
+from TurbidostatIncreaseStress_settings import LOG_2, StressSchedule, check_setting, make_od_filter, od_channels_of, resolve_od_channel # next to this file in the plugins folder
 
 
 __plugin_summary__ = "Dosing automation for maintaining target OD with increasing alternate media ratio"
@@ -13,6 +28,534 @@ __plugin_author__ = "Aina Sendra Ortiz"
 #__plugin_homepage__ = "https://docs.pioreactor.com"
 
 
+PUMP_CHUNK_ML = 0.625 # pioreactor's execute_io_action splits larger volumes into halves until each pump run is at most this
+CHECKPOINT_DIR = os.path.join(os.path.expanduser("~"), ".pioreactor", "storage") # same folder as local_persistant_storage
+OD_RING_STALE_AFTER = 30.0 # seconds: an older reading in the OD ring means od_reading stopped writing it, use the broker again
+
+
+# The settings that can be changed while the job runs, see TurbidostatIncreaseStress.reconfigure. The order numbers the
+# settings in the decision log (1 = target_od, ...), so only append to it.
+RECONFIGURABLE_SETTINGS = (
+    "target_od", "volume", "dilutions", "initial_alt_media", "alt_media_ratio_increase", "event_driven", "min_dilution_interval",
+    "debounce_readings", "od_filter", "od_filter_window", "od_channel", "stress_schedule", "stress_step_every", "adaptive_volume",
+    "concurrent_dosing", "culture_volume", "max_volume", "media_reservoir_ml", "alt_media_reservoir_ml", "waste_reservoir_ml",
+    "reservoir_warning_hours", "lockstep", "ratio_step",
+)
+SETTINGS_SCHEMA_PATHS = ( # TurbidostatIncreaseStress.yaml, next to this file in the repository, or where the plugin installer puts it
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "TurbidostatIncreaseStress.yaml"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "ui", "contrib", "automations", "dosing", "turbidostat_increase_stress.yaml"),
+)
+
+
+settings_schema = None # loaded by the first instance, then shared by all of them
+
+
+def load_settings_schema(paths=SETTINGS_SCHEMA_PATHS):
+    # The fields of TurbidostatIncreaseStress.yaml, {key: field}, with the valid values of each setting (min / max / options).
+    # Empty if the file or PyYAML is missing: then only the checks of the plugin itself apply (schedule, filter, vial volumes).
+    # Parsed once per process, parsing it takes longer than creating the job.
+    global settings_schema
+    if settings_schema is None:
+        settings_schema = read_settings_schema(paths)
+    return settings_schema
+
+
+def read_settings_schema(paths):
+    for path in paths:
+        if os.path.exists(path):
+            try:
+                import yaml # only needed here, once per process
+            except ImportError:
+                return {}
+            with open(path) as f:
+                return {field["key"]: field for field in yaml.safe_load(f)["fields"]}
+    return {}
+
+
+def as_bool(value):
+    # Settings coming from the UI or from MQTT are strings, and bool("0") is True, so parse them explicitly.
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "1.0", "true", "yes", "on")
+    return bool(value)
+
+
+def parse_timestamp(value):
+    # od_reading stamps its messages with an ISO 8601 UTC time like "2024-05-01T12:00:00.123456Z". Returns unix time.
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class GrowthRateEstimator:
+    # Online growth rate from the OD readings: a Kalman filter on log(OD) with a constant growth rate model,
+    # state = (log OD, growth rate per hour). One update is a few float operations (the 2x2 matrices are written out),
+    # with no history kept and no query to the database. The cumulative number of generations integrates the positive
+    # growth rate over time, which is a better measure of evolutionary time than the number of dilutions.
+    __slots__ = ("measurement_variance", "level_variance", "rate_variance", "log_od", "growth_rate", "p00", "p01", "p11", "last_at", "generations")
+
+    def __init__(self, measurement_variance=1e-4, level_variance=1e-6, rate_variance=1e-3):
+        self.measurement_variance = measurement_variance # of log(OD): 1e-4 is about 1% OD noise
+        self.level_variance = level_variance # per hour
+        self.rate_variance = rate_variance # per hour, how fast the growth rate itself can change
+        self.log_od = None
+        self.growth_rate = 0.0
+        self.p00, self.p01, self.p11 = measurement_variance, 0.0, 1.0
+        self.last_at = None
+        self.generations = 0.0
+
+    def dilution(self):
+        # A dilution makes log(OD) jump down but doesn't change the growth rate: restart the level from the next reading.
+        self.log_od = None
+
+    def update(self, od, at):
+        # od: one OD reading, at: when it was taken, in seconds (monotonic). Returns the growth rate, per hour.
+        if od <= 0.0:
+            return self.growth_rate
+        dt = 0.0 if self.last_at is None else (at - self.last_at) / 3600
+        if dt < 0.0:
+            return self.growth_rate
+        self.last_at = at
+        if self.growth_rate > 0.0:
+            self.generations += self.growth_rate * dt / LOG_2
+
+        z = log(od)
+        if self.log_od is None or dt == 0.0:
+            self.log_od = z
+            self.p00 = self.measurement_variance
+            return self.growth_rate
+
+        # predict
+        self.log_od += self.growth_rate * dt
+        p00 = self.p00 + dt * (2 * self.p01 + dt * self.p11) + self.level_variance * dt
+        p01 = self.p01 + dt * self.p11
+        p11 = self.p11 + self.rate_variance * dt
+        # correct with the new reading
+        s = p00 + self.measurement_variance
+        k0, k1 = p00 / s, p01 / s
+        innovation = z - self.log_od
+        self.log_od += k0 * innovation
+        self.growth_rate += k1 * innovation
+        self.p00, self.p01, self.p11 = (1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01
+        return self.growth_rate
+
+
+class RampCheckpoint:
+    # Append-only log of the stress ramp state (dilution_count, alt_media_ratio, ratio_step, generations, what is left in the bottles),
+    # so a restarted job can resume where it was.
+    # Every record has the same size and ends with a CRC, so the latest state is simply the last record of the file:
+    # restoring reads one record from the end, whatever the length of the log.
+    # To spare the SD card, record() only keeps the latest state in memory, and it is written + fsync'd once every
+    # `batch` records or `interval` seconds, or right away with force=True (used when alt_media_ratio changes).
+    # The file starts with a header holding the record size: a log written with another record layout (another version of the
+    # plugin) is not resumed from, and is moved aside to `.old` instead of being appended to.
+    MAGIC = b"TISCKPT1"
+    HEADER = struct.Struct("<8sI4x") # magic, record size with its CRC
+    RECORD = struct.Struct("<dqdqddddd") # timestamp, dilution_count, alt_media_ratio, ratio_step, generations, generations at the start of the step, media, alt_media and waste mL left (NaN if not tracked)
+    CRC = struct.Struct("<I")
+    SIZE = RECORD.size + CRC.size
+    MAX_RECORDS = 10000 # the log is compacted to its last record beyond this
+    __slots__ = ("path", "batch", "interval", "pending", "pending_count", "last_flush_at", "file")
+
+    @classmethod
+    def compatible(cls, f):
+        header = f.read(cls.HEADER.size)
+        return len(header) == cls.HEADER.size and cls.HEADER.unpack(header) == (cls.MAGIC, cls.SIZE)
+
+    def __init__(self, path, batch=5, interval=600.0):
+        self.path = path
+        self.batch = max(int(batch), 1)
+        self.interval = float(interval)
+        self.pending = None
+        self.pending_count = 0
+        self.last_flush_at = monotonic()
+        self.file = None
+
+    def latest(self):
+        # Returns (timestamp, dilution_count, alt_media_ratio, ratio_step, generations, step_started_generations, media_ml, alt_media_ml, waste_ml)
+        # of the last complete record, or None.
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            if not self.compatible(f):
+                return None
+            end = f.seek(0, os.SEEK_END)
+            end -= (end - self.HEADER.size) % self.SIZE # ignore a record torn by a power cut
+            while end > self.HEADER.size: # only steps back more than once if the last record is corrupt
+                f.seek(end - self.SIZE)
+                data = f.read(self.SIZE)
+                payload, (crc,) = data[:self.RECORD.size], self.CRC.unpack(data[self.RECORD.size:])
+                if zlib.crc32(payload) == crc:
+                    return self.RECORD.unpack(payload)
+                end -= self.SIZE
+        return None
+
+    def record(self, dilution_count, alt_media_ratio, ratio_step, generations, step_started_generations, reservoirs, force=False):
+        self.pending = (time(), dilution_count, alt_media_ratio, ratio_step, generations, step_started_generations, *reservoirs)
+        self.pending_count += 1
+        if force or self.pending_count >= self.batch or monotonic() - self.last_flush_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending is None:
+            return
+        payload = self.RECORD.pack(*self.pending)
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    compatible = self.compatible(f)
+                if not compatible:
+                    os.replace(self.path, self.path + ".old")
+            self.file = open(self.path, "ab")
+            if self.file.tell() == 0:
+                self.file.write(self.HEADER.pack(self.MAGIC, self.SIZE))
+            else:
+                self.file.truncate(self.file.tell() - (self.file.tell() - self.HEADER.size) % self.SIZE) # drop a torn record, so the next one is aligned
+        self.file.write(payload + self.CRC.pack(zlib.crc32(payload)))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = None
+        self.pending_count = 0
+        self.last_flush_at = monotonic()
+
+        if self.file.tell() >= self.HEADER.size + self.MAX_RECORDS * self.SIZE:
+            self.compact(payload)
+
+    def compact(self, payload):
+        # Replace the log by its last record: write a new file, fsync it, then rename it over the old one (atomic).
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.SIZE) + payload + self.CRC.pack(zlib.crc32(payload)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ReservoirInventory:
+    # What is left in the media and alt_media bottles, and the room left in the waste bottle, updated with every dosing action
+    # (a subtraction per bottle), and when each of them runs out: walking the stress schedule still to come at the exchange rate
+    # observed, since the alt_media bottle empties faster and faster as the ratio goes up. A capacity of 0 means that bottle is not tracked.
+    # The levels are arrays in the order of BOTTLES, so an instance that tracks nothing costs a few hundred bytes. What is left in a
+    # bottle that is not tracked is NaN, which is also how the checkpoint stores it.
+    BOTTLES = ("media", "alt_media", "waste")
+    __slots__ = ("capacity", "remaining", "tracked", "warned", "exchange_rate", "last_exchange_at", "smoothing")
+
+    def __init__(self, media_ml=0.0, alt_media_ml=0.0, waste_ml=0.0, smoothing=0.1):
+        self.capacity = array("d", (media_ml, alt_media_ml, waste_ml))
+        self.remaining = array("d", (capacity if capacity > 0 else float("nan") for capacity in self.capacity))
+        self.tracked = tuple(bottle for bottle, capacity in zip(self.BOTTLES, self.capacity) if capacity > 0)
+        self.warned = () # bottles already warned about, until they are refilled
+        self.exchange_rate = None # mL exchanged per hour, an EWMA over the dilutions (None before the second one)
+        self.last_exchange_at = None
+        self.smoothing = smoothing
+
+    def left(self, bottle):
+        return self.remaining[self.BOTTLES.index(bottle)]
+
+    def refill(self, bottle, capacity):
+        # A full bottle of `capacity` mL is in place (an empty one for waste).
+        i = self.BOTTLES.index(bottle)
+        self.capacity[i] = float(capacity)
+        self.remaining[i] = self.capacity[i] if self.capacity[i] > 0 else float("nan")
+        self.tracked = tuple(bottle for bottle, capacity in zip(self.BOTTLES, self.capacity) if capacity > 0)
+        self.warned = tuple(warned for warned in self.warned if warned != bottle)
+
+    def restore(self, levels):
+        # mL left in each bottle, as saved in the checkpoint. NaN (not tracked then) keeps the bottle full.
+        for i, ml in enumerate(levels):
+            if ml == ml and self.capacity[i] > 0:
+                self.remaining[i] = min(ml, self.capacity[i])
+
+    def shortfall(self, media_ml, alt_media_ml, waste_ml):
+        # The first bottle that can't supply (or take) this dosing action, or None.
+        if not self.tracked:
+            return None
+        for bottle, capacity, remaining, ml in zip(self.BOTTLES, self.capacity, self.remaining, (media_ml, alt_media_ml, waste_ml)):
+            if capacity > 0 and ml > remaining:
+                return bottle
+        return None
+
+    def draw(self, media_ml, alt_media_ml, waste_ml, at):
+        # at: monotonic time of the dosing action, in seconds
+        self.remaining[0] -= media_ml
+        self.remaining[1] -= alt_media_ml
+        self.remaining[2] -= waste_ml
+        if self.last_exchange_at is not None and at > self.last_exchange_at:
+            rate = waste_ml * 3600 / (at - self.last_exchange_at)
+            self.exchange_rate = rate if self.exchange_rate is None else self.exchange_rate + self.smoothing * (rate - self.exchange_rate)
+        self.last_exchange_at = at
+
+    def hours_left(self, schedule, ratio_step, step_left_ml, step_ml, exchange_rate=None):
+        # {bottle: hours} until each tracked bottle runs out, inf if it never does (e.g. alt_media while the ratio is 0), None if the
+        # exchange rate is not known yet. step_left_ml: mL still to exchange in the current step, step_ml: in each next step.
+        # Stops at the step where the last bottle runs out, so it goes through at most the steps of the schedule.
+        exchange_rate = exchange_rate or self.exchange_rate
+        if not exchange_rate:
+            return None
+        left = {bottle: self.left(bottle) for bottle in self.tracked}
+        hours = {bottle: float("inf") for bottle in left}
+        exchanged, step, chunk = 0.0, ratio_step, step_left_ml
+        while left:
+            ratio = schedule.ratio(step)
+            last = step >= len(schedule.ratios) - 1 or step_ml == float("inf")
+            if last:
+                chunk = float("inf")
+            for bottle, fraction in (("media", 1.0 - ratio), ("alt_media", ratio), ("waste", 1.0)):
+                if bottle not in left or fraction <= 0.0:
+                    continue
+                if chunk * fraction >= left[bottle]:
+                    hours[bottle] = (exchanged + max(left.pop(bottle), 0.0) / fraction) / exchange_rate
+                else:
+                    left[bottle] -= chunk * fraction
+            if last:
+                break
+            exchanged += chunk
+            step, chunk = step + 1, step_ml
+        return hours
+
+
+class DecisionLog:
+    # Binary audit trail of every dosing decision, one fixed-size record per execute() / OD reading, in a ring file of `capacity` records,
+    # so the disk usage is bounded (the oldest records are overwritten). The file is memory-mapped: appending a record is a
+    # struct.pack_into in memory, and the OS writes the dirty pages back in the background instead of one write per record.
+    # Read it with TurbidostatIncreaseStress_decisionlog.read_decision_log, which returns NumPy structured arrays without copying.
+    MAGIC = b"TISDLOG1"
+    HEADER = struct.Struct("<8sIIQ8x") # magic, record size, capacity, records written since the file was created
+    RECORD = struct.Struct("<QdffffffiiBBH") # seq, timestamp, od, media_ml, alt_media_ml, waste_ml, alt_media_ratio, target_od, dilution_count, ratio_step, fired, kind, setting
+    # Kinds of record, see TurbidostatIncreaseStress_decisionlog.KINDS. A settings record has the number of the changed setting
+    # (its place in RECONFIGURABLE_SETTINGS, from 1) and its new value in the od column, one record per setting. The value of a
+    # string setting is its index in the string table, a `.strings` file next to the log with one JSON string per line.
+    DECISION = 0
+    SETTINGS = 1
+    REJECTED_SETTINGS = 2
+    __slots__ = ("path", "capacity", "mm", "written", "strings")
+
+    def __init__(self, path, capacity=2**19):
+        self.path = path
+        self.capacity = int(capacity)
+        size = self.HEADER.size + self.capacity * self.RECORD.size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            header = os.read(fd, self.HEADER.size)
+            compatible = len(header) == self.HEADER.size and self.HEADER.unpack(header)[:3] == (self.MAGIC, self.RECORD.size, self.capacity)
+            if not compatible:
+                os.ftruncate(fd, 0) # a new log, or one written with another layout or capacity: start over
+            os.ftruncate(fd, size) # sparse file, the disk blocks are only used as records are written
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.strings = {} # string -> its index in the string table
+        if compatible:
+            self.written = self.HEADER.unpack_from(self.mm)[3]
+            if os.path.exists(path + ".strings"):
+                with open(path + ".strings") as f:
+                    self.strings = {json.loads(line): i for i, line in enumerate(f)}
+        else:
+            self.written = 0
+            self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.RECORD.size, self.capacity, 0)
+            open(path + ".strings", "w").close()
+
+    def append(self, timestamp, od, fired, media_ml, alt_media_ml, waste_ml, dilution_count, alt_media_ratio, target_od, ratio_step, kind=DECISION, setting=0):
+        slot = self.written % self.capacity
+        self.RECORD.pack_into(self.mm, self.HEADER.size + slot * self.RECORD.size,
+                              self.written, timestamp, od, media_ml, alt_media_ml, waste_ml, alt_media_ratio, target_od, dilution_count, ratio_step, fired, kind, setting)
+        self.written += 1
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.RECORD.size, self.capacity, self.written) # after the record, so a reader never sees a half-written one as valid
+
+    def string_index(self, value):
+        # Index of value in the string table, appended to it the first time. Only settings changes use it, so they are few.
+        if value not in self.strings:
+            with open(self.path + ".strings", "a") as f:
+                f.write(json.dumps(value) + "\n")
+            self.strings[value] = len(self.strings)
+        return self.strings[value]
+
+    def close(self):
+        if not self.mm.closed:
+            self.mm.flush()
+            self.mm.close()
+
+
+class VolumeInterlock:
+    # Volume model of the vial while several pumps run at the same time. An addition counts from the moment it starts, and a removal
+    # only once it has finished, so the modelled volume is always the worst case. An addition waits until it fits under max_volume.
+    def __init__(self, culture_volume, max_volume, timeout=600.0):
+        if max_volume <= culture_volume:
+            raise ValueError(f"max_volume ({max_volume} mL) must be larger than culture_volume ({culture_volume} mL).")
+        self.culture_volume = culture_volume
+        self.max_volume = max_volume
+        self.timeout = timeout
+        self.volume = culture_volume
+        self.peak_volume = culture_volume
+        self.aborted = False
+        self.changed = threading.Condition()
+
+    def start_addition(self, ml):
+        with self.changed:
+            fits = self.changed.wait_for(lambda: self.aborted or self.volume + ml <= self.max_volume + 1e-9, timeout=self.timeout)
+            if self.aborted or not fits:
+                raise RuntimeError(f"Stopped adding media: {ml:.2f} mL more would overfill the vial ({self.volume:.2f} of {self.max_volume:.2f} mL).")
+            self.volume += ml
+            self.peak_volume = max(self.peak_volume, self.volume)
+
+    def finish_removal(self, ml):
+        with self.changed:
+            self.volume = max(self.volume - ml, self.culture_volume) # the waste pump can't go below the level of the waste tube
+            self.changed.notify_all()
+
+    def abort(self):
+        # A removal failed: the volume is unknown, so no addition may start any more.
+        with self.changed:
+            self.aborted = True
+            self.changed.notify_all()
+
+
+class LatencyHistogram:
+    # HDR-style histogram of durations: log-linear buckets of microseconds, 16 per power of two (a resolution of about 6%),
+    # from 1 µs to 2**40 µs (12 days). Recording is an index computation and one increment, with a fixed amount of memory.
+    SUB_BUCKETS = 16
+    BUCKETS = 16 * 38
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * self.BUCKETS))
+        self.count = 0
+        self.total = 0.0 # seconds
+        self.max = 0.0
+
+    @classmethod
+    def index(cls, us):
+        if us < 2 * cls.SUB_BUCKETS:
+            return us
+        shift = us.bit_length() - 5
+        return cls.SUB_BUCKETS * (shift + 1) + (us >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def upper_bound(cls, index):
+        # Highest duration (seconds) counted in a bucket.
+        if index < 2 * cls.SUB_BUCKETS:
+            return (index + 1) / 1e6
+        shift = index // cls.SUB_BUCKETS - 1
+        return ((index % cls.SUB_BUCKETS + cls.SUB_BUCKETS + 1) << shift) / 1e6
+
+    def record(self, seconds):
+        self.counts[self.index(min(int(seconds * 1e6), 2**40 - 1))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        if not self.count:
+            return float("nan")
+        rank = q / 100 * self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        # Number of durations <= each bound (seconds), for the fixed buckets of a Prometheus histogram.
+        counts, seen, index = [], 0, 0
+        for bound in bounds:
+            while index < self.BUCKETS and self.upper_bound(index) <= bound:
+                seen += self.counts[index]
+                index += 1
+            counts.append(seen)
+        return counts
+
+
+class Metrics:
+    # Timers and counters of the automation's hot path, only with metrics=1: the timed methods are wrapped on the instance when the
+    # job starts, so with metrics off the code runs exactly as without this class. Every `interval` seconds (checked when a timed
+    # method returns) the metrics are written as a Prometheus text file, for node_exporter's textfile collector, and published.
+    PROMETHEUS_BOUNDS = (1e-5, 1e-4, 1e-3, 0.01, 0.1, 1.0, 10.0, 60.0, 600.0) # seconds
+    __slots__ = ("histograms", "dispensed_ml", "dosing_actions", "started_at", "exported_at", "path", "interval", "labels", "state", "publish")
+
+    def __init__(self, path, labels, interval, state, publish):
+        self.histograms = {}
+        self.dispensed_ml = {"media": 0.0, "alt_media": 0.0, "waste": 0.0}
+        self.dosing_actions = 0
+        self.started_at = self.exported_at = monotonic()
+        self.path = path
+        self.interval = float(interval)
+        self.labels = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        self.state = state # returns the automation's own counters and gauges, like skipped_ticks
+        self.publish = publish # called with the summary, to publish it as a setting
+
+    def timed(self, name, method):
+        histogram = self.histograms[name] = LatencyHistogram()
+
+        def timed_method(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.record(perf_counter() - started)
+                if monotonic() - self.exported_at >= self.interval:
+                    self.export()
+        return timed_method
+
+    def count_dosing(self, media_ml, alt_media_ml, waste_ml):
+        self.dosing_actions += 1
+        self.dispensed_ml["media"] += media_ml
+        self.dispensed_ml["alt_media"] += alt_media_ml
+        self.dispensed_ml["waste"] += waste_ml
+
+    def summary(self):
+        hours = (monotonic() - self.started_at) / 3600
+        summary = {
+            name: {"count": h.count, "p50_ms": h.percentile(50) * 1000, "p99_ms": h.percentile(99) * 1000, "max_ms": h.max * 1000}
+            for name, h in self.histograms.items() if h.count
+        }
+        summary["dilutions_per_hour"] = self.dosing_actions / hours if hours > 0 else 0.0
+        summary["dispensed_ml"] = dict(self.dispensed_ml)
+        summary.update(self.state())
+        return summary
+
+    def prometheus(self):
+        prefix = "turbidostat_increase_stress"
+        lines = [f"# HELP {prefix}_duration_seconds Time spent in the automation's methods.", f"# TYPE {prefix}_duration_seconds histogram"]
+        for name, h in self.histograms.items():
+            labels = f'{self.labels},method="{name}"'
+            for bound, count in zip(self.PROMETHEUS_BOUNDS, h.cumulative(self.PROMETHEUS_BOUNDS)):
+                lines.append(f'{prefix}_duration_seconds_bucket{{{labels},le="{bound:g}"}} {count}')
+            lines.append(f'{prefix}_duration_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f"{prefix}_duration_seconds_sum{{{labels}}} {h.total:.9f}")
+            lines.append(f"{prefix}_duration_seconds_count{{{labels}}} {h.count}")
+        lines += [f"# TYPE {prefix}_dispensed_ml_total counter"]
+        lines += [f'{prefix}_dispensed_ml_total{{{self.labels},pump="{pump}"}} {ml:.4f}' for pump, ml in self.dispensed_ml.items()]
+        lines += [f"# TYPE {prefix}_dilutions_total counter", f"{prefix}_dilutions_total{{{self.labels}}} {self.dosing_actions}"]
+        for key, value in self.state().items():
+            kind = "counter" if key.endswith("_total") else "gauge"
+            lines += [f"# TYPE {prefix}_{key} {kind}", f"{prefix}_{key}{{{self.labels}}} {float(value):g}"]
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        self.exported_at = monotonic()
+        text = self.prometheus()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(self.path + ".tmp", self.path) # the collector never reads a half-written file
+        self.publish(self.summary())
+
+
+def discover_od_channels():
+    # The channels od_reading reads on this unit, from the pioreactor config. None if it doesn't say, see od_channels_of.
+    return od_channels_of(config)
+
 
 class TurbidostatIncreaseStress(DosingAutomationJobContrib):
     automation_name = "turbidostat_increase_stress"
@@ -22,9 +565,42 @@ class TurbidostatIncreaseStress(DosingAutomationJobContrib):
         "dilutions": {"datatype": "int", "settable": True},
         "initial_alt_media": {"datatype": "float", "settable": True},  # The initial proportion of alt_media, so for ex. 0.05 if we want 5% alt_media and 95% normal media
         "alt_media_ratio_increase": {"datatype":"float", "settable": True}, # If we want the alt_media to increase by 5% then we input here 0.05
+        "event_driven": {"datatype": "boolean", "settable": True}, # If True, every new OD reading can trigger a dilution, instead of waiting for the next execute()
+        "min_dilution_interval": {"datatype": "float", "settable": True, "unit": "s"}, # Minimum time between two dilutions
+        "debounce_readings": {"datatype": "int", "settable": True}, # Number of consecutive OD readings above target_od needed to trigger a dilution
+        "trigger_latency": {"datatype": "float", "settable": False, "unit": "ms"}, # Time from the OD reading arriving to the start of the pump action (event_driven only)
+        "od_filter": {"datatype": "string", "settable": True}, # none, median, ewma or kalman: filter applied to the OD readings before comparing them to target_od
+        "od_filter_window": {"datatype": "int", "settable": True}, # Number of readings the filter looks back on
+        "filtered_od": {"datatype": "float", "settable": False, "unit": "od600"}, # The OD value actually compared to target_od
+        "od_channel": {"datatype": "string", "settable": True}, # auto, max, mean or a channel name like 2: which OD channel(s) are compared to target_od
+        "od_channels": {"datatype": "string", "settable": False}, # The channels actually read, found in the od_reading configuration
+        "dilution_count": {"datatype": "int", "settable": False}, # Dilutions since the last alt_media_ratio increase
+        "alt_media_ratio": {"datatype": "float", "settable": False}, # Current proportion of alt_media in each dilution
+        "ratio_step": {"datatype": "int", "settable": True}, # Current step of the stress schedule. Setting it moves the ramp to that step (the fleet coordinator does, in lockstep)
+        "stress_schedule": {"datatype": "string", "settable": True}, # linear, exponential:<factor> or table:<r0>,<r1>,... see StressSchedule
+        "stress_step_every": {"datatype": "string", "settable": True}, # dilutions, hours:<h> or generations:<k>
+        "growth_rate": {"datatype": "float", "settable": False, "unit": "h⁻¹"}, # Estimated online from the OD readings
+        "generations": {"datatype": "float", "settable": False}, # Cumulative generations since the start of the ramp
+        "adaptive_volume": {"datatype": "boolean", "settable": True}, # If True, each dilution exchanges just enough to bring the OD back to target_od, at most `volume`
+        "metrics": {"datatype": "boolean", "settable": False}, # If True, time the hot path and count the dosing, see Metrics
+        "metrics_summary": {"datatype": "json", "settable": False}, # Latency percentiles per method, dilutions per hour, mL per pump, skipped ticks
+        "skipped_ticks": {"datatype": "int", "settable": False}, # Decisions that could not be made: no OD reading yet, or a dilution still running
+        "od_ring": {"datatype": "boolean", "settable": False}, # If True, read the OD from od_reading's shared-memory ring when there is one, else from the broker
+        "concurrent_dosing": {"datatype": "boolean", "settable": True}, # If True, media and alt_media are added at the same time and the waste removal overlaps the next additions
+        "culture_volume": {"datatype": "float", "settable": True, "unit": "mL"}, # Volume in the vial at the level of the waste tube
+        "max_volume": {"datatype": "float", "settable": True, "unit": "mL"}, # The vial must never hold more than this, also while pumps run at the same time
+        "media_reservoir_ml": {"datatype": "float", "settable": True, "unit": "mL"}, # Capacity of the media bottle, 0 = not tracked. Set it (again) when a full bottle is put in
+        "alt_media_reservoir_ml": {"datatype": "float", "settable": True, "unit": "mL"}, # Same for the alt_media bottle
+        "waste_reservoir_ml": {"datatype": "float", "settable": True, "unit": "mL"}, # Same for the waste bottle, set it when an empty one is put in
+        "reservoir_warning_hours": {"datatype": "float", "settable": True, "unit": "h"}, # Warn when a bottle is forecast to run out within this time
+        "reservoirs": {"datatype": "json", "settable": False}, # mL left and hours left in each tracked bottle
+        "reservoir_empty": {"datatype": "string", "settable": False}, # The bottle that paused the dosing because it can't supply the next dilution, "" when dosing
+        "lockstep": {"datatype": "boolean", "settable": True}, # If True, the ramp waits at the end of each step until ratio_step is set, see TurbidostatIncreaseStress_fleet.py
+        "step_ready": {"datatype": "boolean", "settable": False}, # lockstep: the current step is done, waiting to be moved to the next one
+        "settings": {"datatype": "json", "settable": True}, # All the settings above that can change while the job runs. Set it to change several of them at once, see reconfigure
     }
 
-    def __init__(self, target_od, volume, dilutions, initial_alt_media, alt_media_ratio_increase, **kwargs):
+    def __init__(self, target_od, volume, dilutions, initial_alt_media, alt_media_ratio_increase, event_driven=False, min_dilution_interval=0.0, debounce_readings=1, od_filter="none", od_filter_window=5, od_channel="auto", resume=False, checkpoint_batch=5, decision_log_capacity=2**19, concurrent_dosing=False, culture_volume=14.0, max_volume=18.0, stress_schedule="linear", stress_step_every="dilutions", adaptive_volume=False, od_ring=False, od_ring_poll=0.5, metrics=False, metrics_interval=60.0, media_reservoir_ml=0.0, alt_media_reservoir_ml=0.0, waste_reservoir_ml=0.0, reservoir_warning_hours=12.0, lockstep=False, **kwargs):
         super().__init__(**kwargs)
 
         self.target_od = float(target_od)
@@ -33,13 +609,119 @@ class TurbidostatIncreaseStress(DosingAutomationJobContrib):
         self.initial_alt_media= float(initial_alt_media)  
         self.alt_media_ratio_increase = float(alt_media_ratio_increase)
         self.dilution_count = 0 # this is an internal parameter, not input by user, so not an argument in the __init__ method
-        
-        self.alt_media_ratio = self.initial_alt_media  # Set the initial alt_media_ratio
 
+        self.stress_schedule = stress_schedule
+        self.stress_step_every = stress_step_every
+        self.schedule = StressSchedule(self.stress_schedule, self.stress_step_every, self.initial_alt_media, self.alt_media_ratio_increase)
+        self.ratio_step = 0
+        self.step_started_at = monotonic() # for stress_step_every = hours:<h>
+        self.growth = GrowthRateEstimator()
+        self.growth_rate = 0.0
+        self.generations = 0.0
+        self.step_started_generations = 0.0 # for stress_step_every = generations:<k>
+        self.alt_media_ratio = self.schedule.ratio(self.ratio_step)  # Set the initial alt_media_ratio
+        self.lockstep = as_bool(lockstep)
+        self.step_ready = False
+
+        self.event_driven = as_bool(event_driven)
+        self.min_dilution_interval = float(min_dilution_interval)
+        self.debounce_readings = max(int(debounce_readings), 1)
+        self.readings_above_target = 0 # consecutive OD readings above target_od, for the debouncing
+        self.last_dilution_at = None # monotonic time of the last dilution, for min_dilution_interval
+        self.trigger_latency = None
+        self.skipped_ticks = 0
+        self.skipped_lock = threading.Lock() # skipped_ticks is counted on the timer, MQTT, od_ring and decisions threads, see count_skipped
+        self.dosing_lock = threading.Lock() # execute() (timer thread) and the event_driven decisions must not dilute at the same time
+        self.decisions = None # event_driven: single-thread executor the OD readings are handed to, created on the first reading
+        self.dilution_ended_at = None # unix time the last dilution's pumps finished: OD readings taken before then are dropped
+        self.disconnected = False # set by on_disconnected: from then on, no decision is made or logged
+
+        self.concurrent_dosing = as_bool(concurrent_dosing)
+        self.culture_volume = float(culture_volume)
+        self.max_volume = float(max_volume)
+        VolumeInterlock(self.culture_volume, self.max_volume) # fail early if max_volume leaves no room for dosing
+        self.pump_executors = None # one single-thread executor per pump, created the first time concurrent dosing is used
+
+        # What is left in the bottles. The dosing pauses, without counting a dilution, when one can't supply the next one.
+        self.media_reservoir_ml = float(media_reservoir_ml)
+        self.alt_media_reservoir_ml = float(alt_media_reservoir_ml)
+        self.waste_reservoir_ml = float(waste_reservoir_ml)
+        self.reservoir_warning_hours = float(reservoir_warning_hours)
+        self.inventory = ReservoirInventory(self.media_reservoir_ml, self.alt_media_reservoir_ml, self.waste_reservoir_ml)
+        self.reservoirs = None
+        self.reservoir_empty = ""
+
+        self.adaptive_volume = as_bool(adaptive_volume)
+        self.exchanged_ml = 0.0 # mL exchanged towards the next dilution_count, see count_dilution
+
+        self.od_filter = od_filter
+        self.od_filter_window = int(od_filter_window)
+        make_od_filter(self.od_filter, self.od_filter_window) # fail early on an unknown filter name
+        self.filters = {} # one filter per OD channel, created on the first reading of that channel
+        self.filtered_od = None
+
+        self.od_channel, self.channel_policy, self.channels = self.resolve_od_channel(od_channel)
+        self.od_channels = ",".join(self.channels) if self.channels is not None else "all"
+
+        # Optional fast path for the OD readings, see TurbidostatIncreaseStress_odring. The broker stays the fallback, and the ring
+        # is opened on first use since od_reading may start after this job.
+        self.od_ring = as_bool(od_ring)
+        self.od_ring_poll = float(od_ring_poll) # event_driven only: look at the ring at least this often, also if the doorbell is silent
+        self.ring = None
+        self.ring_seen = 0 # readings of the ring already handed to a decision, event_driven only
+        self.ring_latest_at = None # timestamp of the latest reading read from the ring
+        self.ring_stop = threading.Event()
+        self.ring_poller = None
+
+        # Settings changed while the job runs are validated as a whole, then swapped in between two decisions, see reconfigure.
+        self.settings_schema = load_settings_schema()
+        self.validate_settings({}) # the settings given at start against the same schema, raises ValueError
+        self.settings_lock = threading.Lock()
+        self.pending_settings = {}
+        self.settings = {key: getattr(self, key) for key in RECONFIGURABLE_SETTINGS}
+        self.subscribed_to_od = False
+
+        # The ramp state is saved in a checkpoint log, and with resume=True a restarted job (power cut, plugin update) continues the ramp
+        # instead of going back to dilution_count = 0 and initial_alt_media.
+        self.checkpoint = RampCheckpoint(os.path.join(CHECKPOINT_DIR, f"turbidostat_increase_stress_{self.unit}_{self.experiment}.ckpt"), batch=checkpoint_batch)
+        if as_bool(resume):
+            saved = self.checkpoint.latest()
+            if saved is not None:
+                saved_at, self.dilution_count, _, self.ratio_step, self.generations, self.step_started_generations, *levels = saved
+                self.inventory.restore(levels)
+                self.growth.generations = self.generations
+                self.alt_media_ratio = self.schedule.ratio(self.ratio_step) # a step of hours:<h> restarts its clock on resume
+                self.logger.info(f"Resumed the stress ramp saved at {saved_at:.0f}: step {self.ratio_step}, dilution_count={self.dilution_count}, alt_media_ratio={self.alt_media_ratio:.3f}")
+            elif os.path.exists(self.checkpoint.path):
+                self.logger.warning(f"{self.checkpoint.path} has no ramp state this version of the plugin can read: the stress ramp starts over.")
+
+        self.decision_log = DecisionLog(os.path.join(CHECKPOINT_DIR, f"turbidostat_increase_stress_{self.unit}_{self.experiment}.dlog"), capacity=decision_log_capacity)
+
+
+        self.metrics = as_bool(metrics)
+        self.metrics_summary = None
+        self.meter = None
+        if self.metrics:
+            self.enable_metrics(metrics_interval)
 
         # Calibration checks
         self.check_calibration(["media", "waste", "alt_media"])  # This is a call to the check_calibration method, and if you add that list it performs the calibration check for each of those pumps.
 
+        if self.event_driven:
+            self.start_event_driven()
+
+    def start_event_driven(self):
+        # Each new OD reading triggers the decision, so an OD crossing target_od just after a tick doesn't wait a whole `duration`.
+        # Subscribed once: when event_driven is switched off again, on_od_reading and poll_od_ring ignore the readings.
+        # The decision runs on the decisions thread, not in the MQTT callback, so a dilution never holds up the client's network loop.
+        if self.subscribed_to_od:
+            return
+        self.subscribed_to_od = True
+        self.subscribe_and_callback(self.on_od_reading, f"pioreactor/{self.unit}/{self.experiment}/od_reading/ods", allow_retained=False)
+        if self.od_ring:
+            self.ring_poller = threading.Thread(target=self.poll_od_ring, name="od_ring", daemon=True)
+            self.ring_poller.start()
+
     def check_calibration(self, pumps):     # It checks each pump listed in the provided array against the calibration cache.
                                             # It contains the logic for checking the calibration status. 
                                             # This method takes a list of pumps as its argument, iterates over this list, and checks if each pump is present in the calibration cache. 
@@ -50,23 +732,501 @@ class TurbidostatIncreaseStress(DosingAutomationJobContrib):
                     raise CalibrationError(f"{pump} pump calibration must be performed first.")
 
 
+    def enable_metrics(self, interval):
+        # Wrap the hot path methods of this instance with timers. The class methods stay untouched, so with metrics off nothing is timed.
+        self.meter = Metrics(
+            os.path.join(CHECKPOINT_DIR, f"turbidostat_increase_stress_{self.unit}_{self.experiment}.prom"), {"unit": self.unit, "experiment": self.experiment},
+            interval, state=lambda: {"skipped_ticks_total": self.skipped_ticks, "alt_media_ratio": self.alt_media_ratio, "dilution_count": self.dilution_count},
+            publish=lambda summary: setattr(self, "metrics_summary", summary),
+        )
+        # decide_on_reading is the event_driven decision (with its dilution), on the decisions thread: on_od_reading only hands the reading over.
+        for name in ("execute", "on_od_reading", "decide_on_reading", "check_calibration", "update_media_ratio"):
+            setattr(self, name, self.meter.timed(name, getattr(self, name)))
+
+        execute_io_action = self.execute_io_action
+        def counted_execute_io_action(alt_media_ml=0.0, media_ml=0.0, waste_ml=0.0):
+            self.meter.count_dosing(media_ml, alt_media_ml, waste_ml)
+            return execute_io_action(alt_media_ml=alt_media_ml, media_ml=media_ml, waste_ml=waste_ml)
+        self.execute_io_action = self.meter.timed("execute_io_action", counted_execute_io_action)
+
+    def save_ramp_state(self, force=False):
+        self.checkpoint.record(self.dilution_count, self.alt_media_ratio, self.ratio_step, self.generations, self.step_started_generations, self.inventory.remaining, force=force)
+
+    def on_disconnected(self):
+        # The base job first (it stops the execute() timer). MQTT callbacks can still arrive until the job's clients are
+        # disconnected, so the flag is set under dosing_lock: a running decision finishes with its pump action, and none starts after.
+        super_on_disconnected = getattr(super(), "on_disconnected", None)
+        if super_on_disconnected is not None:
+            super_on_disconnected()
+        with self.dosing_lock:
+            self.disconnected = True
+        self.ring_stop.set()
+        if self.ring_poller is not None:
+            self.ring_poller.join()
+        if self.ring is not None:
+            self.ring.close()
+        if self.decisions is not None:
+            self.decisions.shutdown(wait=True) # the readings still queued are dropped by decide_on_reading
+        if self.pump_executors is not None:
+            for executor in self.pump_executors.values():
+                executor.shutdown(wait=True)
+        if self.meter is not None:
+            self.meter.export()
+        self.checkpoint.flush() # don't lose the dilutions since the last batched write
+        self.checkpoint.close()
+        self.decision_log.close()
+
+    def exchange_volume(self, od):
+        # adaptive_volume: the mL to exchange now, 0 for no dilution yet. Adding v mL to culture_volume and removing v mL multiplies
+        # the OD by culture_volume / (culture_volume + v), so culture_volume * (od / target_od - 1) mL bring it back to target_od.
+        # Every pump run costs the same, and pioreactor halves a volume until each run is at most PUMP_CHUNK_ML: a dose of
+        # 2**k full chunks is the fewest pump runs per mL (2.6 mL would take 8 runs of 0.325 mL). The dose is the largest such one
+        # the OD needs, at most `volume` and the free room in the vial (max_volume - culture_volume). The OD is left to rise until
+        # it needs at least half of the largest dose that fits: a smaller one would pump as often, per mL, for no exchange worth it.
+        needed = self.culture_volume * (od / self.target_od - 1.0)
+        limit = min(self.volume, self.max_volume - self.culture_volume)
+        dose = min(PUMP_CHUNK_ML * 2 ** max(floor(log2(limit / PUMP_CHUNK_ML)), 0), limit)
+        if needed < max(dose / 2, min(PUMP_CHUNK_ML, limit)):
+            return 0.0
+        while dose / 2 >= needed and dose / 2 >= PUMP_CHUNK_ML:
+            dose /= 2
+        return dose
+
+    def count_dilution(self, volume):
+        # A step of the stress ramp is `dilutions` dilutions of `volume` mL: the ramp advances by the mL exchanged, not by the number
+        # of doses. A fixed-volume dilution counts one, and the smaller doses of adaptive_volume count their share of `volume`.
+        # The remainder (less than one dilution) is not checkpointed.
+        self.exchanged_ml += volume
+        while self.exchanged_ml >= self.volume:
+            self.exchanged_ml -= self.volume
+            self.dilution_count += 1
+
+    def resolve_od_channel(self, value):
+        # (od_channel, channel policy, channels read) for the channels configured on this unit, see resolve_od_channel in TurbidostatIncreaseStress_settings.
+        return resolve_od_channel(value, discover_od_channels())
+
+    def parse_setting(self, key, value):
+        # A new value for a setting, as the datatype it is published with. Raises ValueError.
+        if key not in RECONFIGURABLE_SETTINGS:
+            raise ValueError(f"{key} can't be changed while the job runs. Settable: {', '.join(RECONFIGURABLE_SETTINGS)}")
+        datatype = self.published_settings[key]["datatype"]
+        if datatype == "boolean":
+            return as_bool(value)
+        if datatype == "int":
+            number = float(value)
+            if number != int(number):
+                raise ValueError(f"{key}: {value!r} is not an integer")
+            return int(number)
+        if datatype == "float":
+            return float(value)
+        return str(value)
+
+    def validate_settings(self, changes):
+        # The whole parameter set once changes are applied, checked against the YAML schema, then the settings that only make sense
+        # together (compiled schedule, filter, vial volumes, OD channel). Returns (settings, compiled schedule, resolved OD channel),
+        # or raises ValueError with every problem found. Changes nothing.
+        settings = {key: getattr(self, key) for key in RECONFIGURABLE_SETTINGS}
+        problems = []
+        for key, value in changes.items():
+            try:
+                settings[key] = self.parse_setting(key, value)
+            except ValueError as e:
+                problems.append(str(e))
+        for key, value in settings.items():
+            problem = check_setting(self.settings_schema[key], value) if key in self.settings_schema else None
+            if problem is not None:
+                problems.append(f"{key} = {value!r} {problem}")
+        if settings["ratio_step"] < 0:
+            problems.append(f"ratio_step = {settings['ratio_step']} must be 0 or more")
+        if problems:
+            raise ValueError("; ".join(problems))
+        schedule = StressSchedule(settings["stress_schedule"], settings["stress_step_every"], settings["initial_alt_media"], settings["alt_media_ratio_increase"])
+        make_od_filter(settings["od_filter"], settings["od_filter_window"])
+        VolumeInterlock(settings["culture_volume"], settings["max_volume"])
+        return settings, schedule, self.resolve_od_channel(settings["od_channel"])
+
+    def set_settings(self, value):
+        # Several settings as one change, a JSON object like {"volume": 2.0, "dilutions": 20}: all of them are applied, or none.
+        changes = json.loads(value) if isinstance(value, (str, bytes)) else value
+        if not isinstance(changes, dict):
+            raise ValueError(f"settings must be a JSON object of setting: value, not {value!r}")
+        self.reconfigure(changes)
+
+    def reconfigure(self, changes):
+        # Change settings while the job runs, without restarting it (a restart pauses the dosing). The whole new parameter set is
+        # validated first, so a rejected change leaves everything as it was. It is then applied between two decisions: right away
+        # if no decision is running, else when the next one starts, so a decision never sees half of a change (e.g. the new volume
+        # with the old ratio). A change made while another one waits is merged into it. Every change, applied or rejected, is
+        # recorded in the decision log.
+        with self.settings_lock:
+            merged = {**self.pending_settings, **changes}
+            try:
+                self.validate_settings(merged)
+            except ValueError as e:
+                self.log_settings_change(changes, rejected=True)
+                self.logger.warning(f"Rejected the settings change {changes}: {e}")
+                raise
+            self.pending_settings = merged
+        if self.dosing_lock.acquire(blocking=False):
+            try:
+                self.apply_pending_settings()
+            finally:
+                self.dosing_lock.release()
+
+    def apply_pending_settings(self):
+        # Called with the dosing_lock held. What happens to the ramp state:
+        #  * the stress schedule settings (initial_alt_media, alt_media_ratio_increase, stress_schedule): the schedule is recompiled and the
+        #    current step takes its ratio from it right away. stress_step_every keeps the current step's start (time and generations).
+        #  * dilutions: dilution_count is kept, and if it already reached the new value the current step is done now (see finish_step).
+        #  * ratio_step: the ramp moves to that step, which starts now with dilution_count = 0.
+        #  * lockstep off: a step that was done and waiting for the fleet coordinator (step_ready) moves to the next step now.
+        #  * volume: from the next dilution. With adaptive_volume, the mL exchanged towards the next dilution_count are kept.
+        #  * target_od: the debouncing starts over. od_filter, od_filter_window, od_channel: the filters start over.
+        with self.settings_lock:
+            changes, self.pending_settings = self.pending_settings, {}
+        if not changes:
+            return
+        try:
+            settings, schedule, (od_channel, channel_policy, channels) = self.validate_settings(changes)
+        except ValueError as e: # checked when the change arrived, so only if another change made it invalid since
+            self.log_settings_change(changes, rejected=True)
+            self.logger.warning(f"Rejected the settings change {changes}: {e}")
+            return
+        changed = {key: value for key, value in settings.items() if value != getattr(self, key)}
+        for key, value in changed.items():
+            setattr(self, key, value)
+
+        if changed.keys() & {"initial_alt_media", "alt_media_ratio_increase", "stress_schedule", "stress_step_every"}:
+            self.schedule = schedule
+            self.alt_media_ratio = self.schedule.ratio(self.ratio_step)
+        if changed.keys() & {"od_filter", "od_filter_window", "od_channel"}:
+            self.od_channel, self.channel_policy, self.channels = od_channel, channel_policy, channels
+            self.od_channels = ",".join(channels) if channels is not None else "all"
+            self.filters = {}
+        if "target_od" in changed:
+            self.readings_above_target = 0
+        if "event_driven" in changed and self.event_driven:
+            self.start_event_driven()
+        for bottle in ReservoirInventory.BOTTLES:
+            key = f"{bottle}_reservoir_ml"
+            if key in changes: # also when set to the same capacity: that is a new bottle
+                self.inventory.refill(bottle, settings[key])
+                changed[key] = settings[key]
+        if "ratio_step" in changed:
+            self.start_step(self.ratio_step)
+            self.dilution_count = 0
+        if "lockstep" in changed and not self.lockstep and self.step_ready:
+            self.finish_step()
+        if self.schedule.by_dilutions and self.dilution_count >= self.dilutions and not self.step_ready:
+            self.finish_step()
+
+        self.settings = {key: getattr(self, key) for key in RECONFIGURABLE_SETTINGS}
+        self.save_ramp_state(force=True)
+        self.log_settings_change(changed)
+        if changed:
+            self.logger.info(f"Settings changed: {', '.join(f'{key}={value}' for key, value in changed.items())}")
+
+    def log_settings_change(self, changes, rejected=False):
+        kind = DecisionLog.REJECTED_SETTINGS if rejected else DecisionLog.SETTINGS
+        for key, value in changes.items():
+            setting = RECONFIGURABLE_SETTINGS.index(key) + 1 if key in RECONFIGURABLE_SETTINGS else 0
+            if self.published_settings.get(key, {}).get("datatype") == "string":
+                new_value = float(self.decision_log.string_index(str(value)))
+            else:
+                try:
+                    new_value = float(value)
+                except (TypeError, ValueError):
+                    new_value = float("nan") # a rejected value that isn't a number
+            self.decision_log.append(time(), new_value, False, 0.0, 0.0, 0.0, self.dilution_count, self.alt_media_ratio, self.target_od, self.ratio_step, kind=kind, setting=setting)
+
     def execute(self):
-        # Check if the latest OD reading is available
-        if not is_pio_job_running("od_reading") or self.latest_od is None:
-            self.logger.warning("OD Reading job is not ready. Latest OD data is not available.")
+        if self.event_driven:
+            return # dilutions are triggered by on_od_reading as soon as a new OD reading arrives
+
+        ods = self.read_od_ring() if self.od_ring else None
+        if ods is None:
+            # Check if the latest OD reading is available
+            if not is_pio_job_running("od_reading") or self.latest_od is None:
+                self.logger.warning("OD Reading job is not ready. Latest OD data is not available.")
+                with self.dosing_lock: # not while on_disconnected closes the decision log
+                    self.count_skipped()
+                    self.log_decision(float("nan"))
+                return
+            ods = self.latest_od
+
+        self.dilute_if_above_target(ods)
+
+    def read_od_ring(self, new_only=False):
+        # The latest OD readings from od_reading's shared-memory ring as (channel, od) pairs, or None to use the broker: there is
+        # no ring, od_reading stopped writing to it, or (new_only) no reading arrived since the last call.
+        if self.ring is None:
+            try:
+                from TurbidostatIncreaseStress_odring import ODRing, od_ring_path # next to this file in the plugins folder
+                self.ring = ODRing(od_ring_path(self.unit, self.experiment))
+            except (ImportError, OSError, ValueError):
+                return None
+        written = self.ring.written
+        if new_only and written == self.ring_seen:
+            return None
+        reading = self.ring.read_values(written - 1) if written else None
+        if reading is None or time() - reading[0] > OD_RING_STALE_AFTER:
+            self.ring.close()
+            self.ring = None # reopen the path next time, od_reading may have made a new ring
+            return None
+        if new_only:
+            self.ring_seen = written
+        self.ring_latest_at = reading[0]
+        return zip(self.ring.channels, reading[1])
+
+    def poll_od_ring(self):
+        # event_driven with od_ring: wait for the ring's doorbell (at most od_ring_poll seconds), and hand every new reading to the
+        # decisions thread, like on_od_reading does with the broker's.
+        while not self.ring_stop.is_set():
+            if self.ring is None:
+                self.ring_stop.wait(self.od_ring_poll)
+            else:
+                self.ring.wait(self.od_ring_poll)
+            noticed_at = perf_counter()
+            ods = self.read_od_ring(new_only=True)
+            if ods is not None and self.event_driven and not self.disconnected:
+                self.submit_decision(ods, self.ring_latest_at, noticed_at)
+
+    def on_od_reading(self, message):
+        received_at = perf_counter()
+        if not self.event_driven or self.disconnected:
+            return # event_driven was switched off while the job runs, see start_event_driven
+        if self.ring_latest_at is not None and time() - self.ring_latest_at <= OD_RING_STALE_AFTER:
+            return # the ring is alive: the same reading comes through it, without the broker
+        payload = json.loads(message.payload)
+        ods = {channel: reading["od"] for channel, reading in payload["ods"].items()}
+        taken_at = parse_timestamp(payload["timestamp"]) if "timestamp" in payload else time()
+        self.submit_decision(ods, taken_at, received_at)
+
+    def submit_decision(self, ods, taken_at, received_at):
+        if self.decisions is None:
+            self.decisions = ThreadPoolExecutor(max_workers=1, thread_name_prefix="od_decisions")
+        try:
+            self.decisions.submit(self.decide_on_reading, ods, taken_at, received_at)
+        except RuntimeError:
+            pass # on_disconnected shut the executor down since the caller checked
+
+    def decide_on_reading(self, ods, taken_at, received_at):
+        # On the decisions thread, one reading at a time. A reading taken before the last dilution finished, while the pumps
+        # were stirring up the vial or before the fresh media went in, doesn't describe the culture: it is dropped.
+        if self.disconnected:
             return
-        
-        if (self.latest_od['2'] > self.target_od):
-            self.dilution_count += 1
-            alt_media_ml = self.volume * self.alt_media_ratio # This calculates the volume of alternate media to add based on the current alt_media_ratio.
-            media_ml = self.volume - alt_media_ml              # This calculates the remaining volume to be filled with normal media.
-            self.execute_io_action(media_ml=media_ml, alt_media_ml=alt_media_ml, waste_ml=self.volume) #  This line triggers the action to add the calculated volumes of normal and alternate media and remove an equal amount as waste.
+        if self.dilution_ended_at is not None and taken_at < self.dilution_ended_at:
+            self.count_skipped()
+            return
+        self.dilute_if_above_target(ods, received_at)
+
+    def count_skipped(self):
+        # += is a read, an add and a write: two threads counting at the same time would lose one.
+        with self.skipped_lock:
+            self.skipped_ticks += 1
+
+    def combine_channels(self, ods):
+        # Filter every channel read by this unit, then reduce them to the one OD compared to target_od, using the channel policy.
+        # ods is {channel: od} from the broker, or (channel, od) pairs read straight from the OD ring.
+        filtered = []
+        for channel, od in ods.items() if isinstance(ods, dict) else ods:
+            if self.channels is not None and channel not in self.channels:
+                continue
+            if channel not in self.filters:
+                self.filters[channel] = make_od_filter(self.od_filter, self.od_filter_window)
+            filtered.append(self.filters[channel].update(float(od)))
+        if not filtered:
+            return None
+        if self.channel_policy == "mean":
+            return sum(filtered) / len(filtered)
+        return max(filtered)
+
+    def log_decision(self, od, media_ml=0.0, alt_media_ml=0.0, waste_ml=0.0, step=None):
+        # step: (ratio_step, alt_media_ratio) the decision was made in, when the dilution finished that step and moved on
+        if self.disconnected:
+            return # the decision log is closed
+        ratio_step, alt_media_ratio = step or (self.ratio_step, self.alt_media_ratio)
+        self.decision_log.append(time(), od, waste_ml > 0, media_ml, alt_media_ml, waste_ml, self.dilution_count, alt_media_ratio, self.target_od, ratio_step)
+
+    def dilute_if_above_target(self, ods, triggered_at=None):
+        if not self.dosing_lock.acquire(blocking=False):
+            self.count_skipped()
+            return # a dilution is already running, and OD readings taken while pumping are not reliable anyway
+        if self.disconnected:
+            self.dosing_lock.release()
+            return
+        od = float("nan")
+        media_ml = alt_media_ml = waste_ml = 0.0
+        step = None
+        try:
+            self.apply_pending_settings() # a settings change that arrived during the previous decision
+            od = self.combine_channels(ods)
+            if od is None:
+                self.logger.warning(f"No OD reading for channel(s) {self.od_channels}.")
+                od = float("nan")
+                return
+            self.filtered_od = od
+            now = monotonic()
+            self.growth_rate = self.growth.update(od, now)
+            self.generations = self.growth.generations
+            if not self.step_ready and self.schedule.step_due((now - self.step_started_at) / 3600, self.generations - self.step_started_generations):
+                self.finish_step()
+            step = (self.ratio_step, self.alt_media_ratio)
+
+            if od <= self.target_od:
+                self.readings_above_target = 0
+                return
 
-            if self.dilution_count >= self.dilutions:
-                self.update_media_ratio() # If true, update_media_ratio method is called to update the ratio of alternate media
-                self.dilution_count = 0 # Reset the count for the next cycle        
-   
+            self.readings_above_target += 1
+            if self.readings_above_target < self.debounce_readings:
+                return # wait for more readings above target_od before diluting, so a single noisy reading doesn't trigger it
+
+            if self.last_dilution_at is not None and now - self.last_dilution_at < self.min_dilution_interval:
+                return
+
+            volume = self.exchange_volume(od) if self.adaptive_volume else self.volume
+            if volume <= 0:
+                return # adaptive_volume: not enough above target_od yet for a dose worth its pump runs
+            alt_media_ml = volume * self.alt_media_ratio # This calculates the volume of alternate media to add based on the current alt_media_ratio.
+            media_ml = volume - alt_media_ml              # This calculates the remaining volume to be filled with normal media.
+            waste_ml = volume
+            empty = self.inventory.shortfall(media_ml, alt_media_ml, waste_ml)
+            if empty is not None:
+                self.pause_for_refill(empty)
+                media_ml = alt_media_ml = waste_ml = 0.0
+                return
+            if self.reservoir_empty:
+                self.logger.info(f"The {self.reservoir_empty} bottle was refilled, dosing resumes.")
+                self.reservoir_empty = ""
+
+            self.readings_above_target = 0
+            self.last_dilution_at = now
+            for filter_ in self.filters.values():
+                filter_.reset() # the readings from before the dilution no longer describe the culture
+            self.growth.dilution()
+            self.count_dilution(volume)
+            if triggered_at is not None:
+                self.trigger_latency = (perf_counter() - triggered_at) * 1000
+            moved = self.execute_io_action(media_ml=media_ml, alt_media_ml=alt_media_ml, waste_ml=waste_ml) #  This line triggers the action to add the calculated volumes of normal and alternate media and remove an equal amount as waste.
+            self.dilution_ended_at = time()
+            if self.inventory.tracked: # what the pumps moved: less than asked when the job was asked to sleep or stop in the middle
+                self.inventory.draw(moved["media_ml"], moved["alt_media_ml"], moved["waste_ml"], now)
+
+            if self.schedule.by_dilutions and self.dilution_count >= self.dilutions and not self.step_ready:
+                self.finish_step() # If true, the ratio of alternate media moves to the next step, and the count starts again
+            else:
+                self.save_ramp_state()
+            if self.inventory.tracked:
+                self.forecast_reservoirs(now)
+        finally:
+            self.log_decision(od, media_ml, alt_media_ml, waste_ml, step)
+            self.dosing_lock.release()
+
+
+    def forecast_reservoirs(self, now):
+        # After each dilution: publish what is left in the bottles and for how long, and warn once per bottle (until it is refilled)
+        # when one runs out within reservoir_warning_hours. The current step is counted as partly done.
+        rate = self.inventory.exchange_rate or 0.0
+        step_ml = self.schedule.step_volume(self.dilutions, self.volume, rate, self.growth_rate)
+        if self.schedule.by_dilutions:
+            done = (self.dilution_count * self.volume + self.exchanged_ml) / step_ml
+        elif self.schedule.step_hours is not None:
+            done = (now - self.step_started_at) / 3600 / self.schedule.step_hours
+        else:
+            done = (self.generations - self.step_started_generations) / self.schedule.step_generations
+        step_left_ml = step_ml if step_ml == float("inf") else step_ml * max(1.0 - done, 0.0)
+        hours = self.inventory.hours_left(self.schedule, self.ratio_step, step_left_ml, step_ml)
+        self.reservoirs = {
+            bottle: {"remaining_ml": round(self.inventory.left(bottle), 1), "hours_left": None if hours is None or hours[bottle] == float("inf") else round(hours[bottle], 1)}
+            for bottle in self.inventory.tracked
+        }
+        for bottle, left in (hours or {}).items():
+            if left < self.reservoir_warning_hours and bottle not in self.inventory.warned:
+                self.inventory.warned += (bottle,)
+                self.logger.warning(f"The {bottle} bottle will {'be full' if bottle == 'waste' else 'run out'} in about {left:.1f} h "
+                                    f"({self.inventory.left(bottle):.0f} mL left). Dosing pauses when it can't supply a dilution.")
+
+    def pause_for_refill(self, bottle):
+        # The next dilution doesn't fit in what is left: no pump runs, so the culture never gets half a dilution or air,
+        # and dilution_count doesn't move. Dosing resumes at the first decision after the bottle is replaced (set its *_reservoir_ml).
+        if self.reservoir_empty != bottle:
+            self.reservoir_empty = bottle
+            self.logger.error(f"Dosing paused: the {bottle} bottle {'is full' if bottle == 'waste' else 'is empty'} "
+                              f"({self.inventory.left(bottle):.1f} mL left). Set {bottle}_reservoir_ml after replacing it.")
+            self.save_ramp_state(force=True)
+
+    def execute_io_action(self, alt_media_ml=0.0, media_ml=0.0, waste_ml=0.0):
+        if not self.concurrent_dosing:
+            return super().execute_io_action(alt_media_ml=alt_media_ml, media_ml=media_ml, waste_ml=waste_ml) # one pump at a time
+        return self.execute_io_action_concurrently(alt_media_ml=alt_media_ml, media_ml=media_ml, waste_ml=waste_ml)
+
+    def execute_io_action_concurrently(self, alt_media_ml=0.0, media_ml=0.0, waste_ml=0.0):
+        # media and alt_media are added at the same time, and the waste removal of one chunk overlaps the additions of the next one.
+        # A chunk is at most half of the free room in the vial (max_volume - culture_volume), so the next chunk can go in while the
+        # previous one is still being removed, and at most PUMP_CHUNK_ML per pump, like execute_io_action. The VolumeInterlock holds
+        # an addition back if it would not fit.
+        # Each pump runs through the base class's per-pump functions with the job's MQTT client and logger, and, like execute_io_action,
+        # no new chunk starts once the job is asked to sleep or disconnect (the chunk already in the vial is still removed).
+        if self.pump_executors is None:
+            self.pump_executors = {pump: ThreadPoolExecutor(max_workers=1, thread_name_prefix=pump) for pump in ("media", "alt_media", "waste")}
+        pump_functions = {"media": self.add_media_to_bioreactor, "alt_media": self.add_alt_media_to_bioreactor, "waste": self.remove_waste_from_bioreactor}
+        source_of_event = f"{self.job_name}:{self.automation_name}"
+        interlock = VolumeInterlock(self.culture_volume, self.max_volume)
+        n = max(ceil((media_ml + alt_media_ml) / ((self.max_volume - self.culture_volume) / 2)), ceil(max(media_ml, alt_media_ml, waste_ml) / PUMP_CHUNK_ML), 1)
+        moved = SummableDict(waste_ml=0.0, media_ml=0.0, alt_media_ml=0.0)
+
+        def run_pump(pump, ml):
+            return pump_functions[pump](ml=ml, source_of_event=source_of_event, mqtt_client=self.pub_client, logger=self.logger)
+
+        def remove(ml):
+            try:
+                removed = run_pump("waste", ml)
+            except Exception:
+                interlock.abort()
+                raise
+            interlock.finish_removal(ml)
+            return removed
+
+        removals = []
+        try:
+            for _ in range(n):
+                if self.state in (self.SLEEPING, self.DISCONNECTED):
+                    break
+                interlock.start_addition((media_ml + alt_media_ml) / n)
+                additions = {pump: self.pump_executors[pump].submit(run_pump, pump, ml / n) for pump, ml in (("media", media_ml), ("alt_media", alt_media_ml)) if ml > 0}
+                for pump, addition in additions.items():
+                    moved[f"{pump}_ml"] += addition.result() # the whole chunk must be in the vial before it is removed
+                if waste_ml > 0:
+                    removals.append(self.pump_executors["waste"].submit(remove, waste_ml / n))
+        finally:
+            for removal in removals:
+                moved["waste_ml"] += removal.result() # never leave the vial above culture_volume when returning
+        return moved
+
+    def finish_step(self):
+        # The current step of the stress ramp is done. In lockstep, stay on it (diluting at its ratio) until the fleet coordinator
+        # moves every reactor to the next step at once, by setting ratio_step. Else move to the next step now.
+        if self.lockstep:
+            self.step_ready = True
+            self.save_ramp_state()
+            return
+        self.update_media_ratio()
+        self.dilution_count = 0 # Reset the count for the next cycle
+        self.save_ramp_state(force=True)
 
     def update_media_ratio(self):
-        self.alt_media_ratio += self.alt_media_ratio_increase
-        self.alt_media_ratio = min(self.alt_media_ratio, 1.0)  # Ensure it doesn't exceed 100%
+        self.start_step(self.ratio_step + 1)
+
+    def start_step(self, step):
+        self.ratio_step = step
+        self.alt_media_ratio = self.schedule.ratio(self.ratio_step)  # Exact value from the compiled schedule, already capped at 100%
+        self.step_started_at = monotonic()
+        self.step_started_generations = self.generations
+        self.step_ready = False
+
+
+# One setter per setting that can change while the job runs (set_target_od, set_volume, ...): a change of one setting from the UI
+# or from MQTT goes through the same validation and swap between decisions as a change of several, see reconfigure.
+for key in RECONFIGURABLE_SETTINGS:
+    setattr(TurbidostatIncreaseStress, f"set_{key}", lambda self, value, key=key: self.reconfigure({key: value}))
+del key
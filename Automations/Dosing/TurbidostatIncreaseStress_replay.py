@@ -0,0 +1,71 @@
+
+'''
+Replay noisy OD traces through the Turbidostat Increase Stress automation, once per od_filter, and count the spurious dilutions.
+
+The noise of a recorded trace (the OD readings minus their rolling median) is replayed on top of the simulated culture,
+so each filter sees the same recorded spikes and the simulator knows the true OD behind every dilution.
+A dilution is spurious when the true OD was clearly below target_od (see SPURIOUS_MARGIN in the simulator).
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_replay.py --trace od_readings.csv --channel 2 --days 7
+
+The trace is a CSV export of od_readings (columns od_reading and channel). Without --trace, a synthetic trace with
+Gaussian noise and occasional spikes (bubbles) is used.
+'''
+
+import argparse
+import csv
+
+import numpy as np
+
+from TurbidostatIncreaseStress_simulator import CultureModel, simulate
+
+
+def load_noise_trace(path, column="od_reading", channel=None, smoothing_window=11):
+    with open(path, newline="") as f:
+        rows = csv.DictReader(f)
+        od = np.array([float(row[column]) for row in rows if channel is None or row.get("channel") == channel])
+    if len(od) < smoothing_window:
+        raise ValueError(f"{path} has only {len(od)} readings, need at least {smoothing_window}")
+
+    # The smooth part is the culture, the rest is measurement noise. Keep the noise relative to the OD level.
+    half = smoothing_window // 2
+    padded = np.pad(od, half, mode="edge")
+    smooth = np.median(np.lib.stride_tricks.sliding_window_view(padded, smoothing_window), axis=1)
+    return (od - smooth) / np.maximum(smooth, 1e-6)
+
+
+def replay(filters, window, noise_trace=None, n_reactors=8, days=7.0, seed=0, **settings):
+    model = CultureModel(od_noise=0.01, spike_probability=0.02, spike_height=0.5)
+    results = {}
+    for name in filters:
+        # noise_trace is relative; scale it with the target OD so it matches the OD level the culture is held at
+        trace = None if noise_trace is None else noise_trace * settings.get("target_od", 2.0)
+        results[name] = simulate(n_reactors=n_reactors, days=days, model=model, engine="plugin", seed=seed, noise_trace=trace,
+                                 od_filter=name, od_filter_window=window, **settings)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the OD filters of the Turbidostat Increase Stress automation on noisy traces')
+    parser.add_argument('--trace', default=None, help='CSV export of od_readings. Default: synthetic noise with spikes')
+    parser.add_argument('--column', default='od_reading', help='Column of the CSV with the OD readings')
+    parser.add_argument('--channel', default=None, help='Only use the readings of this channel')
+    parser.add_argument('--window', type=int, default=5, help='od_filter_window used for every filter')
+    parser.add_argument('--filters', default='none,median,ewma,kalman', help='Comma separated od_filter names')
+    parser.add_argument('--target_od', type=float, default=2.0, help='Target optical density')
+    parser.add_argument('--volume', type=float, default=5.0, help='Volume for dilution')
+    parser.add_argument('--days', type=float, default=7.0, help='Simulated run length, in days')
+    parser.add_argument('--reactors', type=int, default=8, help='Number of reactors replayed per filter')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    noise = load_noise_trace(args.trace, args.column, args.channel) if args.trace else None
+    results = replay(args.filters.split(","), args.window, noise, n_reactors=args.reactors, days=args.days, seed=args.seed,
+                     target_od=args.target_od, volume=args.volume)
+
+    print(f"{'od_filter':>10} {'dilutions':>10} {'spurious':>10} {'media mL':>10} {'OD rel. std':>12}")
+    for name, result in results.items():
+        print(f"{name:>10} {result['dilutions_total'].mean():10.1f} {result['spurious_dilutions'].mean():10.1f} "
+              f"{(result['media_ml'] + result['alt_media_ml']).mean():10.1f} {np.nanmean(result['od_relative_std']):12.4f}")
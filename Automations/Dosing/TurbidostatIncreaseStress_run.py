@@ -0,0 +1,203 @@
+
+'''
+One entry point to start the Turbidostat Increase Stress automation, replacing the v0 / v1 / v1_argparse / v1_configfile /
+v1_interactiveinput scripts, which each had their own copy of the class and only differed in where the settings came from.
+
+Every setting is a field of TurbidostatIncreaseStress.yaml and is resolved in this order (first found wins):
+  1) a command line flag               --target_od 2.0
+  2) an answer to the prompt           with --interactive, for every setting not given on the command line
+  3) the INI file                      --config turbidostat_config.ini, section [TurbidostatSettings]
+  4) the default in TurbidostatIncreaseStress.yaml
+
+run on the command line with
+
+nohup python3 TurbidostatIncreaseStress_run.py --config turbidostat_config.ini --target_od 2.0 &
+
+Use --dry_run to print the resolved settings (and where each one came from) without starting anything, and --validate to only
+check them (exit code 1 if one is invalid). The settings are checked with the plugin's own rules (TurbidostatIncreaseStress_settings:
+the YAML schema, the compiled stress schedule, the OD filter, the vial volumes and the OD channels configured for od_reading on this
+unit), so a setting --validate accepts doesn't stop the job when it starts. The pioreactor package and the plugin are only imported
+when a job actually starts, so --help, --validate and --dry_run return in milliseconds, also on a Pi.
+'''
+
+import argparse
+import configparser
+import os
+import sys
+
+from TurbidostatIncreaseStress_settings import StressSchedule, check_setting, make_od_filter, od_channels_of, resolve_od_channel
+
+
+YAML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TurbidostatIncreaseStress.yaml")
+INI_SECTION = "TurbidostatSettings"
+PIOREACTOR_CONFIGS = [os.path.join(os.path.expanduser("~"), ".pioreactor", name) for name in ("config.ini", "unit_config.ini")] # the unit's config overrides the shared one
+
+def scalar(text):
+    if text.startswith("[") and text.endswith("]"):
+        return [scalar(item.strip()) for item in text[1:-1].split(",") if item.strip()]
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"":
+        return text[1:-1]
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def read_fields(path=YAML_PATH):
+    # The fields of TurbidostatIncreaseStress.yaml, {key: field}, without PyYAML: importing and running it takes longer than
+    # everything else --help or --validate do. The file only has lists of "key: scalar" entries (and [a, b] lists) under `fields:`,
+    # which is all this reads.
+    fields, field, in_fields = {}, None, False
+    with open(path) as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            if not line[0].isspace():
+                in_fields = stripped == "fields:"
+                continue
+            if not in_fields:
+                continue
+            if stripped.startswith("- "):
+                field = {}
+                stripped = stripped[2:]
+            name, _, value = stripped.partition(":")
+            field[name.strip()] = scalar(value.strip())
+            if name.strip() == "key":
+                fields[field["key"]] = field
+    return fields
+
+
+def convert(field, value):
+    # A value from the command line, the prompt or the INI file, as the type of the field's default.
+    cast = type(field["default"])
+    try:
+        if cast is int and float(value) != int(float(value)):
+            raise ValueError
+        return int(float(value)) if cast is int else cast(value)
+    except ValueError:
+        raise ValueError(f"{field['key']}: {value!r} is not a valid {cast.__name__}")
+
+
+def build_parser(fields):
+    parser = argparse.ArgumentParser(description='Run the Turbidostat Increase Stress dosing automation')
+    for key, field in fields.items():
+        parser.add_argument(f'--{key}', default=None, help=f"{field.get('label', key)} ({field.get('unit', '')}), default {field['default']}")
+    parser.add_argument('--duration', type=float, default=1.0, help='How often execute runs, in minutes')
+    parser.add_argument('--unit', default=None, help='Pioreactor unit (default: this one)')
+    parser.add_argument('--experiment', default=None, help='Experiment (default: the latest one)')
+    parser.add_argument('--config', default=None, help=f'INI file with a [{INI_SECTION}] section (the settings not given on the command line)')
+    parser.add_argument('--interactive', action='store_true', help='Ask for every setting not given on the command line')
+    parser.add_argument('--validate', action='store_true', help='Only check the settings, exit code 1 if one is invalid')
+    parser.add_argument('--dry_run', action='store_true', help='Print the resolved settings and where each one came from, without starting the job')
+    return parser
+
+
+def resolve_settings(fields, args, ask=input):
+    # Returns {key: (value, source)} following the order in the module docstring. Raises ValueError on an unknown or invalid value.
+    resolved = {key: (field["default"], "yaml") for key, field in fields.items()}
+
+    if args.config:
+        ini = configparser.ConfigParser()
+        if not ini.read(args.config):
+            raise ValueError(f"Cannot read {args.config}")
+        if INI_SECTION not in ini:
+            raise ValueError(f"{args.config} has no [{INI_SECTION}] section")
+        for key, value in ini[INI_SECTION].items():
+            if key not in fields:
+                raise ValueError(f"{args.config}: {key} is not a setting of the automation. Choose from: {', '.join(fields)}")
+            resolved[key] = (convert(fields[key], value), args.config)
+
+    for key, field in fields.items():
+        flag = getattr(args, key)
+        if flag is not None:
+            resolved[key] = (convert(field, flag), "command line")
+        elif args.interactive:
+            answer = ask(f"{field.get('label', key)} ({field.get('unit', '')}) [{resolved[key][0]}]: ").strip()
+            if answer:
+                resolved[key] = (convert(field, answer), "prompt")
+    return resolved
+
+
+def configured_od_channels(paths=PIOREACTOR_CONFIGS):
+    # The OD channels od_reading reads on this unit, read from the pioreactor config files like the plugin does through the
+    # pioreactor package. None without them (e.g. on a laptop): then any od_channel is accepted, as the plugin does.
+    config = configparser.ConfigParser()
+    config.read(paths)
+    return od_channels_of(config)
+
+
+def validate(fields, settings, od_channels=None):
+    # Returns the problems found, as strings. An empty list means the settings can be used. The same checks as the plugin's
+    # validate_settings when the job starts: od_channels are the channels configured for od_reading, see configured_od_channels.
+    problems, invalid = [], set()
+    for key, value in settings.items():
+        problem = check_setting(fields[key], value)
+        if problem is not None:
+            problems.append(f"{key} = {value!r} {problem}")
+            invalid.add(key)
+    if settings["max_volume"] <= settings["culture_volume"]:
+        problems.append(f"max_volume = {settings['max_volume']} must be larger than culture_volume = {settings['culture_volume']}")
+    checks = (
+        ("stress_schedule", lambda: StressSchedule(settings["stress_schedule"], settings["stress_step_every"], settings["initial_alt_media"], settings["alt_media_ratio_increase"])),
+        ("od_filter", lambda: make_od_filter(settings["od_filter"], settings["od_filter_window"])),
+        ("od_channel", lambda: resolve_od_channel(settings["od_channel"], od_channels)),
+    )
+    for key, check in checks:
+        if key in invalid:
+            continue
+        try:
+            check()
+        except ValueError as e:
+            problems.append(f"{key} = {settings[key]!r}: {e}")
+    return problems
+
+
+def job_kwargs(args):
+    # The DosingController arguments that are not settings of the automation. unit and experiment are only passed when given.
+    kwargs = {"duration": args.duration}
+    kwargs.update({key: getattr(args, key) for key in ("unit", "experiment") if getattr(args, key) is not None})
+    return kwargs
+
+
+def start_job(settings, kwargs):
+    # The only place the pioreactor package and the plugin are imported. Importing the plugin registers the automation class
+    # so DosingController finds it by name.
+    import TurbidostatIncreaseStress_plugin
+    from pioreactor.background_jobs.dosing_control import DosingController
+
+    dc = DosingController(automation_name=TurbidostatIncreaseStress_plugin.TurbidostatIncreaseStress.automation_name, **kwargs, **settings)
+    dc.block_until_disconnected() # To run the dosing automation continuously until interrupted
+
+
+if __name__ == "__main__":
+    fields = read_fields()
+    args = build_parser(fields).parse_args()
+
+    try:
+        resolved = resolve_settings(fields, args)
+    except ValueError as e:
+        print(f"Invalid settings: {e}")
+        sys.exit(1)
+    settings = {key: value for key, (value, _) in resolved.items()}
+    problems = validate(fields, settings, configured_od_channels())
+
+    if args.dry_run or args.validate:
+        if args.dry_run:
+            for key, (value, source) in resolved.items():
+                print(f"{key:>26} = {value!s:<12} ({source})")
+            print(f"Would start DosingController(automation_name=\"turbidostat_increase_stress\", "
+                  f"{', '.join(f'{key}={value!r}' for key, value in {**job_kwargs(args), **settings}.items())})")
+        for problem in problems:
+            print(f"Invalid setting: {problem}")
+        if not problems:
+            print("Settings are valid.")
+        sys.exit(1 if problems else 0)
+
+    if problems:
+        for problem in problems:
+            print(f"Invalid setting: {problem}")
+        sys.exit(1)
+    start_job(settings, job_kwargs(args))
@@ -0,0 +1,68 @@
+
+'''
+Preview and validate a stress schedule of the Turbidostat Increase Stress automation before starting a run, and the media it needs.
+
+The settings default to the fields of TurbidostatIncreaseStress.yaml, the command line overrides them.
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_schedule.py --stress_schedule exponential:1.5 --stress_step_every hours:12 --initial_alt_media 0.05
+
+It prints every step of the compiled schedule (the alt_media ratio, when the step starts, and the media and alt_media it uses),
+or the error and exit code 1 if the schedule is not valid. The mL per step need the exchange rate (mL per hour, the `reservoirs`
+forecast uses the observed one) for hours:<h> steps, and also the growth rate for generations:<k> steps. With the bottle
+capacities, it also tells when each bottle runs out:
+
+python3 TurbidostatIncreaseStress_schedule.py --exchange_rate 2.5 --media_reservoir_ml 1000 --alt_media_reservoir_ml 250
+'''
+
+import argparse
+import sys
+
+from TurbidostatIncreaseStress_sweep import YAML_PATH
+from TurbidostatIncreaseStress_simulator import load_plugin
+
+import yaml
+
+
+if __name__ == "__main__":
+    with open(YAML_PATH) as f:
+        defaults = {field["key"]: field["default"] for field in yaml.safe_load(f)["fields"]}
+
+    parser = argparse.ArgumentParser(description='Preview the stress schedule of the Turbidostat Increase Stress automation')
+    parser.add_argument('--stress_schedule', default=defaults["stress_schedule"], help='linear, exponential:<factor> or table:<r0>,<r1>,...')
+    parser.add_argument('--stress_step_every', default=defaults["stress_step_every"], help='dilutions, hours:<h> or generations:<k>')
+    parser.add_argument('--initial_alt_media', type=float, default=defaults["initial_alt_media"], help='Initial alternate media ratio')
+    parser.add_argument('--alt_media_ratio_increase', type=float, default=defaults["alt_media_ratio_increase"], help='Media ratio increase after each cycle')
+    parser.add_argument('--dilutions', type=int, default=defaults["dilutions"], help='Number of dilutions per step')
+    parser.add_argument('--volume', type=float, default=defaults["volume"], help='Volume for dilution')
+    parser.add_argument('--exchange_rate', type=float, default=0.0, help='mL exchanged per hour (0 = unknown)')
+    parser.add_argument('--growth_rate', type=float, default=0.0, help='Growth rate per hour, for generations:<k> steps (0 = unknown)')
+    for bottle in ("media", "alt_media", "waste"):
+        parser.add_argument(f'--{bottle}_reservoir_ml', type=float, default=defaults[f"{bottle}_reservoir_ml"], help=f'Capacity of the {bottle} bottle (0 = not tracked)')
+    args = parser.parse_args()
+
+    plugin, _ = load_plugin()
+    try:
+        schedule = plugin.StressSchedule(args.stress_schedule, args.stress_step_every, args.initial_alt_media, args.alt_media_ratio_increase)
+    except ValueError as e:
+        print(f"Invalid stress schedule: {e}")
+        sys.exit(1)
+
+    step_ml = schedule.step_volume(args.dilutions, args.volume, args.exchange_rate, args.growth_rate)
+    print(f"{args.stress_schedule}, a step every {args.stress_step_every}: {len(schedule.ratios)} steps")
+    media_total = alt_media_total = 0.0
+    for step, ratio, starts in schedule.preview(args.dilutions):
+        if step_ml == float("inf"):
+            print(f"  step {step:4d}: alt_media ratio {ratio:.4f}   {starts}")
+            continue
+        media_total += step_ml * (1.0 - ratio)
+        alt_media_total += step_ml * ratio
+        print(f"  step {step:4d}: alt_media ratio {ratio:.4f}   {starts:<24} media {step_ml * (1.0 - ratio):8.1f} mL   alt_media {step_ml * ratio:8.1f} mL")
+    if step_ml != float("inf"):
+        print(f"Total over these steps: media {media_total:.1f} mL, alt_media {alt_media_total:.1f} mL")
+
+    inventory = plugin.ReservoirInventory(args.media_reservoir_ml, args.alt_media_reservoir_ml, args.waste_reservoir_ml)
+    if inventory.tracked and args.exchange_rate > 0:
+        for bottle, hours in inventory.hours_left(schedule, 0, step_ml, step_ml, exchange_rate=args.exchange_rate).items():
+            print(f"The {bottle} bottle ({inventory.left(bottle):g} mL) " + (f"{'is full' if bottle == 'waste' else 'runs out'} after {hours:.1f} h" if hours != float("inf") else "lasts the whole ramp"))
@@ -0,0 +1,227 @@
+'''
+The rules a setting of the Turbidostat Increase Stress automation must follow, without the pioreactor package: the YAML schema
+(min / max / options), the stress schedule, the OD filters and the OD channel. The plugin checks a new parameter set with them when
+the job starts and when a setting changes while it runs, and TurbidostatIncreaseStress_run.py --validate checks the same rules before
+a job is started, in milliseconds, also on a computer without the pioreactor package.
+
+It goes in the plugins folder next to TurbidostatIncreaseStress_plugin.py, which imports it.
+'''
+
+from array import array
+from bisect import bisect_left, insort
+from math import log
+
+
+LOG_2 = log(2.0)
+OD_CHANNELS_SECTION = "od_config.photodiode_channel"
+
+
+def check_setting(field, value):
+    # The problem with value for this field of the YAML schema (TurbidostatIncreaseStress.yaml, {key: field}), or None.
+    if "options" in field:
+        option = value.partition(":")[0] if isinstance(value, str) else value
+        if option not in field["options"]:
+            return f"must be one of {', '.join(map(str, field['options']))}"
+    if "min" in field and value < field["min"]:
+        return f"must be at least {field['min']}"
+    if "max" in field and value > field["max"]:
+        return f"must be at most {field['max']}"
+    return None
+
+
+class ODFilter:
+    # Streaming filter in front of the target_od comparison: update() takes one raw OD reading and returns the filtered OD.
+    # The state has a fixed size (set by window), allocated once. This base class is the "none" filter: it returns the raw reading.
+    # The filters, like the other per-reactor state classes, use __slots__: one process can host many automations (see TurbidostatIncreaseStress_host.py).
+    __slots__ = ("window",)
+
+    def __init__(self, window=5):
+        self.window = max(int(window), 1)
+        self.reset()
+
+    def reset(self):
+        pass
+
+    def update(self, od):
+        return od
+
+
+class RollingMedianFilter(ODFilter):
+    # Median of the last `window` readings. A ring buffer remembers the order the readings came in,
+    # and a sorted copy of the same readings gives the median. Both hold at most `window` values.
+    __slots__ = ("ring", "sorted", "position")
+
+    def reset(self):
+        self.ring = array("d", [0.0] * self.window)
+        self.sorted = []
+        self.position = 0
+
+    def update(self, od):
+        if len(self.sorted) == self.window:
+            oldest = self.ring[self.position]
+            del self.sorted[bisect_left(self.sorted, oldest)]
+        self.ring[self.position] = od
+        self.position = (self.position + 1) % self.window
+        insort(self.sorted, od)
+
+        n = len(self.sorted)
+        if n % 2:
+            return self.sorted[n // 2]
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+
+
+class EWMAFilter(ODFilter):
+    # Exponentially weighted moving average, with the same center of mass as a `window` long moving average.
+    __slots__ = ("alpha", "value")
+
+    def reset(self):
+        self.alpha = 2.0 / (self.window + 1)
+        self.value = None
+
+    def update(self, od):
+        self.value = od if self.value is None else self.value + self.alpha * (od - self.value)
+        return self.value
+
+
+class KalmanFilter(ODFilter):
+    # 1D Kalman filter with a random walk model for the OD. The process noise is 1 / window**2 of the measurement noise,
+    # so a larger window trusts each new reading less.
+    __slots__ = ("process_noise", "value", "variance")
+
+    def reset(self):
+        self.process_noise = 1.0 / self.window ** 2
+        self.value = None
+        self.variance = 1.0
+
+    def update(self, od):
+        if self.value is None:
+            self.value = od
+            return od
+        self.variance += self.process_noise
+        gain = self.variance / (self.variance + 1.0)
+        self.value += gain * (od - self.value)
+        self.variance *= 1.0 - gain
+        return self.value
+
+
+OD_FILTERS = {"none": ODFilter, "median": RollingMedianFilter, "ewma": EWMAFilter, "kalman": KalmanFilter}
+
+
+def make_od_filter(name, window):
+    if name not in OD_FILTERS:
+        raise ValueError(f"Unknown od_filter {name}. Choose from: {', '.join(OD_FILTERS)}")
+    return OD_FILTERS[name](window)
+
+
+class StressSchedule:
+    # The alt_media ratio at every step of the stress ramp, computed once into a lookup table, so update_media_ratio is an exact
+    # table lookup instead of adding alt_media_ratio_increase again and again (20 additions of 0.05 don't land exactly on 1.0).
+    #
+    # shape: "linear"                initial_alt_media + step * alt_media_ratio_increase (the original ramp; an increase of 0 holds
+    #                                initial_alt_media for the whole run)
+    #        "exponential:<factor>"  initial_alt_media * factor ** step
+    #        "table:<r0>,<r1>,..."   the ratios to go through, in order (initial_alt_media and alt_media_ratio_increase are not used)
+    # every: "dilutions"             a step every `dilutions` dilutions (the original behaviour)
+    #        "hours:<h>"             a step every h hours, however many dilutions that is
+    #        "generations:<k>"       a step every k generations, estimated online by GrowthRateEstimator
+    # Every shape is capped at 1.0 (100% alt_media) and stays on its last ratio after the last step.
+    MAX_STEPS = 10000
+    __slots__ = ("shape", "every", "ratios", "step_hours", "step_generations", "by_dilutions")
+
+    def __init__(self, shape, every, initial_alt_media, alt_media_ratio_increase):
+        self.shape = shape
+        self.every = every
+        kind, _, argument = shape.partition(":")
+        if kind == "linear":
+            if alt_media_ratio_increase < 0:
+                raise ValueError("alt_media_ratio_increase can't be negative for a linear stress schedule.")
+            if alt_media_ratio_increase == 0: # a constant ratio: one step, held for the whole run
+                ratios = [min(round(initial_alt_media, 9), 1.0)]
+            else:
+                ratios = self.ramp(lambda step: initial_alt_media + step * alt_media_ratio_increase)
+        elif kind == "exponential":
+            factor = float(argument or 2.0)
+            if factor <= 1.0 or initial_alt_media <= 0.0:
+                raise ValueError("An exponential stress schedule needs a factor above 1 and initial_alt_media above 0.")
+            ratios = self.ramp(lambda step: initial_alt_media * factor ** step)
+        elif kind == "table":
+            ratios = [float(ratio) for ratio in argument.split(",") if ratio.strip()]
+            if not ratios:
+                raise ValueError("A table stress schedule needs at least one ratio, like table:0.1,0.25,0.5,1.0")
+        else:
+            raise ValueError(f"Unknown stress schedule {shape}. Use linear, exponential:<factor> or table:<r0>,<r1>,...")
+        for step, ratio in enumerate(ratios):
+            if not 0.0 <= ratio <= 1.0:
+                raise ValueError(f"Step {step} of the stress schedule has an alt_media ratio of {ratio}, outside 0 - 1.")
+        self.ratios = array("d", ratios)
+
+        trigger, _, argument = every.partition(":")
+        self.step_hours = self.step_generations = None
+        if trigger == "hours" and argument and float(argument) > 0:
+            self.step_hours = float(argument)
+        elif trigger == "generations" and argument and float(argument) > 0:
+            self.step_generations = float(argument)
+        elif trigger != "dilutions":
+            raise ValueError(f"Unknown stress schedule step {every}. Use dilutions, hours:<h> or generations:<k>")
+        self.by_dilutions = trigger == "dilutions"
+
+    def ramp(self, ratio_at):
+        ratios = []
+        for step in range(self.MAX_STEPS):
+            ratio = min(round(ratio_at(step), 9), 1.0) # rounded to 9 decimals, so 0.25 + 15 * 0.05 is exactly 1.0
+            ratios.append(ratio)
+            if ratio >= 1.0:
+                break
+        return ratios
+
+    def ratio(self, step):
+        return self.ratios[min(step, len(self.ratios) - 1)]
+
+    def step_due(self, hours, generations):
+        # For hours:<h> and generations:<k> steps, given the time and generations since the current step started.
+        # Steps every `dilutions` dilutions are counted by the automation itself.
+        if self.step_hours is not None:
+            return hours >= self.step_hours
+        if self.step_generations is not None:
+            return generations >= self.step_generations
+        return False
+
+    def step_volume(self, dilutions, volume, exchange_rate, growth_rate):
+        # mL exchanged during one whole step: `dilutions` dilutions of `volume` mL, or the hours of a step at exchange_rate (mL per hour).
+        # A generation takes log(2) / growth_rate hours. inf when the step never ends at this rate.
+        if self.by_dilutions:
+            return dilutions * volume
+        hours = self.step_hours if self.step_hours is not None else (self.step_generations * LOG_2 / growth_rate if growth_rate > 0 else float("inf"))
+        return hours * exchange_rate if exchange_rate > 0 else float("inf")
+
+    def preview(self, dilutions):
+        # (step, ratio, when the step starts) for every step of the ramp, to check a schedule before starting a run.
+        for step, ratio in enumerate(self.ratios):
+            if self.step_hours is not None:
+                yield step, ratio, f"after {step * self.step_hours:g} h"
+            elif self.step_generations is not None:
+                yield step, ratio, f"after {step * self.step_generations:g} generations"
+            else:
+                yield step, ratio, f"after {step * dilutions} dilutions"
+
+
+def od_channels_of(config):
+    # The od_reading job reads the photodiode channels that have an angle in [od_config.photodiode_channel] (REF is the reference photodiode).
+    # config is the pioreactor config, or any ConfigParser read from the same files. Returns None if the section is missing:
+    # then every channel present in the OD readings is used.
+    if not config.has_section(OD_CHANNELS_SECTION):
+        return None
+    return sorted(channel for channel, angle in config[OD_CHANNELS_SECTION].items() if angle and angle.upper() not in ("REF", "NONE"))
+
+
+def resolve_od_channel(value, configured):
+    # The previous version was hard-coded to latest_od['2'], the 90 degree channel of our own Pioreactors.
+    # "auto" uses the channel(s) configured for od_reading on this unit, so the same plugin works on every hardware revision:
+    # the only configured channel, or the highest OD of them if there are several sensors.
+    # Returns (od_channel, channel policy, channels read), channels being None for all the channels in the readings.
+    value = str(value)
+    if value in ("auto", "max", "mean"):
+        return value, "mean" if value == "mean" else "max", configured
+    if configured is not None and value not in configured:
+        raise ValueError(f"OD channel {value} is not configured for od_reading. Configured channels: {', '.join(configured)}")
+    return value, "max", [value]
@@ -0,0 +1,1123 @@
+
+'''
+Offline simulator for the Turbidostat Increase Stress automation.
+
+It replaces the pioreactor package with small stand-ins (no MQTT broker, no pumps, no calibration files)
+and drives the real TurbidostatIncreaseStress.execute / update_media_ratio code from TurbidostatIncreaseStress_plugin.py
+on a virtual clock, so a 7 day stress ramp can be replayed in a few seconds.
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_simulator.py --days 7 --reactors 24 --target_od 2.0 --volume 5.0 --dilutions 10 --initial_alt_media 0.25 --alt_media_ratio_increase 0.05
+
+Two engines are available:
+  * "plugin": one real TurbidostatIncreaseStress instance per reactor (the culture model is vectorized, the decisions run the plugin code).
+  * "vectorized": the same decision logic written with NumPy arrays, so thousands of reactors advance in one array operation per tick.
+'''
+
+import argparse
+import configparser
+import logging
+import sys
+import tempfile
+import time
+import types
+import warnings
+
+import numpy as np
+
+
+PUMPS = ("media", "alt_media", "waste")
+SPURIOUS_MARGIN = 0.02  # a dilution is spurious if the true OD was more than 2% below target_od
+MAX_ML_PER_ACTION = 0.625  # like pioreactor's execute_io_action, larger volumes are dosed as repeated halves
+PUMP_ML_PER_SECOND = {"media": 0.5, "alt_media": 0.5, "waste": 0.5}  # typical calibrated peristaltic pump rates
+
+
+def dosing_chunks(ml):
+    # Number of equal chunks pioreactor splits a dosing action into: halve until every chunk is at most MAX_ML_PER_ACTION.
+    return 2 ** np.ceil(np.log2(np.maximum(np.asarray(ml, dtype=float) / MAX_ML_PER_ACTION, 1.0))).astype(np.int64)
+
+
+class VirtualClock:
+    # A clock that only moves when the simulator says so. Seconds since the start of the simulated run.
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class CultureModel:
+    # Growth / dilution / stress-response model shared by every simulated reactor.
+    # Growth is logistic, and the growth rate falls with the fraction of alt_media in the vial following a Hill curve.
+    # The culture adapts: the half-inhibitory alt_media fraction (ic50) rises slowly with every generation spent under stress.
+    def __init__(self, mu_max=0.6, carrying_capacity=6.0, ic50=0.6, hill=2.0, adaptation_rate=0.01,
+                 od_noise=0.01, spike_probability=0.0, spike_height=0.5, culture_volume=14.0, initial_od=0.05):
+        self.mu_max = mu_max                        # per hour, without stress
+        self.carrying_capacity = carrying_capacity  # od600
+        self.ic50 = ic50                            # alt_media fraction in the vial that halves the growth rate
+        self.hill = hill
+        self.adaptation_rate = adaptation_rate      # relative increase of ic50 per generation spent under stress
+        self.od_noise = od_noise                    # standard deviation of the OD measurement noise
+        self.spike_probability = spike_probability  # chance that a reading is a spike (bubble, debris), on top of od_noise
+        self.spike_height = spike_height            # relative height of a spike, 0.5 = reads 50% above the true OD
+        self.culture_volume = culture_volume        # mL kept in the vial (Not the dilution volume!)
+        self.initial_od = initial_od
+
+
+class ReactorBank:
+    # State of N simulated vials kept as NumPy arrays, so every physical update is one array operation.
+    # seed is one seed for the whole bank, or one seed per reactor: then every reactor draws its noise from its own generator,
+    # and its run doesn't depend on the other reactors simulated with it (the batches of a sweep).
+    NOISE_BLOCK = 1024 # with one seed per reactor, draws made at a time per reactor
+
+    def __init__(self, n_reactors, model, initial_alt_media=0.0, seed=None, noise_trace=None):
+        self.n = n_reactors
+        self.model = model
+        self.rng = np.random.default_rng(seed) if np.ndim(seed) == 0 else None
+        self.reactor_rngs = None if self.rng is not None else [np.random.default_rng(int(s)) for s in seed]
+        self.noise_block = None # (normal, uniform) draws of every reactor, NOISE_BLOCK columns, with one seed per reactor
+        self.noise_column = 0
+        self.od = np.full(n_reactors, model.initial_od, dtype=float)
+        self.alt_fraction = np.broadcast_to(np.asarray(initial_alt_media, dtype=float), (n_reactors,)).copy()
+        self.ic50 = np.full(n_reactors, model.ic50, dtype=float)
+        self.generations = np.zeros(n_reactors)
+        self.dispensed_ml = {pump: np.zeros(n_reactors) for pump in PUMPS}
+        self.pump_activations = {pump: np.zeros(n_reactors, dtype=np.int64) for pump in PUMPS}
+        self.dilutions = np.zeros(n_reactors, dtype=np.int64)  # dosing actions (execute_io_action calls)
+        self.volume = np.full(n_reactors, model.culture_volume)  # mL in the vial right now
+        self.peak_volume = self.volume.copy()  # highest volume seen, to check that the vial never overflows
+        # Measurement noise replayed from a recorded trace (OD minus its smoothed value), instead of the model's noise.
+        # Each reactor starts at a different offset of the trace.
+        self.noise_trace = None if noise_trace is None else np.asarray(noise_trace, dtype=float)
+        self.noise_position = None
+        if noise_trace is not None:
+            if self.rng is not None:
+                self.noise_position = self.rng.integers(0, len(self.noise_trace), n_reactors)
+            else:
+                self.noise_position = np.array([rng.integers(0, len(self.noise_trace)) for rng in self.reactor_rngs])
+
+    def growth_rate(self):
+        m = self.model
+        return m.mu_max / (1.0 + (self.alt_fraction / self.ic50) ** m.hill)
+
+    def grow(self, hours):
+        # Exact logistic solution over the step, with the growth rate held constant during the step.
+        m = self.model
+        mu = self.growth_rate()
+        growth = np.exp(mu * hours)
+        new_od = m.carrying_capacity * self.od * growth / (m.carrying_capacity + self.od * (growth - 1.0))
+        generations = np.log2(new_od / self.od)
+        self.generations += generations
+        self.ic50 *= np.exp(m.adaptation_rate * generations * (self.alt_fraction > 0))
+        self.od = new_od
+
+    def measure(self):
+        if self.noise_trace is not None:
+            noise = self.noise_trace[self.noise_position]
+            self.noise_position = (self.noise_position + 1) % len(self.noise_trace)
+            return np.maximum(self.od + noise, 0.0)
+        if self.rng is not None:
+            noise = self.rng.normal(0.0, self.model.od_noise, self.n)
+            spikes = self.rng.random(self.n) < self.model.spike_probability
+        else:
+            if self.noise_block is None or self.noise_column == self.NOISE_BLOCK:
+                self.noise_block = (np.array([rng.standard_normal(self.NOISE_BLOCK) for rng in self.reactor_rngs]),
+                                    np.array([rng.random(self.NOISE_BLOCK) for rng in self.reactor_rngs]))
+                self.noise_column = 0
+            noise = self.noise_block[0][:, self.noise_column] * self.model.od_noise
+            spikes = self.noise_block[1][:, self.noise_column] < self.model.spike_probability
+            self.noise_column += 1
+        return np.maximum(self.od * (1.0 + self.model.spike_height * spikes) + noise, 0.0)
+
+    def pump(self, index, pump, ml):
+        # One pump run on one reactor, called by the stand-in pump actions. Additions dilute the culture and raise the volume,
+        # waste removal brings the volume back down, never below culture_volume (the level of the waste tube).
+        if ml <= 0:
+            return
+        if pump == "waste":
+            self.volume[index] = max(self.volume[index] - ml, self.model.culture_volume)
+        else:
+            v = self.volume[index]
+            self.od[index] *= v / (v + ml)
+            self.alt_fraction[index] = (self.alt_fraction[index] * v + (ml if pump == "alt_media" else 0.0)) / (v + ml)
+            self.volume[index] = v + ml
+            self.peak_volume[index] = max(self.peak_volume[index], v + ml)
+        self.dispensed_ml[pump][index] += ml
+        self.pump_activations[pump][index] += 1
+
+    def dilute_many(self, mask, media_ml, alt_media_ml, waste_ml):
+        # The stand-in execute_io_action for every reactor in mask at once: the volumes are split in n equal chunks,
+        # and each chunk adds media and alt_media then removes the same volume to waste. Over n chunks of `add` mL the culture
+        # is diluted by r = (v / (v + add)) ** n, and the alt_media fraction moves towards the alt_media share of the added media.
+        v = self.model.culture_volume
+        n = dosing_chunks(np.maximum(np.maximum(media_ml, alt_media_ml), waste_ml))
+        added = media_ml + alt_media_ml
+        r = (v / (v + added / n)) ** n
+        alt_share = np.divide(alt_media_ml, added, out=np.zeros(self.n), where=added > 0)
+        self.od = np.where(mask, self.od * r, self.od)
+        self.alt_fraction = np.where(mask, r * self.alt_fraction + (1 - r) * alt_share, self.alt_fraction)
+        self.peak_volume = np.where(mask, np.maximum(self.peak_volume, v + added / n), self.peak_volume)
+        self.dilutions += mask
+        for pump, ml in (("media", media_ml), ("alt_media", alt_media_ml), ("waste", waste_ml)):
+            self.dispensed_ml[pump] += np.where(mask, ml, 0.0)
+            self.pump_activations[pump] += np.where(mask & (ml > 0), n, 0)
+
+
+def install_pioreactor_standins(clock=None, calibrated_pumps=PUMPS, photodiode_channels=None):
+    '''
+    Put minimal stand-ins for the pioreactor modules used by the plugin into sys.modules,
+    so `import TurbidostatIncreaseStress_plugin` works on a laptop without the pioreactor package.
+    Returns the stand-in module namespace (useful to swap the clock or the persistent storage).
+    Do not call this inside a real pioreactor process: it replaces the real modules.
+    '''
+    clock = clock or VirtualClock()
+    storage = {"current_pump_calibration": {pump: {} for pump in calibrated_pumps}}
+    subscriptions = {}  # topic -> callbacks, an in-process stand-in for the MQTT broker
+    config = configparser.ConfigParser()
+    config["od_config.photodiode_channel"] = photodiode_channels or {"1": "REF", "2": "90"}
+    reactors = {}  # unit -> (ReactorBank, index), so the stand-in pump actions know which vial they act on
+    pump_timing = types.SimpleNamespace(time_scale=0.0, ml_per_second=dict(PUMP_ML_PER_SECOND))  # time_scale > 0 makes pumps take real (scaled) time
+    pump_timing.deferred = None  # a dict: pumps return at once and add their (scaled) run time to deferred[unit] instead of sleeping
+
+    def run_pump(pump, unit, ml):
+        bank, index = reactors.get(unit, (None, 0))
+        seconds = ml / pump_timing.ml_per_second[pump] * pump_timing.time_scale
+        if pump != "waste" and bank is not None:
+            bank.pump(index, pump, ml)  # count additions from their start and removals at their end: the worst case for the volume
+        if seconds > 0 and pump_timing.deferred is not None:
+            pump_timing.deferred[unit] = pump_timing.deferred.get(unit, 0.0) + seconds
+        elif seconds > 0:
+            time.sleep(seconds)
+        if pump == "waste" and bank is not None:
+            bank.pump(index, pump, ml)
+        return ml
+
+    def add_media(unit, experiment, ml, **kwargs):
+        return run_pump("media", unit, ml)
+
+    def add_alt_media(unit, experiment, ml, **kwargs):
+        return run_pump("alt_media", unit, ml)
+
+    def remove_waste(unit, experiment, ml, **kwargs):
+        return run_pump("waste", unit, ml)
+
+    def publish(topic, payload):
+        message = types.SimpleNamespace(topic=topic, payload=payload.encode() if isinstance(payload, str) else payload)
+        for callback in subscriptions.get(topic, []):
+            callback(message)
+
+    class CalibrationError(Exception):
+        pass
+
+    class local_persistant_storage:
+        # dict-backed stand-in of pioreactor.utils.local_persistant_storage
+        def __init__(self, cache_name):
+            self.cache = storage.setdefault(cache_name, {})
+
+        def __enter__(self):
+            return self.cache
+
+        def __exit__(self, *exc):
+            return False
+
+    def is_pio_job_running(*job_names):
+        return True
+
+    class SummableDict(dict):
+        # pioreactor.utils.SummableDict: dicts of volumes that add up key by key
+        def __add__(self, other):
+            return SummableDict({key: self.get(key, 0.0) + other.get(key, 0.0) for key in self.keys() | other.keys()})
+
+    class DosingAutomationJobContrib:
+        # Only what TurbidostatIncreaseStress uses: latest_od, logger, execute_io_action and the per-pump functions it calls,
+        # the job state, unit / experiment / duration.
+        automation_name = None
+        job_name = "dosing_automation"
+        published_settings = {}
+        INIT, READY, SLEEPING, DISCONNECTED = "init", "ready", "sleeping", "disconnected"
+        state = READY
+        pub_client = None
+
+        def __init__(self, unit="sim_unit", experiment="sim_experiment", duration=1.0, bank=None, index=0, **kwargs):
+            self.unit = unit
+            self.experiment = experiment
+            self.duration = duration
+            self.latest_od = None
+            self.logger = logging.getLogger(f"{self.automation_name}.{unit}")
+            self.bank = bank    # ReactorBank that receives the pump actions
+            self.index = index  # position of this reactor in the bank
+            reactors[unit] = (bank, index)
+
+        def add_media_to_bioreactor(self, ml, source_of_event, mqtt_client, logger):
+            return add_media(unit=self.unit, experiment=self.experiment, ml=ml, source_of_event=source_of_event, mqtt_client=mqtt_client, logger=logger)
+
+        def add_alt_media_to_bioreactor(self, ml, source_of_event, mqtt_client, logger):
+            return add_alt_media(unit=self.unit, experiment=self.experiment, ml=ml, source_of_event=source_of_event, mqtt_client=mqtt_client, logger=logger)
+
+        def remove_waste_from_bioreactor(self, ml, source_of_event, mqtt_client, logger):
+            return remove_waste(unit=self.unit, experiment=self.experiment, ml=ml, source_of_event=source_of_event, mqtt_client=mqtt_client, logger=logger)
+
+        def execute_io_action(self, alt_media_ml=0.0, media_ml=0.0, waste_ml=0.0):
+            # Like pioreactor: split in equal chunks of at most MAX_ML_PER_ACTION, each chunk runs media, alt_media then waste, one pump
+            # at a time, and no chunk starts once the job is asked to sleep or disconnect.
+            n = int(dosing_chunks(max(alt_media_ml, media_ml, waste_ml)))
+            moved = SummableDict(waste_ml=0.0, media_ml=0.0, alt_media_ml=0.0)
+            source_of_event = f"{self.job_name}:{self.automation_name}"
+            for _ in range(n):
+                if self.state in (self.SLEEPING, self.DISCONNECTED):
+                    break
+                for pump, pump_function, ml in (("media", self.add_media_to_bioreactor, media_ml), ("alt_media", self.add_alt_media_to_bioreactor, alt_media_ml),
+                                                ("waste", self.remove_waste_from_bioreactor, waste_ml)):
+                    if ml > 0:
+                        moved[f"{pump}_ml"] += pump_function(ml=ml / n, source_of_event=source_of_event, mqtt_client=self.pub_client, logger=self.logger)
+            return moved
+
+        def subscribe_and_callback(self, callback, subscriptions_, allow_retained=True, **kwargs):
+            for topic in [subscriptions_] if isinstance(subscriptions_, str) else subscriptions_:
+                subscriptions.setdefault(topic, []).append(callback)
+
+    class DosingController:
+        def __init__(self, automation_name, **kwargs):
+            raise RuntimeError("DosingController is not available in the offline simulator.")
+
+    modules = {
+        "pioreactor": types.ModuleType("pioreactor"),
+        "pioreactor.automations": types.ModuleType("pioreactor.automations"),
+        "pioreactor.automations.dosing": types.ModuleType("pioreactor.automations.dosing"),
+        "pioreactor.automations.dosing.base": types.ModuleType("pioreactor.automations.dosing.base"),
+        "pioreactor.utils": types.ModuleType("pioreactor.utils"),
+        "pioreactor.exc": types.ModuleType("pioreactor.exc"),
+        "pioreactor.config": types.ModuleType("pioreactor.config"),
+        "pioreactor.actions": types.ModuleType("pioreactor.actions"),
+        "pioreactor.actions.pump": types.ModuleType("pioreactor.actions.pump"),
+        "pioreactor.background_jobs": types.ModuleType("pioreactor.background_jobs"),
+        "pioreactor.background_jobs.dosing_control": types.ModuleType("pioreactor.background_jobs.dosing_control"),
+    }
+    modules["pioreactor.automations.dosing.base"].DosingAutomationJobContrib = DosingAutomationJobContrib
+    modules["pioreactor.utils"].local_persistant_storage = local_persistant_storage
+    modules["pioreactor.utils"].is_pio_job_running = is_pio_job_running
+    modules["pioreactor.utils"].SummableDict = SummableDict
+    modules["pioreactor.exc"].CalibrationError = CalibrationError
+    modules["pioreactor.config"].config = config
+    modules["pioreactor.actions.pump"].add_media = add_media
+    modules["pioreactor.actions.pump"].add_alt_media = add_alt_media
+    modules["pioreactor.actions.pump"].remove_waste = remove_waste
+    modules["pioreactor.background_jobs.dosing_control"].DosingController = DosingController
+    modules["pioreactor"].standins = types.SimpleNamespace(clock=clock, storage=storage, storage_dir=tempfile.mkdtemp(prefix="pioreactor_sim_"), config=config, subscriptions=subscriptions, publish=publish, reactors=reactors, pump_timing=pump_timing)
+    sys.modules.update(modules)
+    return modules["pioreactor"].standins
+
+
+def load_plugin(clock=None):
+    standins = install_pioreactor_standins(clock)
+    sys.modules.pop("TurbidostatIncreaseStress_plugin", None)  # re-import so it binds to these stand-ins
+    import TurbidostatIncreaseStress_plugin
+    TurbidostatIncreaseStress_plugin.monotonic = standins.clock.monotonic  # min_dilution_interval etc. follow the virtual clock
+    TurbidostatIncreaseStress_plugin.time = standins.clock.time  # and so do the checkpoint and decision log timestamps
+    TurbidostatIncreaseStress_plugin.CHECKPOINT_DIR = standins.storage_dir  # keep the simulated ramp checkpoints out of ~/.pioreactor
+    return TurbidostatIncreaseStress_plugin, standins
+
+
+class VectorizedTurbidostatIncreaseStress:
+    # The decision logic of TurbidostatIncreaseStress.execute / update_media_ratio, one array element per reactor.
+    # Keep in step with the plugin: compare_engines() checks that both engines give the same pump history.
+    def __init__(self, target_od, volume, dilutions, initial_alt_media, alt_media_ratio_increase, n_reactors):
+        shape = (n_reactors,)
+        self.target_od = np.broadcast_to(np.asarray(target_od, dtype=float), shape).copy()
+        self.volume = np.broadcast_to(np.asarray(volume, dtype=float), shape).copy()
+        self.dilutions = np.broadcast_to(np.asarray(dilutions, dtype=np.int64), shape).copy()
+        self.initial_alt_media = np.broadcast_to(np.asarray(initial_alt_media, dtype=float), shape).copy()
+        self.alt_media_ratio_increase = np.broadcast_to(np.asarray(alt_media_ratio_increase, dtype=float), shape).copy()
+        self.dilution_count = np.zeros(shape, dtype=np.int64)
+        self.ratio_step = np.zeros(shape, dtype=np.int64)
+        self.alt_media_ratio = self.initial_alt_media.copy()
+
+    def execute(self, od, bank):
+        fire = od > self.target_od
+        self.dilution_count += fire
+        alt_media_ml = self.volume * self.alt_media_ratio
+        media_ml = self.volume - alt_media_ml
+        bank.dilute_many(fire, media_ml, alt_media_ml, self.volume)
+
+        update = fire & (self.dilution_count >= self.dilutions)
+        self.ratio_step += update
+        # the linear StressSchedule of the plugin: computed from the step, rounded like the plugin's lookup table
+        self.alt_media_ratio = np.minimum(np.round(self.initial_alt_media + self.ratio_step * self.alt_media_ratio_increase, 9), 1.0)
+        self.dilution_count = np.where(update, 0, self.dilution_count)
+        return fire
+
+
+def simulate(target_od=2.0, volume=5.0, dilutions=10, initial_alt_media=0.25, alt_media_ratio_increase=0.05,
+             n_reactors=1, days=7.0, duration=1.0, model=None, engine="vectorized", seed=None, noise_trace=None, **automation_kwargs):
+    '''
+    Replay a full run on the virtual clock. Settings can be scalars or arrays of length n_reactors.
+    duration is how often execute runs, in minutes (same meaning as in DosingController).
+    seed is one seed, or one seed per reactor (see ReactorBank).
+    noise_trace replays recorded OD noise instead of the model's. automation_kwargs (od_filter, ...) go to the plugin, "plugin" engine only.
+    Returns a dict of per-reactor NumPy arrays.
+    '''
+    model = model or CultureModel()
+    clock = VirtualClock()
+    bank = ReactorBank(n_reactors, model, initial_alt_media=0.0, seed=seed, noise_trace=noise_trace)
+    n_ticks = int(round(days * 24 * 60 / duration))
+    hours_per_tick = duration / 60.0
+
+    if engine == "vectorized":
+        if automation_kwargs:
+            raise ValueError(f"{', '.join(automation_kwargs)} only work with the plugin engine")
+        policy = VectorizedTurbidostatIncreaseStress(target_od, volume, dilutions, initial_alt_media, alt_media_ratio_increase, n_reactors)
+        get_ratio = lambda: policy.alt_media_ratio
+        target = policy.target_od
+    elif engine == "plugin":
+        plugin, _ = load_plugin(clock)
+        settings = [np.broadcast_to(np.asarray(s), (n_reactors,)) for s in (target_od, volume, dilutions, initial_alt_media, alt_media_ratio_increase)]
+        automations = [
+            plugin.TurbidostatIncreaseStress(
+                target_od=settings[0][i], volume=settings[1][i], dilutions=settings[2][i],
+                initial_alt_media=settings[3][i], alt_media_ratio_increase=settings[4][i],
+                unit=f"sim{i:04d}", experiment="simulation", duration=duration, bank=bank, index=i, **automation_kwargs,
+            )
+            for i in range(n_reactors)
+        ]
+        get_ratio = lambda: np.array([a.alt_media_ratio for a in automations])
+        target = settings[0].astype(float)
+    else:
+        raise ValueError(f"Unknown engine {engine}")
+
+    time_to_full_alt_media = np.full(n_reactors, np.nan)
+    # running sums for the OD stability (relative deviation from target_od, once the culture first reached it)
+    reached = np.zeros(n_reactors, dtype=bool)
+    dev_sum = np.zeros(n_reactors)
+    dev_sq_sum = np.zeros(n_reactors)
+    dev_n = np.zeros(n_reactors)
+    spurious_dilutions = np.zeros(n_reactors, dtype=np.int64)  # dilutions fired while the true (noise-free) OD was clearly below target_od
+
+    for _ in range(n_ticks):
+        bank.grow(hours_per_tick)
+        clock.advance(duration * 60.0)
+        od = bank.measure()
+        true_od_below_target = bank.od < target * (1 - SPURIOUS_MARGIN)
+        dilutions_before = bank.dilutions.copy()
+
+        reached |= od >= target
+        rel = np.where(reached, (od - target) / target, 0.0)
+        dev_sum += rel
+        dev_sq_sum += rel * rel
+        dev_n += reached
+
+        if engine == "vectorized":
+            policy.execute(od, bank)
+        else:
+            dispensed_before = sum(bank.dispensed_ml.values())
+            for i, automation in enumerate(automations):
+                automation.latest_od = {"2": float(od[i])}
+                automation.execute()
+            bank.dilutions += sum(bank.dispensed_ml.values()) > dispensed_before
+        spurious_dilutions += (bank.dilutions > dilutions_before) & true_od_below_target
+
+        full = (get_ratio() >= 1.0) & np.isnan(time_to_full_alt_media)
+        time_to_full_alt_media[full] = clock.now / 3600.0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_dev = dev_sum / dev_n
+        od_std = np.sqrt(np.maximum(dev_sq_sum / dev_n - mean_dev ** 2, 0.0))
+
+    return {
+        "media_ml": bank.dispensed_ml["media"],
+        "alt_media_ml": bank.dispensed_ml["alt_media"],
+        "waste_ml": bank.dispensed_ml["waste"],
+        "pump_activations": sum(bank.pump_activations.values()),
+        "dilutions_total": bank.dilutions.copy(),
+        "spurious_dilutions": spurious_dilutions,
+        "hours_to_full_alt_media": time_to_full_alt_media,
+        "od_relative_std": od_std,
+        "final_alt_media_ratio": np.asarray(get_ratio(), dtype=float),
+        "final_od": bank.od,
+        "generations": bank.generations,
+        "peak_volume": bank.peak_volume,
+        # the plugin's online estimate (GrowthRateEstimator), to compare against the model's true generations
+        "estimated_generations": np.array([a.generations for a in automations]) if engine == "plugin" else np.full(n_reactors, np.nan),
+    }
+
+
+def compare_engines(days=2.0, seed=1, **settings):
+    # Run both engines on the same noise and check that the pump history is identical.
+    plugin_run = simulate(days=days, engine="plugin", seed=seed, **settings)
+    vector_run = simulate(days=days, engine="vectorized", seed=seed, **settings)
+    return all(np.allclose(plugin_run[k], vector_run[k], equal_nan=True) for k in ("media_ml", "alt_media_ml", "waste_ml", "final_alt_media_ratio"))
+
+
+def measure_trigger_latency(n_readings=2000, od_interval=5.0, target_od=2.0, pump_seconds=0.0):
+    '''
+    Event-driven mode: publish OD readings through the in-process broker stand-in and collect the plugin's trigger_latency,
+    the time from an OD reading arriving in the MQTT callback to the start of the pump action on the decisions thread.
+    pump_seconds emulates a blocking pump run.
+    Returns the latencies in ms and the OD sampling interval in ms, to compare against.
+    '''
+    import json
+
+    plugin, standins = load_plugin()
+    automation = plugin.TurbidostatIncreaseStress(
+        target_od=target_od, volume=1.0, dilutions=10, initial_alt_media=0.25, alt_media_ratio_increase=0.05,
+        event_driven=True, unit="latency", experiment="simulation",
+    )
+    if pump_seconds:
+        automation.execute_io_action = lambda **volumes: time.sleep(pump_seconds)
+    topic = f"pioreactor/{automation.unit}/{automation.experiment}/od_reading/ods"
+
+    latencies = []
+    for i in range(n_readings):
+        od = target_od * (1.05 if i % 2 else 0.95)  # every other reading is above target_od and triggers a dilution
+        automation.trigger_latency = None
+        standins.publish(topic, json.dumps({"ods": {"2": {"od": od, "channel": "2", "angle": "90"}}}))
+        automation.decisions.submit(int).result()  # wait for the decision of this reading
+        standins.clock.advance(od_interval)
+        if automation.trigger_latency is not None:
+            latencies.append(automation.trigger_latency)
+    automation.on_disconnected()
+    return np.array(latencies), od_interval * 1000
+
+
+def compare_dilution_volume(days=7.0, n_reactors=8, seed=0, **settings):
+    '''
+    The same runs with the fixed `volume` per dilution and with adaptive_volume (plugin engine).
+    Returns {adaptive_volume: means over the reactors} of the pump activations, mL through the pumps (tubing wear) and dilutions per day,
+    the OD deviation and the alt_media_ratio reached.
+    '''
+    results = {}
+    for adaptive in (False, True):
+        run = simulate(n_reactors=n_reactors, days=days, engine="plugin", seed=seed, adaptive_volume=adaptive, **settings)
+        results[adaptive] = {
+            "pump_activations_per_day": float(run["pump_activations"].mean()) / days,
+            "pumped_ml_per_day": float((run["media_ml"] + run["alt_media_ml"] + run["waste_ml"]).mean()) / days,
+            "dilutions_per_day": float(run["dilutions_total"].mean()) / days,
+            "od_relative_std": float(np.nanmean(run["od_relative_std"])),
+            "final_alt_media_ratio": float(run["final_alt_media_ratio"].mean()),  # the pace of the stress ramp
+        }
+    return results
+
+
+def measure_metrics_overhead(n_calls=20000, repeats=5):
+    '''
+    Cost of one execute() tick that doesn't dilute (the common case), with metrics off and on.
+    Returns {metrics: µs per call}, the best of `repeats` runs.
+    '''
+    plugin, _ = load_plugin()
+    results = {}
+    for metrics in (False, True):
+        automation = plugin.TurbidostatIncreaseStress(
+            target_od=2.0, volume=1.0, dilutions=10, initial_alt_media=0.25, alt_media_ratio_increase=0.05,
+            metrics=metrics, metrics_interval=3600.0, unit=f"metrics_{metrics}", experiment="simulation",
+        )
+        automation.latest_od = {"2": 1.0}
+        execute = automation.execute
+        best = float("inf")
+        for _ in range(repeats):
+            started = time.perf_counter()
+            for _ in range(n_calls):
+                execute()
+            best = min(best, time.perf_counter() - started)
+        automation.on_disconnected()
+        results[metrics] = best / n_calls * 1e6
+    return results
+
+
+def measure_growth_estimator(n_samples=100000, growth_rate=0.4, od_interval=5.0, od_noise=0.01, seed=0):
+    '''
+    Cost and accuracy of the plugin's online growth rate estimator on a noisy exponential curve, at growth_rate per hour.
+    Returns (µs per OD sample, estimated growth rate per hour, estimated generations, true generations).
+    '''
+    plugin, _ = load_plugin()
+    estimator = plugin.GrowthRateEstimator()
+    rng = np.random.default_rng(seed)
+    at = np.arange(n_samples) * od_interval
+    od = (0.1 * np.exp(growth_rate * (at % 3600) / 3600) * (1 + od_noise * rng.standard_normal(n_samples))).tolist()
+    at = at.tolist()
+
+    started = time.perf_counter()
+    update = estimator.update
+    for i in range(n_samples):
+        if i and at[i] % 3600 == 0:
+            estimator.dilution()  # the curve is diluted back to 0.1 every hour
+        update(od[i], at[i])
+    elapsed = time.perf_counter() - started
+    true_generations = growth_rate * at[-1] / 3600 / np.log(2)
+    return elapsed / n_samples * 1e6, estimator.growth_rate, estimator.generations, true_generations
+
+
+def _broker_standin(server, topic, results):
+    # A minimal local broker: one subscriber and one publisher over TCP, one line per message (topic, tab, JSON payload),
+    # routed by topic like MQTT. Runs in its own process.
+    subscriber, _ = server.accept()
+    publisher, _ = server.accept()
+    routes = {topic.encode(): subscriber}
+    for line in publisher.makefile("rb"):
+        routes[line.split(b"\t", 1)[0]].sendall(line)
+    results.put(("broker", time.process_time()))
+
+
+def _od_publisher(feed, address, topic, n_readings, interval, results):
+    # The od_reading side, in its own process: publish n_readings OD readings every interval seconds, through the broker or the ring.
+    import json
+    import socket
+
+    from TurbidostatIncreaseStress_odring import ODRing
+
+    if feed == "broker":
+        connection = socket.create_connection(address)
+        send = lambda od: connection.sendall(f"{topic}\t{json.dumps({'ods': {'2': {'od': od, 'timestamp': time.time()}}})}\n".encode())
+    else:
+        ring = ODRing(address, ["2"])
+        send = lambda od: ring.publish({"2": od}, time.time())
+    for i in range(n_readings):
+        send(1.0 + i * 1e-6)
+        time.sleep(interval)
+    if feed == "broker":
+        connection.close()
+    results.put(("publisher", time.process_time()))
+
+
+def measure_od_feed(n_readings=500, interval=0.01, od_ring_poll=0.5):
+    '''
+    OD readings from an od_reading stand-in process to this process, through a local broker stand-in (JSON over TCP, one hop
+    through the broker process, like MQTT on the Pi) and through the shared-memory ODRing of TurbidostatIncreaseStress_odring,
+    woken by its doorbell.
+    Returns {feed: (latencies in ms, CPU µs per reading summed over the processes)}.
+    '''
+    import json
+    import multiprocessing
+    import socket
+
+    import TurbidostatIncreaseStress_odring
+
+    standins = install_pioreactor_standins()
+    TurbidostatIncreaseStress_odring.OD_RING_DIR = standins.storage_dir  # keep the OD rings of the measurement out of /dev/shm
+    context = multiprocessing.get_context("fork")
+    topic = "pioreactor/feed/simulation/od_reading/ods"
+    results = {}
+    for feed in ("broker", "ring"):
+        queue = context.Queue()
+        processes = []
+        if feed == "broker":
+            server = socket.create_server(("127.0.0.1", 0))
+            processes.append(context.Process(target=_broker_standin, args=(server, topic, queue)))
+            processes[0].start()
+            subscriber = socket.create_connection(server.getsockname())
+            lines = subscriber.makefile("rb")
+            address = server.getsockname()
+        else:
+            address = TurbidostatIncreaseStress_odring.od_ring_path("feed", "simulation")
+        processes.append(context.Process(target=_od_publisher, args=(feed, address, topic, n_readings, interval, queue)))
+
+        started_cpu = time.process_time()
+        processes[-1].start()
+        latencies = []
+        if feed == "broker":
+            for line in lines:
+                reading = json.loads(line.split(b"\t", 1)[1])["ods"]["2"]
+                latencies.append(time.time() - reading["timestamp"])
+        else:
+            ring = None
+            seen = 0
+            while len(latencies) < n_readings and (ring is None or processes[-1].is_alive() or ring.written > seen):
+                if ring is None:
+                    try:
+                        ring = TurbidostatIncreaseStress_odring.ODRing(address)
+                    except (OSError, ValueError):
+                        time.sleep(0.001)
+                        continue
+                ring.wait(od_ring_poll)
+                written = ring.written
+                if written > seen:
+                    seen = written
+                    timestamp, ods = ring.read(written - 1)
+                    latencies.append(time.time() - timestamp)
+            ring.close()
+        cpu = time.process_time() - started_cpu
+        for process in processes:
+            process.join()
+        while not queue.empty():
+            cpu += queue.get()[1]
+        results[feed] = (np.array(latencies) * 1000, cpu / n_readings * 1e6)
+    return results
+
+
+def measure_dilution_cycle(volume=5.0, alt_media_ratio=0.5, time_scale=0.02, culture_volume=14.0, max_volume=18.0):
+    '''
+    Wall-clock time of one dilution cycle, one pump at a time (pioreactor's execute_io_action) and with concurrent_dosing,
+    using stand-in pumps that take ml / PUMP_ML_PER_SECOND seconds (scaled by time_scale to keep the measurement short).
+    Returns {concurrent_dosing: (seconds per cycle, peak vial volume in mL)}.
+    '''
+    results = {}
+    for concurrent in (False, True):
+        plugin, standins = load_plugin()
+        bank = ReactorBank(1, CultureModel(culture_volume=culture_volume))
+        automation = plugin.TurbidostatIncreaseStress(
+            target_od=2.0, volume=volume, dilutions=10, initial_alt_media=alt_media_ratio, alt_media_ratio_increase=0.05,
+            concurrent_dosing=concurrent, culture_volume=culture_volume, max_volume=max_volume,
+            unit="dosing_cycle", experiment="simulation", bank=bank, index=0,
+        )
+        standins.pump_timing.time_scale = time_scale
+        alt_media_ml = volume * alt_media_ratio
+        started = time.perf_counter()
+        automation.execute_io_action(alt_media_ml=alt_media_ml, media_ml=volume - alt_media_ml, waste_ml=volume)
+        results[concurrent] = ((time.perf_counter() - started) / time_scale, float(bank.peak_volume[0]))
+        automation.on_disconnected()
+    return results
+
+
+# Checks of behaviour that broke once, run with --check (exit code 1 if one fails). Each check_* function raises AssertionError
+# saying what went wrong.
+
+def check_engines_agree():
+    assert compare_engines(), "the plugin and the vectorized engine dosed differently on the same noise"
+
+
+def check_yaml_types():
+    # TurbidostatIncreaseStress_run.py converts the command line, INI and prompt values to the type of the YAML default,
+    # so every default must have the type of the plugin's datatype (a float setting with a default of 0 only takes ints).
+    from TurbidostatIncreaseStress_run import read_fields
+
+    plugin, _ = load_plugin()
+    python_types = {"float": float, "int": int, "boolean": int, "string": str}
+    for key, field in read_fields().items():
+        setting = plugin.TurbidostatIncreaseStress.published_settings.get(key)
+        if setting is not None and setting["datatype"] in python_types:
+            expected = python_types[setting["datatype"]]
+            assert type(field["default"]) is expected, f"{key}: the YAML default {field['default']!r} is not a {expected.__name__}"
+
+
+def check_validate_like_plugin():
+    # TurbidostatIncreaseStress_run.py --validate rejects exactly the settings the plugin rejects when the job starts.
+    from TurbidostatIncreaseStress_run import configured_od_channels, read_fields, validate
+
+    plugin, _ = load_plugin() # od_reading reads channel 2 (and 1 as the reference) on the stand-in unit
+    fields = read_fields()
+    defaults = {key: field["default"] for key, field in fields.items()}
+    with tempfile.TemporaryDirectory() as folder:
+        with open(f"{folder}/config.ini", "w") as f:
+            f.write("[od_config.photodiode_channel]\n1=REF\n2=90\n")
+        od_channels = configured_od_channels([f"{folder}/config.ini"])
+    for changes in ({}, {"stress_schedule": "exponential:0.5"}, {"stress_schedule": "table:"}, {"stress_schedule": "table:0.5,1.5"},
+                    {"stress_step_every": "hours:"}, {"od_channel": "7"}, {"od_channel": "2"}, {"od_filter_window": 0}):
+        settings = {**defaults, **changes}
+        problems = validate(fields, settings, od_channels)
+        try:
+            plugin.TurbidostatIncreaseStress(unit="check", experiment="validate", **settings)
+            rejected = None
+        except ValueError as e:
+            rejected = str(e)
+        assert bool(problems) == (rejected is not None), f"{changes}: --validate found {problems}, the plugin {rejected or 'accepted them'}"
+
+
+def check_float_interval():
+    from TurbidostatIncreaseStress_run import build_parser, read_fields, resolve_settings, validate
+
+    fields = read_fields()
+    with tempfile.TemporaryDirectory() as folder:
+        ini = f"{folder}/turbidostat_config.ini"
+        with open(ini, "w") as f:
+            f.write("[TurbidostatSettings]\nmin_dilution_interval = 0.5\n")
+        for argv, expected in ((["--min_dilution_interval", "2.5"], 2.5), (["--config", ini], 0.5)):
+            resolved = resolve_settings(fields, build_parser(fields).parse_args(argv))
+            settings = {key: value for key, (value, _) in resolved.items()}
+            assert settings["min_dilution_interval"] == expected, f"{' '.join(argv)}: min_dilution_interval = {settings['min_dilution_interval']!r}"
+            assert not validate(fields, settings), f"{' '.join(argv)}: {validate(fields, settings)}"
+
+
+def check_lockstep_off():
+    # A unit waiting at the end of a step for the fleet coordinator moves on by itself once lockstep is turned off.
+    plugin, _ = load_plugin()
+    bank = ReactorBank(1, CultureModel())
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="lockstep_off", target_od=2.0, volume=1.0, dilutions=3,
+                                                  initial_alt_media=0.25, alt_media_ratio_increase=0.05, lockstep=True, bank=bank, index=0)
+    automation.latest_od = {"2": 3.0} # above target_od: every decision dilutes
+    for _ in range(4):
+        automation.execute()
+    assert automation.step_ready and automation.ratio_step == 0, "the step should be done and waiting in lockstep"
+    automation.set_lockstep("0")
+    for _ in range(6):
+        automation.execute()
+    automation.on_disconnected()
+    assert not automation.step_ready, "still waiting for the fleet coordinator after lockstep was turned off"
+    assert automation.ratio_step == 3 and automation.dilution_count == 0, \
+        f"ratio_step {automation.ratio_step}, dilution_count {automation.dilution_count} (expected 3 and 0)"
+
+
+def check_constant_ratio():
+    # alt_media_ratio_increase = 0 is valid in the YAML file, and holds initial_alt_media for the whole run.
+    from TurbidostatIncreaseStress_run import build_parser, read_fields, resolve_settings, validate
+
+    fields = read_fields()
+    resolved = resolve_settings(fields, build_parser(fields).parse_args(["--alt_media_ratio_increase", "0"]))
+    assert not validate(fields, {key: value for key, (value, _) in resolved.items()}), "alt_media_ratio_increase = 0 should validate"
+    result = simulate(days=2.0, engine="plugin", seed=0, initial_alt_media=0.3, alt_media_ratio_increase=0.0)
+    assert result["dilutions_total"][0] > 0 and result["final_alt_media_ratio"][0] == 0.3, \
+        f"final alt_media_ratio {result['final_alt_media_ratio'][0]} after {result['dilutions_total'][0]} dilutions (expected 0.3)"
+    assert compare_engines(initial_alt_media=0.3, alt_media_ratio_increase=0.0), "the engines disagree on a constant ratio"
+
+
+def check_adaptive_volume():
+    # adaptive_volume waits until the OD needs a dose worth its pump runs, doses whole pump chunks, and counts the mL towards the ramp.
+    plugin, _ = load_plugin()
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="adaptive", target_od=2.0, volume=5.0, dilutions=10,
+                                                  initial_alt_media=0.25, alt_media_ratio_increase=0.05, adaptive_volume=True,
+                                                  culture_volume=14.0, max_volume=18.0)
+    doses = []
+    automation.execute_io_action = lambda **volumes: doses.append(volumes["waste_ml"])
+    for od in (2.05, 2.15, 2.2, 2.8, 2.8):  # need 0.35, 1.05, 1.4 and 5.6 mL
+        automation.latest_od = {"2": od}
+        automation.execute()
+    automation.on_disconnected()
+    assert doses == [2.5, 2.5, 2.5], f"doses {doses}: expected none below 1.25 mL needed, then 2.5 mL (4 full chunks, the most that fits in 4 mL of headroom)"
+    assert automation.dilution_count == 1 and automation.exchanged_ml == 2.5, f"7.5 mL exchanged counted as {automation.dilution_count} dilutions + {automation.exchanged_ml} mL"
+
+
+def check_concurrent_dosing():
+    # concurrent_dosing pumps through the job's per-pump functions, at most MAX_ML_PER_ACTION a run, starts no new chunk once
+    # the job is asked to sleep, removes what it added before returning, and returns a SummableDict like execute_io_action.
+    plugin, _ = load_plugin()
+    bank = ReactorBank(1, CultureModel())
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="concurrent_dosing", target_od=2.0, volume=5.0, dilutions=10,
+                                                  initial_alt_media=0.5, alt_media_ratio_increase=0.05, concurrent_dosing=True, bank=bank, index=0)
+    runs = []
+    add_media_to_bioreactor = automation.add_media_to_bioreactor
+
+    def add_media_then_sleep(ml, **kwargs):
+        runs.append(ml)
+        if len(runs) == 2:
+            automation.state = automation.SLEEPING # asked to sleep in the middle of the dilution
+        return add_media_to_bioreactor(ml=ml, **kwargs)
+
+    automation.add_media_to_bioreactor = add_media_then_sleep
+    moved = automation.execute_io_action(alt_media_ml=2.5, media_ml=2.5, waste_ml=5.0)
+    automation.on_disconnected()
+    assert type(moved).__name__ == "SummableDict", f"returned a {type(moved).__name__}"
+    assert max(runs) <= MAX_ML_PER_ACTION + 1e-9, f"a pump run of {max(runs)} mL"
+    assert 0 < moved["media_ml"] < 2.5, f"{moved['media_ml']} mL of media added after the job was asked to sleep"
+    assert abs(moved["waste_ml"] - moved["media_ml"] - moved["alt_media_ml"]) < 1e-9 and abs(bank.volume[0] - CultureModel().culture_volume) < 1e-9, \
+        f"the vial was left at {bank.volume[0]} mL"
+
+
+def check_od_ring_names():
+    # The channel names are stored in a fixed 32-byte field of the OD ring's header: names that don't fit are refused, not cut off.
+    from TurbidostatIncreaseStress_odring import ODRing
+
+    with tempfile.TemporaryDirectory() as folder:
+        ring = ODRing(f"{folder}/od.ring", ["1", "2"])
+        ring.publish({"1": 0.5, "2": 0.7}, 1.0)
+        reader = ODRing(f"{folder}/od.ring")
+        assert reader.channels == ["1", "2"] and reader.latest() == (1.0, {"1": 0.5, "2": 0.7}), f"read back {reader.channels}, {reader.latest()}"
+        reader.close()
+        ring.close()
+        for channels in ([f"channel_{i}" for i in range(4)], ["1,2"], [""]):
+            try:
+                ODRing(f"{folder}/bad.ring", channels)
+            except ValueError:
+                continue
+            raise AssertionError(f"an OD ring was created with the channels {channels}")
+
+
+def check_od_ring_reader():
+    # With od_ring=1 the automation decides on the readings of the OD ring, and on the broker's while the ring is missing or stale.
+    import time
+    import TurbidostatIncreaseStress_odring
+    from TurbidostatIncreaseStress_odring import ODRing, od_ring_path
+
+    plugin, standins = load_plugin()
+    TurbidostatIncreaseStress_odring.OD_RING_DIR = standins.storage_dir
+    ring = ODRing(od_ring_path("check", "od_ring"), ["1", "2"])
+    try:
+        for event_driven in (False, True):
+            automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="od_ring", target_od=2.0, volume=1.0, dilutions=10,
+                                                          initial_alt_media=0.25, alt_media_ratio_increase=0.05, od_ring=True,
+                                                          od_ring_poll=0.01, event_driven=event_driven)
+            ods = []
+            automation.combine_channels = lambda readings: ods.append(dict(readings)) or 1.0
+            automation.latest_od = {"2": 1.0}
+            ring.publish({"1": 0.5, "2": 3.0}, standins.clock.time())
+            if event_driven:
+                for _ in range(500):
+                    if ods:
+                        break
+                    time.sleep(0.01) # the od_ring thread picks the reading up
+                automation.decisions.submit(int).result()
+            else:
+                automation.execute()
+                standins.clock.advance(plugin.OD_RING_STALE_AFTER + 1.0)
+                automation.execute()
+            automation.on_disconnected()
+            expected = [{"1": 0.5, "2": 3.0}] + ([] if event_driven else [{"2": 1.0}])
+            assert ods == expected, f"event_driven={event_driven}: decided on {ods}, not {expected}"
+    finally:
+        ring.close()
+
+
+def check_checkpoint_layout():
+    # A checkpoint written with another record layout is not resumed from and not appended to, and the bottles are drawn by
+    # what the pumps moved, not by what was asked.
+    import os
+    import struct
+    import zlib
+
+    plugin, standins = load_plugin()
+    path = f"{standins.storage_dir}/turbidostat_increase_stress_check_layout.ckpt"
+    old = struct.pack("<dqdq", 1.0, 7, 0.5, 3) # an older, shorter record
+    with open(path, "wb") as f:
+        f.write((old + struct.pack("<I", zlib.crc32(old))) * 10)
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="layout", target_od=2.0, volume=1.0, dilutions=10,
+                                                  initial_alt_media=0.25, alt_media_ratio_increase=0.05, resume=True, media_reservoir_ml=100.0)
+    assert automation.dilution_count == 0 and automation.ratio_step == 0, f"resumed from an old checkpoint: step {automation.ratio_step}, {automation.dilution_count} dilutions"
+    automation.execute_io_action = lambda **volumes: plugin.SummableDict(media_ml=0.25, alt_media_ml=0.125, waste_ml=0.375) # stopped halfway
+    automation.latest_od = {"2": 3.0}
+    automation.execute()
+    automation.on_disconnected()
+    assert automation.inventory.left("media") == 99.75, f"{automation.inventory.left('media')} mL of media left, 0.25 mL were pumped"
+    saved = plugin.RampCheckpoint(path).latest()
+    assert saved is not None and saved[1] == 1, f"the new checkpoint reads back as {saved}"
+    assert os.path.exists(path + ".old"), "the old checkpoint was not kept aside"
+
+
+def check_event_driven_decisions():
+    # event_driven hands each OD reading from the MQTT callback to the decisions thread, and drops the readings taken before
+    # the last dilution finished.
+    import json
+    import threading
+    from datetime import datetime, timezone
+
+    plugin, standins = load_plugin()
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="event_driven", target_od=2.0, volume=1.0, dilutions=10,
+                                                  initial_alt_media=0.25, alt_media_ratio_increase=0.05, event_driven=True)
+    dilutions = []
+    def execute_io_action(**volumes):
+        dilutions.append(threading.current_thread().name)
+        standins.clock.advance(30.0)  # the pumps run for 30 s
+    automation.execute_io_action = execute_io_action
+    topic = "pioreactor/check/event_driven/od_reading/ods"
+
+    def publish(od, taken_at):
+        timestamp = datetime.fromtimestamp(taken_at, timezone.utc).isoformat().replace("+00:00", "Z")
+        standins.publish(topic, json.dumps({"ods": {"2": {"od": od, "channel": "2", "angle": "90"}}, "timestamp": timestamp}))
+        automation.decisions.submit(int).result()
+
+    started = standins.clock.time()
+    publish(3.0, started)
+    assert len(dilutions) == 1 and dilutions[0].startswith("od_decisions"), f"the dilution ran on {dilutions}, not on the decisions thread"
+    publish(3.0, started + 10.0) # taken while the pumps ran
+    assert len(dilutions) == 1, "a reading taken during the dilution triggered another one"
+    publish(3.0, started + 40.0)
+    automation.on_disconnected()
+    assert len(dilutions) == 2, "a reading taken after the dilution was dropped"
+
+
+def check_event_driven_metrics():
+    # With metrics=1, the event_driven decisions and their dilutions are timed and exported like execute() ticks.
+    import json
+
+    plugin, standins = load_plugin()
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="metrics", target_od=2.0, volume=1.0, dilutions=10,
+                                                  initial_alt_media=0.25, alt_media_ratio_increase=0.05, event_driven=True, metrics=True)
+    standins.publish("pioreactor/check/metrics/od_reading/ods", json.dumps({"ods": {"2": {"od": 3.0, "channel": "2", "angle": "90"}}}))
+    automation.decisions.submit(int).result()
+    automation.on_disconnected()
+    summary = automation.metrics_summary
+    assert summary.get("decide_on_reading", {}).get("count") == 1, f"the decision was not timed: {summary}"
+    assert summary["dispensed_ml"]["waste"] == 1.0, f"the dilution was not counted: {summary}"
+    with open(automation.meter.path) as f:
+        assert 'method="decide_on_reading"' in f.read(), "decide_on_reading is missing from the Prometheus file"
+
+
+def check_string_settings_logged():
+    # A change of a string setting records its value in the decision log's string table, not NaN.
+    from TurbidostatIncreaseStress_decisionlog import SETTINGS, read_decision_log, read_string_table, setting_value
+
+    plugin, _ = load_plugin()
+    assert SETTINGS == plugin.RECONFIGURABLE_SETTINGS, "the decision log reader numbers the settings differently from the plugin"
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="string_settings", target_od=2.0, volume=1.0, dilutions=10,
+                                                  initial_alt_media=0.25, alt_media_ratio_increase=0.05)
+    automation.reconfigure({"od_filter": "median", "od_channel": "2", "volume": 2.0})
+    automation.reconfigure({"od_filter": "ewma"})
+    automation.reconfigure({"od_filter": "median"})
+    path = automation.decision_log.path
+    automation.on_disconnected()
+    records = read_decision_log(path)
+    strings = read_string_table(path)
+    logged = [setting_value(record, strings) for record in records[records["kind"] == 1]]
+    assert sorted(logged[:3]) == [("od_channel", "2"), ("od_filter", "median"), ("volume", 2.0)] and logged[3:] == [("od_filter", "ewma"), ("od_filter", "median")], \
+        f"logged {logged}"
+    assert len(strings) == 3, f"the string table {strings} should hold each value once"
+
+
+def check_steps_follow_ratio_step():
+    # The analytics split a run into the steps of the schedule, also when consecutive steps have the same alt_media_ratio.
+    from TurbidostatIncreaseStress_analytics import analyze_run
+
+    plugin, standins = load_plugin()
+    bank = ReactorBank(1, CultureModel())
+    automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="ratio_step", target_od=2.0, volume=1.0, dilutions=3,
+                                                  initial_alt_media=0.3, alt_media_ratio_increase=0.0, bank=bank, index=0)
+    automation.latest_od = {"2": 3.0} # above target_od: every decision dilutes
+    for _ in range(10):
+        automation.execute()
+        standins.clock.advance(60.0)
+    path = automation.decision_log.path
+    automation.on_disconnected()
+    for chunk_size in (2**16, 2): # also with steps across chunks
+        steps = analyze_run(path, chunk_size=chunk_size)
+        found = [(step["step"], step["alt_media_ratio"], step["dilutions"]) for step in steps]
+        assert found == [(0, 0.3, 3), (1, 0.3, 3), (2, 0.3, 3), (3, 0.3, 1)], f"chunks of {chunk_size}: steps {found}"
+
+
+def check_sweep_seeding():
+    # A sweep's results don't depend on batch_size: each combination is seeded from its own index.
+    import contextlib
+    import io
+
+    from TurbidostatIncreaseStress_sweep import RESULT_COLUMNS, build_grid, load_fields, sweep
+
+    grid = build_grid(["target_od=1.5,2.0,2.5", "volume=1,2"], load_fields())
+    with tempfile.TemporaryDirectory() as folder:
+        results = {}
+        for batch_size in (6, 4, 1):
+            with contextlib.redirect_stdout(io.StringIO()): # the batch progress lines
+                sweep(grid, f"{folder}/{batch_size}", days=1.0, batch_size=batch_size, workers=2, seed=3)
+            results[batch_size] = {column: np.load(f"{folder}/{batch_size}/{column}.npy") for column in RESULT_COLUMNS}
+    for batch_size in (4, 1):
+        for column in RESULT_COLUMNS:
+            assert np.array_equal(results[batch_size][column], results[6][column], equal_nan=True), \
+                f"{column} differs between batch_size 6 and {batch_size}"
+
+
+def check_calls_after_disconnect():
+    # The timer and the MQTT callbacks can still call in while on_disconnected runs and after it returned: they do nothing.
+    import json
+
+    plugin, standins = load_plugin()
+    for event_driven in (False, True):
+        automation = plugin.TurbidostatIncreaseStress(unit="check", experiment="disconnect", target_od=2.0, volume=1.0, dilutions=10,
+                                                      initial_alt_media=0.25, alt_media_ratio_increase=0.05, event_driven=event_driven)
+        dilutions = []
+        automation.execute_io_action = lambda **volumes: dilutions.append(volumes)
+        automation.on_disconnected()
+        automation.latest_od = {"2": 3.0}
+        automation.execute()
+        automation.latest_od = None
+        automation.execute()
+        standins.publish("pioreactor/check/disconnect/od_reading/ods", json.dumps({"ods": {"2": {"od": 3.0, "channel": "2", "angle": "90"}}}))
+        automation.decide_on_reading({"2": 3.0}, standins.clock.time(), standins.clock.time())
+        assert not dilutions, f"dilutions ran after on_disconnected: {dilutions}"
+
+
+def check_lockstep_waits_for_fleet():
+    # Lockstep on every unit of the cluster moves the fleet on only once all of its units are ready, not the ones that reported.
+    from TurbidostatIncreaseStress_fleet import FleetCoordinator
+
+    try:
+        FleetCoordinator("lockstep", None, lambda topic, payload: None, lockstep=True)
+        assert False, "lockstep on every unit of the cluster started without the fleet size"
+    except ValueError:
+        pass
+    published = []
+    coordinator = FleetCoordinator("lockstep", None, lambda topic, payload: published.append((topic, payload)), lockstep=True, fleet_size=3)
+    for unit in ("unit001", "unit002", "unit003"):
+        assert not published, f"the fleet moved on before {unit} reported: {published}"
+        coordinator.on_message(f"pioreactor/{unit}/lockstep/dosing_automation/ratio_step", "0")
+        coordinator.on_message(f"pioreactor/{unit}/lockstep/dosing_automation/step_ready", "1")
+    assert published == [("pioreactor/$broadcast/lockstep/dosing_automation/ratio_step/set", "1")], f"published {published}"
+
+
+def run_checks():
+    # {name: None if the check passed, else what failed}, in the order the checks are defined.
+    results = {}
+    for name, check in list(globals().items()):
+        if name.startswith("check_") and callable(check):
+            try:
+                check()
+                results[name] = None
+            except AssertionError as e:
+                results[name] = str(e) or "failed"
+            except Exception as e:
+                results[name] = f"{type(e).__name__}: {e}"
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Simulate the Turbidostat Increase Stress automation offline')
+    parser.add_argument('--target_od', type=float, default=2.0, help='Target optical density')
+    parser.add_argument('--volume', type=float, default=5.0, help='Volume for dilution')
+    parser.add_argument('--dilutions', type=int, default=10, help='Number of dilutions')
+    parser.add_argument('--initial_alt_media', type=float, default=0.25, help='Initial alternate media ratio')
+    parser.add_argument('--alt_media_ratio_increase', type=float, default=0.05, help='Media ratio increase after each cycle')
+    parser.add_argument('--days', type=float, default=7.0, help='Simulated run length, in days')
+    parser.add_argument('--duration', type=float, default=1.0, help='How often execute runs, in minutes')
+    parser.add_argument('--reactors', type=int, default=1, help='Number of reactors simulated at once')
+    parser.add_argument('--engine', choices=["vectorized", "plugin"], default="vectorized")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--latency', action='store_true', help='Measure the event-driven trigger-to-pump latency instead of simulating a run')
+    parser.add_argument('--dosing_cycle', action='store_true', help='Time one dilution cycle with and without concurrent_dosing instead of simulating a run')
+    parser.add_argument('--adaptive_volume', action='store_true', help='Compare the fixed volume per dilution with adaptive_volume instead of simulating a run')
+    parser.add_argument('--od_feed', action='store_true', help='Compare the latency and CPU of the OD readings through a local broker and through the shared-memory ring instead of simulating a run')
+    parser.add_argument('--metrics_cost', action='store_true', help='Measure the cost of an execute() tick with metrics off and on instead of simulating a run')
+    parser.add_argument('--growth_cost', action='store_true', help='Measure the cost and accuracy of the online growth rate estimator instead of simulating a run')
+    parser.add_argument('--check', action='store_true', help='Run the checks of behaviour that broke once instead of simulating a run (exit code 1 if one fails)')
+    args = parser.parse_args()
+
+    if args.check:
+        results = run_checks()
+        for name, problem in results.items():
+            print(f"{name:>32}: {'ok' if problem is None else 'FAILED, ' + problem}")
+        sys.exit(1 if any(problem is not None for problem in results.values()) else 0)
+
+    if args.dosing_cycle:
+        for concurrent, (seconds, peak_volume) in measure_dilution_cycle(volume=args.volume).items():
+            print(f"concurrent_dosing={concurrent!s:>5}: {seconds:6.1f} s per {args.volume} mL dilution cycle, peak vial volume {peak_volume:.2f} mL")
+        sys.exit(0)
+
+    if args.adaptive_volume:
+        results = compare_dilution_volume(days=args.days, n_reactors=max(args.reactors, 8), seed=args.seed, target_od=args.target_od, volume=args.volume,
+                                          dilutions=args.dilutions, initial_alt_media=args.initial_alt_media, alt_media_ratio_increase=args.alt_media_ratio_increase)
+        print(f"{'':>26} {'fixed volume':>14} {'adaptive_volume':>16}")
+        for key in results[False]:
+            print(f"{key:>26} {results[False][key]:14.3f} {results[True][key]:16.3f}")
+        sys.exit(0)
+
+    if args.od_feed:
+        for feed, (latencies, cpu_us) in measure_od_feed().items():
+            print(f"{feed:>6}: latency median {np.median(latencies):.3f} ms, p99 {np.percentile(latencies, 99):.3f} ms, "
+                  f"{len(latencies)} readings received, CPU {cpu_us:.0f} µs per reading (all processes)")
+        sys.exit(0)
+
+    if args.metrics_cost:
+        for metrics, us_per_call in measure_metrics_overhead().items():
+            print(f"metrics={metrics!s:>5}: {us_per_call:.2f} µs per execute() tick")
+        sys.exit(0)
+
+    if args.growth_cost:
+        us_per_sample, rate, generations, true_generations = measure_growth_estimator()
+        print(f"Growth rate estimator: {us_per_sample:.2f} µs per OD sample, growth rate {rate:.3f} h⁻¹ (true 0.400), "
+              f"{generations:.1f} generations (true {true_generations:.1f})")
+        sys.exit(0)
+
+    if args.latency:
+        latencies, od_interval_ms = measure_trigger_latency()
+        print(f"Trigger-to-pump latency over {len(latencies)} dilutions: median {np.median(latencies):.3f} ms, "
+              f"p99 {np.percentile(latencies, 99):.3f} ms, max {latencies.max():.3f} ms (OD sampling interval {od_interval_ms:.0f} ms)")
+        sys.exit(0)
+
+    started = time.perf_counter()
+    result = simulate(args.target_od, args.volume, args.dilutions, args.initial_alt_media, args.alt_media_ratio_increase,
+                      n_reactors=args.reactors, days=args.days, duration=args.duration, engine=args.engine, seed=args.seed)
+    elapsed = time.perf_counter() - started
+
+    print(f"Simulated {args.reactors} reactor(s) x {args.days} days in {elapsed:.2f} s ({args.engine} engine)")
+    warnings.simplefilter("ignore", RuntimeWarning)  # nanmean of a result that is NaN for every reactor
+    for key, values in result.items():
+        print(f"  {key:>24}: mean {np.nanmean(values):10.3f}   min {np.nanmin(values):10.3f}   max {np.nanmax(values):10.3f}")
@@ -0,0 +1,130 @@
+
+'''
+Parameter sweep over the published settings of the Turbidostat Increase Stress automation, on the offline simulator.
+
+The swept keys, their units and their default values come from the fields of TurbidostatIncreaseStress.yaml.
+Every key not given with --grid stays at its YAML default. A grid entry is either a list of values or start:stop:num (inclusive, like numpy.linspace).
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_sweep.py --days 7 --grid target_od=1.0:3.0:10 --grid volume=1,2,5 --grid dilutions=5:20:16 --grid alt_media_ratio_increase=0.01:0.1:10 --output sweep_results
+
+Each simulated combination reports its media use, pump activations, time to reach 100% alt_media and OD stability.
+Batches of combinations run as vectorized simulations on a process pool (all cores by default), and the results are streamed
+into one .npy file per column in the output folder. Read them back with:
+
+    import numpy as np
+    hours = np.load("sweep_results/hours_to_full_alt_media.npy", mmap_mode="r")
+'''
+
+import argparse
+import inspect
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import yaml
+
+from TurbidostatIncreaseStress_simulator import CultureModel, simulate
+
+
+YAML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TurbidostatIncreaseStress.yaml")
+
+RESULT_COLUMNS = {
+    "media_ml": "f4",                   # normal media used
+    "alt_media_ml": "f4",               # alternate media used
+    "pump_activations": "i4",           # media + alt_media + waste pump runs
+    "hours_to_full_alt_media": "f4",    # NaN if the ramp never reached 100% alt_media
+    "od_relative_std": "f4",            # OD stability: std of (od - target_od) / target_od after first reaching target_od
+    "final_alt_media_ratio": "f4",
+}
+
+
+def load_fields(yaml_path=YAML_PATH):
+    # Only the fields the simulator knows how to vary (the five dosing settings), not the runtime options like event_driven.
+    sweepable = inspect.signature(simulate).parameters
+    with open(yaml_path) as f:
+        return {field["key"]: field for field in yaml.safe_load(f)["fields"] if field["key"] in sweepable}
+
+
+def parse_grid_value(text, field):
+    cast = int if isinstance(field["default"], int) else float
+    if ":" in text:
+        start, stop, num = text.split(":")
+        values = np.linspace(float(start), float(stop), int(num))
+        return sorted(set(cast(round(v)) if cast is int else cast(v) for v in values))
+    return [cast(v) for v in text.split(",")]
+
+
+def build_grid(grid_args, fields):
+    # Returns the swept values for every YAML field, in the YAML order.
+    values = {key: [field["default"]] for key, field in fields.items()}
+    for entry in grid_args:
+        key, _, text = entry.partition("=")
+        if key not in fields:
+            raise ValueError(f"{key} is not a field of TurbidostatIncreaseStress.yaml. Choose from: {', '.join(fields)}")
+        values[key] = parse_grid_value(text, fields[key])
+    return values
+
+
+def _run_batch(start, params, days, duration, model, seed):
+    # Runs in a worker process: one vectorized simulation for the whole batch. Combination number i is seeded with seed + i,
+    # so its result doesn't depend on batch_size or on the other combinations of its batch.
+    n = len(params["target_od"])
+    result = simulate(n_reactors=n, days=days, duration=duration, model=model, seed=seed + np.arange(start, start + n), **params)
+    return start, {column: result[column] for column in RESULT_COLUMNS}
+
+
+def sweep(values, output, days=7.0, duration=1.0, model=None, batch_size=256, workers=None, seed=0):
+    keys = list(values)
+    combinations = list(itertools.product(*(values[k] for k in keys)))
+    n = len(combinations)
+    os.makedirs(output, exist_ok=True)
+
+    # One preallocated column file per parameter and per result, filled as batches come back.
+    columns = {}
+    for i, key in enumerate(keys):
+        column = np.lib.format.open_memmap(os.path.join(output, f"{key}.npy"), mode="w+", dtype="i4" if isinstance(values[key][0], int) else "f4", shape=(n,))
+        column[:] = [c[i] for c in combinations]
+        columns[key] = column
+    for column, dtype in RESULT_COLUMNS.items():
+        columns[column] = np.lib.format.open_memmap(os.path.join(output, f"{column}.npy"), mode="w+", dtype=dtype, shape=(n,))
+
+    with open(os.path.join(output, "sweep.json"), "w") as f:
+        json.dump({"n": n, "days": days, "duration": duration, "grid": values, "columns": keys + list(RESULT_COLUMNS)}, f, indent=2)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_run_batch, start, {key: np.asarray(columns[key][start:start + batch_size]) for key in keys}, days, duration, model, seed)
+            for start in range(0, n, batch_size)
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            start, result = future.result()
+            for column, values_ in result.items():
+                columns[column][start:start + len(values_)] = values_
+            print(f"  batch {done}/{len(futures)} done", flush=True)
+
+    for column in columns.values():
+        column.flush()
+    return n
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description='Sweep the Turbidostat Increase Stress settings on the offline simulator')
+    parser.add_argument('--grid', action='append', default=[], help='key=v1,v2,... or key=start:stop:num, key being a field of TurbidostatIncreaseStress.yaml')
+    parser.add_argument('--days', type=float, default=7.0, help='Simulated run length, in days')
+    parser.add_argument('--duration', type=float, default=1.0, help='How often execute runs, in minutes')
+    parser.add_argument('--output', default='sweep_results', help='Folder for the column files')
+    parser.add_argument('--batch_size', type=int, default=256, help='Combinations simulated together in one vectorized run')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    grid = build_grid(args.grid, load_fields())
+    started = time.perf_counter()
+    n = sweep(grid, args.output, days=args.days, duration=args.duration, model=CultureModel(), batch_size=args.batch_size, workers=args.workers, seed=args.seed)
+    print(f"Swept {n} combinations in {time.perf_counter() - started:.1f} s, results in {args.output}/")
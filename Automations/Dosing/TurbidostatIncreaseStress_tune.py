@@ -0,0 +1,314 @@
+
+'''
+Auto-tuning of the Turbidostat Increase Stress settings (target_od, volume, dilutions by default) on the offline simulator.
+
+The objective of a set of settings is a simulated run, on the same culture model and the same noise for every candidate:
+  cost = (media_ml + alt_media_ml) per day / 100  +  od_weight * od_relative_std  +  ramp_weight * ramp miss
+the ramp miss being how far the time to reach 100% alt_media is from --ramp_hours, beyond --ramp_tolerance (relative).
+So 100 mL a day, an OD standard deviation of 10% of target_od (with od_weight 10) and a ramp 100% too long all cost 1.
+
+The search is a Bayesian optimization: a Gaussian process (Matern 5/2 kernel, on log(cost)) fitted to every evaluated point,
+and batches of candidates chosen by expected improvement (each pick of a batch assumes the points picked before it score
+what the process predicts). Each batch is simulated in parallel on a process pool (all cores by default), and every evaluated
+point is appended to a cache file as soon as it is done, so an interrupted tuning resumes where it stopped, and changing
+only the weights re-scores the cached simulations without running them again.
+
+run on the command line with
+
+python3 TurbidostatIncreaseStress_tune.py --ramp_hours 72 --tune target_od=0.5:3.0 --tune volume=0.5:4.0 --tune dilutions=2:30
+
+--tune key=low:high tunes a field of TurbidostatIncreaseStress.yaml in that range, --tune key=value fixes it, every other
+field the simulator knows keeps its YAML default. The best settings are written as a copy of TurbidostatIncreaseStress.yaml
+with those defaults (--output), ready to be used as the plugin's YAML file.
+'''
+
+import argparse
+import hashlib
+import inspect
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from TurbidostatIncreaseStress_run import YAML_PATH, read_fields
+from TurbidostatIncreaseStress_settings import check_setting
+from TurbidostatIncreaseStress_simulator import CultureModel, simulate
+
+
+DEFAULT_TUNE = ["target_od=0.5:3.0", "volume=0.5:4.0", "dilutions=2:30"]
+
+
+def tunable_fields(yaml_path=YAML_PATH):
+    # The fields of the YAML file the simulator can vary (the dosing settings), like TurbidostatIncreaseStress_sweep.py.
+    simulated = inspect.signature(simulate).parameters
+    return {key: field for key, field in read_fields(yaml_path).items() if key in simulated}
+
+
+def parse_space(tune_args, fields):
+    # Returns ({key: (low, high, cast)} tuned, {key: value} fixed). Every field not given keeps its YAML default.
+    space, fixed = {}, {key: field["default"] for key, field in fields.items()}
+    for entry in tune_args:
+        key, _, text = entry.partition("=")
+        if key not in fields:
+            raise ValueError(f"{key} is not a field the simulator can vary. Choose from: {', '.join(fields)}")
+        cast = type(fields[key]["default"])
+        values = [cast(float(v)) if cast is int else cast(v) for v in text.split(":")]
+        for value in values:
+            problem = check_setting(fields[key], value)
+            if problem is not None:
+                raise ValueError(f"{key} = {value} {problem}")
+        if len(values) == 1:
+            fixed[key] = values[0]
+            space.pop(key, None)
+        else:
+            low, high = sorted(values)
+            space[key] = (low, high, cast)
+            fixed.pop(key)
+    return space, fixed
+
+
+def decode(space, unit_point):
+    # A point of the unit cube as settings: ints rounded, floats to 3 decimals (so the cache sees them as the same point).
+    settings = {}
+    for (key, (low, high, cast)), u in zip(space.items(), unit_point):
+        value = low + u * (high - low)
+        settings[key] = int(round(value)) if cast is int else round(float(value), 3)
+    return settings
+
+
+def encode(space, settings):
+    return np.array([(settings[key] - low) / (high - low) if high > low else 0.0 for key, (low, high, _) in space.items()])
+
+
+def evaluate(settings, days, duration, replicates, seed, model):
+    # Runs in a worker process: one vectorized simulation of `replicates` reactors with these settings, and the means of what
+    # the objective needs. The same seed for every candidate, so they are compared on the same noise.
+    result = simulate(n_reactors=replicates, days=days, duration=duration, model=model, seed=seed, **settings)
+    hours = result["hours_to_full_alt_media"]
+    initial = settings["initial_alt_media"]
+    progress = np.clip((result["final_alt_media_ratio"] - initial) / max(1.0 - initial, 1e-9), 0.01, 1.0)
+    # A ramp that didn't reach 100% alt_media counts as the time it would take at the pace it had
+    hours = np.where(np.isnan(hours), days * 24 / progress, hours)
+    return settings, {
+        "media_ml_per_day": float((result["media_ml"] + result["alt_media_ml"]).mean() / days),
+        "od_relative_std": float(np.nanmean(result["od_relative_std"])),
+        "ramp_hours": float(hours.mean()),
+    }
+
+
+def cost(metrics, ramp_hours, ramp_tolerance, od_weight, ramp_weight):
+    miss = max(abs(metrics["ramp_hours"] / ramp_hours - 1.0) - ramp_tolerance, 0.0)
+    return metrics["media_ml_per_day"] / 100 + od_weight * metrics["od_relative_std"] + ramp_weight * miss
+
+
+def matern52(a, b, lengthscale):
+    d = np.sqrt(5.0) * np.sqrt(((a[:, None, :] - b[None, :, :]) ** 2).sum(-1)) / lengthscale
+    return (1.0 + d + d * d / 3.0) * np.exp(-d)
+
+
+class GaussianProcess:
+    # Gaussian process regression on the unit cube, y standardized. The lengthscale is the one of LENGTHSCALES with the
+    # highest marginal likelihood: a few Cholesky factorizations of at most a few hundred points.
+    LENGTHSCALES = (0.05, 0.1, 0.2, 0.3, 0.5, 0.8, 1.2)
+
+    def __init__(self, x, y, noise=1e-4):
+        self.x = x
+        self.mean, self.scale = y.mean(), y.std() or 1.0
+        z = (y - self.mean) / self.scale
+        best = -np.inf
+        for lengthscale in self.LENGTHSCALES:
+            k = matern52(x, x, lengthscale) + noise * np.eye(len(x))
+            try:
+                chol = np.linalg.cholesky(k)
+            except np.linalg.LinAlgError:
+                continue
+            alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, z))
+            likelihood = -0.5 * z @ alpha - np.log(np.diag(chol)).sum()
+            if likelihood > best:
+                best, self.lengthscale, self.chol, self.alpha = likelihood, lengthscale, chol, alpha
+
+    def predict(self, x):
+        k = matern52(x, self.x, self.lengthscale)
+        v = np.linalg.solve(self.chol, k.T)
+        variance = np.clip(1.0 - (v * v).sum(0), 1e-12, None)
+        return self.mean + self.scale * (k @ self.alpha), self.scale * np.sqrt(variance)
+
+
+def expected_improvement(mean, std, best):
+    # For a minimization: the expected amount by which a point beats best.
+    z = (best - mean) / std
+    cdf = 0.5 * (1.0 + np.vectorize(math.erf)(z / np.sqrt(2.0)))
+    pdf = np.exp(-0.5 * z * z) / np.sqrt(2.0 * np.pi)
+    return (best - mean) * cdf + std * pdf
+
+
+def propose(space, x, y, batch, rng, n_candidates=2048):
+    # The next batch of points to evaluate: expected improvement over random points of the cube and around the best ones,
+    # each pick added to the data with its predicted value before the next one is chosen (kriging believer).
+    dims = len(space)
+    best_points = x[np.argsort(y)[:5]]
+    candidates = np.vstack([
+        rng.random((n_candidates, dims)),
+        np.clip(np.repeat(best_points, n_candidates // 8, axis=0) + rng.normal(0, 0.05, (len(best_points) * (n_candidates // 8), dims)), 0, 1),
+    ])
+    seen = {tuple(decode(space, point).values()) for point in x}
+    picked = []
+    for _ in range(batch):
+        gp = GaussianProcess(x, y)
+        mean, std = gp.predict(candidates)
+        for i in np.argsort(-expected_improvement(mean, std, y.min())):
+            settings = decode(space, candidates[i])
+            if tuple(settings.values()) not in seen:
+                break
+        else:
+            break # every candidate was already evaluated
+        seen.add(tuple(settings.values()))
+        picked.append(settings)
+        point = encode(space, settings)
+        x, y = np.vstack([x, point]), np.append(y, gp.predict(point[None, :])[0])
+    return picked
+
+
+class EvaluationCache:
+    # Evaluated points, appended to a JSON lines file as they complete. A line only counts for the same simulation (days,
+    # duration, replicates, seed, culture model, fixed settings): config is the hash of those. A line torn by an interruption
+    # is ignored.
+    def __init__(self, path, config):
+        self.path = path
+        self.config = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+        self.points = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("config") == self.config:
+                        self.points[self.key(entry["settings"])] = (entry["settings"], entry["metrics"])
+
+    @staticmethod
+    def key(settings):
+        return json.dumps(settings, sort_keys=True)
+
+    def get(self, settings):
+        return self.points.get(self.key(settings), (None, None))[1]
+
+    def add(self, settings, metrics):
+        self.points[self.key(settings)] = (settings, metrics)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"config": self.config, "settings": settings, "metrics": metrics}) + "\n")
+
+
+def tune(space, fixed, ramp_hours=72.0, ramp_tolerance=0.1, od_weight=10.0, ramp_weight=1.0, days=None, duration=1.0, replicates=4,
+         initial_points=8, iterations=6, batch=None, workers=None, seed=0, model=None, cache_path="tune_cache.jsonl", defaults=None, progress=print):
+    '''
+    Returns (best settings, its metrics, its cost, every evaluated (settings, metrics, cost)), settings including the fixed ones.
+    initial_points are defaults (the YAML defaults of the tuned keys) and points spread over the space at random (the cached
+    points count), then iterations batches are proposed.
+    '''
+    model = model or CultureModel()
+    days = days or ramp_hours * 1.5 / 24 # room for the ramp to finish, and to see the ones that are too slow
+    batch = batch or max(os.cpu_count() or 1, 4)
+    cache = EvaluationCache(cache_path, {"days": days, "duration": duration, "replicates": replicates, "seed": seed,
+                                         "model": vars(model), "fixed": fixed, "space": {key: [low, high] for key, (low, high, _) in space.items()}})
+    score = lambda metrics: cost(metrics, ramp_hours, ramp_tolerance, od_weight, ramp_weight)
+    rng = np.random.default_rng([seed, len(cache.points)])
+    history = [(settings, metrics) for settings, metrics in cache.points.values()]
+    if history:
+        progress(f"  {len(history)} points from {cache_path}")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def run(batch_settings):
+            todo = [settings for settings in batch_settings if cache.get(settings) is None]
+            futures = [pool.submit(evaluate, {**fixed, **settings}, days, duration, replicates, seed, model) for settings in todo]
+            for future in as_completed(futures):
+                full, metrics = future.result()
+                settings = {key: full[key] for key in space}
+                cache.add(settings, metrics)
+                history.append((settings, metrics))
+
+        if len(history) < initial_points:
+            # the YAML defaults (within the bounds) first, the reference the tuned settings are compared to
+            start = [decode(space, np.clip(encode(space, defaults), 0, 1))] if defaults and not history else []
+            run(start + [decode(space, point) for point in rng.random((initial_points - len(history) - len(start), len(space)))])
+        for iteration in range(iterations):
+            x = np.array([encode(space, settings) for settings, _ in history])
+            y = np.log(np.array([score(metrics) for _, metrics in history]))
+            proposed = propose(space, x, y, batch, rng)
+            if not proposed:
+                break
+            run(proposed)
+            settings, metrics = min(history, key=lambda item: score(item[1]))
+            progress(f"  batch {iteration + 1}/{iterations}: {len(history)} points, best cost {score(metrics):.3f} at {settings}")
+
+    evaluated = [({**fixed, **settings}, metrics, score(metrics)) for settings, metrics in history]
+    best = min(evaluated, key=lambda item: item[2])
+    return best[0], best[1], best[2], evaluated
+
+
+def write_yaml(settings, path, yaml_path=YAML_PATH, header=()):
+    # A copy of the plugin's YAML file with these settings as the defaults of their fields (comments, min / max kept, and
+    # the line endings of the original), and the header lines as comments at the top.
+    with open(yaml_path, newline="") as f:
+        lines = f.readlines()
+    newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    out, key = [f"# {line}{newline}" for line in header], None
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("- key:"):
+            key = stripped.partition(":")[2].strip()
+        elif stripped.startswith("default:") and key in settings:
+            line = f"{line[:len(line) - len(line.lstrip())]}default: {settings[key]}{newline}"
+        out.append(line)
+    with open(path, "w", newline="") as f:
+        f.writelines(out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tune the Turbidostat Increase Stress settings on the offline simulator')
+    parser.add_argument('--tune', action='append', default=None, help=f'key=low:high to tune, key=value to fix (default: {" ".join(DEFAULT_TUNE)})')
+    parser.add_argument('--ramp_hours', type=float, default=72.0, help='Wanted time from the start to 100%% alt_media, in hours')
+    parser.add_argument('--ramp_tolerance', type=float, default=0.1, help='Relative miss of ramp_hours that costs nothing')
+    parser.add_argument('--od_weight', type=float, default=10.0, help='Cost of the OD relative standard deviation')
+    parser.add_argument('--ramp_weight', type=float, default=1.0, help='Cost of a ramp 100%% off ramp_hours')
+    parser.add_argument('--days', type=float, default=None, help='Simulated run length, in days (default: 1.5 x ramp_hours)')
+    parser.add_argument('--duration', type=float, default=1.0, help='How often execute runs, in minutes')
+    parser.add_argument('--replicates', type=int, default=4, help='Simulated reactors per candidate, averaged')
+    parser.add_argument('--initial_points', type=int, default=8, help='Random points before the Bayesian optimization starts')
+    parser.add_argument('--iterations', type=int, default=6, help='Batches proposed by the Bayesian optimization')
+    parser.add_argument('--batch', type=int, default=None, help='Candidates per batch (default: the number of cores, at least 4)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--cache', default='tune_cache.jsonl', help='Evaluated points, to resume an interrupted tuning')
+    parser.add_argument('--output', default='TurbidostatIncreaseStress_tuned.yaml', help='YAML file written with the best settings')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fields = tunable_fields()
+    space, fixed = parse_space(args.tune or DEFAULT_TUNE, fields)
+    defaults = {key: fields[key]["default"] for key in space}
+    started = time.perf_counter()
+    settings, metrics, best_cost, evaluated = tune(
+        space, fixed, ramp_hours=args.ramp_hours, ramp_tolerance=args.ramp_tolerance, od_weight=args.od_weight, ramp_weight=args.ramp_weight,
+        days=args.days, duration=args.duration, replicates=args.replicates, initial_points=args.initial_points, iterations=args.iterations,
+        batch=args.batch, workers=args.workers, seed=args.seed, cache_path=args.cache, defaults=defaults,
+    )
+    summary = (f"cost {best_cost:.3f}: {metrics['media_ml_per_day']:.1f} mL of media a day, OD relative std {metrics['od_relative_std']:.4f}, "
+               f"100% alt_media after {metrics['ramp_hours']:.1f} h (wanted {args.ramp_hours:g} h)")
+    write_yaml(settings, args.output, header=[
+        f"Tuned by TurbidostatIncreaseStress_tune.py over {len(evaluated)} simulated candidates: {', '.join(f'{key} = {settings[key]}' for key in space)}",
+        summary,
+    ])
+    print(f"Evaluated {len(evaluated)} candidates in {time.perf_counter() - started:.1f} s")
+    print(f"Best: {', '.join(f'{key}={settings[key]}' for key in space)}, {summary}")
+    reference = decode(space, np.clip(encode(space, defaults), 0, 1))
+    for candidate, candidate_metrics, candidate_cost in evaluated:
+        if all(candidate[key] == reference[key] for key in space):
+            print(f"YAML defaults: {', '.join(f'{key}={reference[key]}' for key in space)}, cost {candidate_cost:.3f}: "
+                  f"{candidate_metrics['media_ml_per_day']:.1f} mL of media a day, OD relative std {candidate_metrics['od_relative_std']:.4f}, "
+                  f"100% alt_media after {candidate_metrics['ramp_hours']:.1f} h")
+    print(f"Written to {args.output}")